@@ -0,0 +1,64 @@
+"""
+Measures the throughput of PersonDetector in images/sec for different batch sizes, against
+running the detector on one full-size image at a time as crop_photos.py used to
+
+Run from the project root with:
+    python -m benchmarks.person_detector --input_dir images/downloaded
+"""
+
+import argparse
+import time
+
+from crop_photos import DEFAULT_INPUT_DIRECTORY, DEFAULT_MODEL, list_input_images
+from modules.tensor_flow.person_detector import ImageProcessor, PersonDetector
+
+BATCH_SIZES = [1, 4, 8, 16]
+
+
+def unbatched_throughput(detector, image_paths):
+    """One unresized image per call, decoded in the foreground"""
+    start = time.perf_counter()
+    for image_path in image_paths:
+        image_tensor, _ = ImageProcessor.load_image_into_tensor(image_path)
+        detector.object_detector.detect(image_tensor)
+    return len(image_paths) / (time.perf_counter() - start)
+
+
+def batched_throughput(detector, image_paths):
+    start = time.perf_counter()
+    for _ in detector.detect_images(image_paths):
+        pass
+    return len(image_paths) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the person detector")
+    parser.add_argument(
+        "--input_dir", default=DEFAULT_INPUT_DIRECTORY, dest="input_dir"
+    )
+    parser.add_argument("--model", default=DEFAULT_MODEL, dest="model")
+    parser.add_argument("--images", type=int, default=64, dest="images")
+    args = parser.parse_args()
+
+    image_paths = sorted(list_input_images(args.input_dir).values())[: args.images]
+    if not image_paths:
+        parser.error(f"No images found in {args.input_dir}")
+
+    detector = PersonDetector(args.model)
+
+    # Warm up the detector, so the first measurement doesn't include loading it
+    for _ in detector.detect_images(image_paths[: max(BATCH_SIZES)]):
+        pass
+
+    print(f"{len(image_paths)} images")
+    print(f"{'method':>12} {'images/sec':>10}")
+    print(f"{'unbatched':>12} {unbatched_throughput(detector, image_paths):>10.2f}")
+
+    for batch_size in BATCH_SIZES:
+        detector.batch_size = batch_size
+        throughput = batched_throughput(detector, image_paths)
+        print(f"{f'batch {batch_size}':>12} {throughput:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
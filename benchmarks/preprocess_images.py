@@ -0,0 +1,97 @@
+"""
+Compares the time and memory of ImageEvaluator's preprocessing against the previous
+img_to_array implementation, for typical batch sizes
+
+Run from the project root with:
+    python -m benchmarks.preprocess_images
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+from tensorflow.keras.preprocessing.image import img_to_array
+
+from modules.tensor_flow.image_evaluator import normalize, resize_into_batch
+
+TARGET_SIZE = (224, 224)
+# Face crops are saved at 250px and user crops at 400px
+SOURCE_SIZE = (400, 400)
+BATCH_SIZES = [1, 4, 16, 64]
+
+
+def legacy_preprocess(images, target_size):
+    """The previous implementation, one float32 copy per step"""
+    processed_images = []
+    for img in images:
+        if img.size != target_size:
+            img = img.resize(target_size)
+        img_array = img_to_array(img)
+        img_array /= 255.0
+        processed_images.append(img_array)
+
+    return np.array(processed_images)
+
+
+def buffer_preprocess(images, target_size, buffer):
+    """Resizes into a reused uint8 buffer, normalization happens in the model's graph"""
+    return resize_into_batch(images, target_size, buffer)
+
+
+def buffer_normalize_preprocess(images, target_size, buffer):
+    """Resizes into a reused uint8 buffer and normalizes it with one vectorized operation"""
+    return normalize(resize_into_batch(images, target_size, buffer))
+
+
+def measure(function, repeats):
+    """Returns the mean time in ms and the peak allocated memory in MB of function()"""
+    function()
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    elapsed = (time.perf_counter() - start) / repeats
+
+    return elapsed * 1000, peak / 1024**2
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks image preprocessing")
+    parser.add_argument("--repeats", type=int, default=20, dest="repeats")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    width, height = TARGET_SIZE
+
+    print(f"{'batch':>5} {'method':>18} {'ms':>8} {'peak MB':>8}")
+    for batch_size in BATCH_SIZES:
+        images = [
+            Image.fromarray(
+                rng.integers(0, 256, SOURCE_SIZE + (3,), dtype=np.uint8), "RGB"
+            )
+            for _ in range(batch_size)
+        ]
+        buffer = np.zeros((batch_size, height, width, 3), dtype=np.uint8)
+
+        methods = {
+            "legacy": lambda: legacy_preprocess(images, TARGET_SIZE),
+            "buffer": lambda: buffer_preprocess(images, TARGET_SIZE, buffer),
+            "buffer+normalize": lambda: buffer_normalize_preprocess(
+                images, TARGET_SIZE, buffer
+            ),
+        }
+
+        for name, function in methods.items():
+            milliseconds, peak = measure(function, args.repeats)
+            print(f"{batch_size:>5} {name:>18} {milliseconds:>8.2f} {peak:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
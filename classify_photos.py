@@ -1,7 +1,10 @@
 import os
-import shutil
 import argparse
 import sys
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from PyQt6.QtWidgets import (
     QApplication,
     QWidget,
@@ -10,52 +13,151 @@ from PyQt6.QtWidgets import (
     QMessageBox
 )
 from PyQt6.QtGui import QPixmap, QImage
-from PyQt6.QtCore import Qt
+from PyQt6.QtCore import Qt, QTimer
 
 from PIL import Image
 
+from modules.storage.image_store import ImageStore
+from modules.storage.label_journal import LABEL_JOURNAL, LabelJournal
+from modules.storage.phash_index import PHASH_DB, PHashIndex, image_phash
+
 DEFAULT_INPUT_DIRECTORY = "images/downloaded"
 DEFAULT_OUTPUT_DIRECTORY = "images/classified"
 
 POSITIVE = "positive"
 NEGATIVE = "negative"
-ORIGINAL = "original"
-FACES = "faces"
 USERS = "users"
 
+DISPLAY_SIZE = (800, 600)
+# How many of the next images are decoded ahead, and how many previous ones are kept for undo
+PREFETCH_AHEAD = 8
+KEEP_BEHIND = 4
+DECODE_WORKERS = 2
+# How often the window title is refreshed with the decode queue depth
+TITLE_REFRESH_MS = 250
+
+# Namespace of the labelled images in the perceptual hash index
+PHASH_SOURCE = "classify"
+
+
+def load_display_image(image_path, size=DISPLAY_SIZE):
+    """
+    Decodes an image scaled to fit in size, keeping its aspect ratio, as a QImage, and its
+    perceptual hash
+
+    QImages can be built outside the GUI thread, unlike QPixmaps
+    """
+    with Image.open(image_path) as image:
+        # Let JPEG decode at a reduced resolution when the file is much larger than the window
+        image.draft("RGB", size)
+        image = image.convert("RGB")
+
+    phash = image_phash(image)
+
+    scale = min(size[0] / image.width, size[1] / image.height)
+    image = image.resize(
+        (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    )
+
+    # Copy so the QImage owns its pixels after the bytes are freed
+    qim = QImage(
+        image.tobytes(),
+        image.width,
+        image.height,
+        image.width * 3,
+        QImage.Format.Format_RGB888,
+    ).copy()
+    return qim, phash
+
+
+class ImagePrefetcher:
+    """
+    Decodes images for display in background threads, keeping a bounded cache of the ones
+    around the current image
+
+    :param callable image_path: returns the path of an image name
+    :param int capacity: how many decoded or pending images to keep
+    """
+
+    def __init__(self, image_path, capacity=PREFETCH_AHEAD + KEEP_BEHIND + 1):
+        self.image_path = image_path
+        self.capacity = capacity
+        self._pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _decode(self, name):
+        try:
+            return load_display_image(self.image_path(name))
+        except (OSError, Image.DecompressionBombError):
+            # DecompressionBombError isn't an OSError, one oversized photo would stop the worker
+            return None, None
+
+    def prefetch(self, names):
+        """Starts decoding the names that aren't cached, in order, evicting the oldest entries"""
+        with self._lock:
+            for name in names:
+                if name in self._cache:
+                    self._cache.move_to_end(name)
+                else:
+                    self._cache[name] = self._pool.submit(self._decode, name)
+
+            while len(self._cache) > self.capacity:
+                _, future = self._cache.popitem(last=False)
+                future.cancel()
+
+    def get(self, name):
+        """
+        Returns the (QImage, perceptual hash) of name, waiting for it if it's still being
+        decoded, or (None, None) if it couldn't be opened
+        """
+        with self._lock:
+            future = self._cache.get(name)
+            if future is None or future.cancelled():
+                future = self._pool.submit(self._decode, name)
+                self._cache[name] = future
+        return future.result()
+
+    def queue_depth(self):
+        """How many images are waiting to be decoded"""
+        with self._lock:
+            return sum(not future.done() for future in self._cache.values())
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
 
 class ImageClassifierApp(QWidget):
     def __init__(self, source_folder, destination_folder):
         super().__init__()
         self.source_folder = source_folder
+        self.source_store = ImageStore(source_folder)
         self.destination_folder = destination_folder
         self.current_index = 0
         self.history = []
         self.image_files = []
+        self.current_phash = None
+        self.skipped_duplicates = 0
 
-        for folder in [ORIGINAL, FACES, USERS]:
-            os.makedirs(
-                os.path.join(self.destination_folder, folder, POSITIVE), exist_ok=True
-            )
-            os.makedirs(
-                os.path.join(self.destination_folder, folder, NEGATIVE), exist_ok=True
-            )
+        self.journal = LabelJournal(os.path.join(destination_folder, LABEL_JOURNAL))
+        # Labelled images, so near-duplicates of them aren't shown again
+        self.phash_index = PHashIndex(
+            os.path.join(source_folder, PHASH_DB), PHASH_SOURCE
+        )
 
-        self.already_classified_images = set(
-            [
-                f
-                for f in os.listdir(
-                    os.path.join(self.destination_folder, USERS, POSITIVE)
-                )
-                if f.endswith(".jpg")
-            ]
-            + [
-                f
-                for f in os.listdir(
-                    os.path.join(self.destination_folder, USERS, NEGATIVE)
+        # Images moved into the destination folder by older versions, and labelled ones
+        self.already_classified_images = {
+            f"{name}_user.jpg" for name in self.journal.labels()
+        }
+        for classification in [POSITIVE, NEGATIVE]:
+            folder = os.path.join(self.destination_folder, USERS, classification)
+            if os.path.isdir(folder):
+                self.already_classified_images.update(
+                    f for f in os.listdir(folder) if f.endswith(".jpg")
                 )
-                if f.endswith(".jpg")
-            ]
+
+        self.prefetcher = ImagePrefetcher(
+            lambda name: self.source_store.path(USERS, name)
         )
 
         self.init_ui()
@@ -73,13 +175,32 @@ class ImageClassifierApp(QWidget):
         self.setFixedSize(800, 600)
 
         self.setMouseTracking(True)
+
+        self.title_timer = QTimer(self)
+        self.title_timer.timeout.connect(self.update_title)
+        self.title_timer.start(TITLE_REFRESH_MS)
+
         self.show()
 
+    def closeEvent(self, event):
+        self.title_timer.stop()
+        self.prefetcher.close()
+        self.journal.close()
+        self.phash_index.close()
+        super().closeEvent(event)
+
+    def update_title(self):
+        if 0 <= self.current_index < len(self.image_files):
+            self.setWindowTitle(
+                f"Image Classifier ({self.current_index + 1}/{len(self.image_files)}) - {self.image_files[self.current_index]}"
+                f" [decoding {self.prefetcher.queue_depth()}, {self.skipped_duplicates} duplicates skipped]"
+            )
+
     def keyPressEvent(self, event):
         if event.key() == Qt.Key.Key_Right:
-            self.move_current_image(POSITIVE)
+            self.label_current_image(POSITIVE)
         elif event.key() == Qt.Key.Key_Left:
-            self.move_current_image(NEGATIVE)
+            self.label_current_image(NEGATIVE)
         elif (
             event.modifiers() & Qt.KeyboardModifier.ControlModifier
             and event.key() == Qt.Key.Key_Z
@@ -87,11 +208,7 @@ class ImageClassifierApp(QWidget):
             self.undo()
 
     def load_images(self):
-        source_images = [
-            f
-            for f in os.listdir(os.path.join(self.source_folder, USERS))
-            if f.endswith(".jpg")
-        ]
+        source_images = self.source_store.list(USERS)
 
         self.image_files = [
             image
@@ -100,22 +217,35 @@ class ImageClassifierApp(QWidget):
         ]
 
     def display_image(self):
-        if 0 <= self.current_index < len(self.image_files):
-            image_path = os.path.join(
-                self.source_folder, USERS, self.image_files[self.current_index]
-            )
-            image = Image.open(image_path)
-            image = image.convert("RGB")
-            qim = QImage(
-                image.tobytes(), image.width, image.height, QImage.Format.Format_RGB888
-            )
-            pix = QPixmap.fromImage(qim)
-            self.image_label.setPixmap(
-                pix.scaled(800, 600, Qt.AspectRatioMode.KeepAspectRatio)
-            )
-            self.setWindowTitle(
-                f"Image Classifier ({self.current_index + 1}/{len(self.image_files)}) - {self.image_files[self.current_index]}"
+        while 0 <= self.current_index < len(self.image_files):
+            image_file = self.image_files[self.current_index]
+
+            # Keep the previous images for undo, and start decoding the next ones
+            self.prefetcher.prefetch(
+                self.image_files[
+                    max(0, self.current_index - KEEP_BEHIND) : self.current_index
+                    + PREFETCH_AHEAD
+                    + 1
+                ]
             )
+
+            qim, self.current_phash = self.prefetcher.get(image_file)
+
+            # Near-duplicates of a labelled image would only be labelled the same way again
+            if self.current_phash is not None and self.phash_index.query(
+                self.current_phash
+            ):
+                self.skipped_duplicates += 1
+                self.current_index += 1
+                continue
+
+            if qim is None:
+                self.image_label.setText(f"Couldn't open {image_file}")
+            else:
+                # Already scaled to the window in the background
+                self.image_label.setPixmap(QPixmap.fromImage(qim))
+            self.update_title()
+            return
         else:
             QMessageBox.information(
                 self,
@@ -126,71 +256,27 @@ class ImageClassifierApp(QWidget):
             self.setWindowTitle("Image Classifier - Complete")
             self.close()
 
-    def move_current_image(self, classification):
+    def label_current_image(self, classification):
         if 0 <= self.current_index < len(self.image_files):
             image_file = self.image_files[self.current_index]
 
-            self.move_image(
-                image_file,
-                self.source_folder,
-                "",
-                self.destination_folder,
-                classification,
-            )
+            # The user, face and original images share the name, the files stay where they are
+            name = image_file.replace("_user.jpg", "")
+            seq = self.journal.label(name, classification)
+            if self.current_phash is not None:
+                self.phash_index.add(name, self.current_phash)
 
-            self.history.append((self.current_index, classification))
+            self.history.append((self.current_index, seq))
             self.current_index += 1
             self.display_image()
 
-    @staticmethod
-    def move_image(
-        image_file, source_folder, source_classification, dst_folder, dst_classification
-    ):
-        users_src_path = os.path.join(
-            source_folder, USERS, source_classification, image_file
-        )
-        users_dst_path = os.path.join(dst_folder, USERS, dst_classification, image_file)
-
-        shutil.move(users_src_path, users_dst_path)
-
-        stripped_filename = image_file.replace("_user.jpg", "")
-
-        faces_src_path = os.path.join(
-            source_folder, FACES, source_classification, f"{stripped_filename}_face.jpg"
-        )
-        faces_dst_path = os.path.join(
-            dst_folder,
-            FACES,
-            dst_classification,
-            f"{stripped_filename}_face.jpg",
-        )
-        shutil.move(faces_src_path, faces_dst_path)
-
-        original_src_path = os.path.join(
-            source_folder,
-            ORIGINAL,
-            source_classification,
-            f"{stripped_filename}_original.jpg",
-        )
-        original_dst_path = os.path.join(
-            dst_folder,
-            ORIGINAL,
-            dst_classification,
-            f"{stripped_filename}_original.jpg",
-        )
-        shutil.move(original_src_path, original_dst_path)
-
     def undo(self):
         if self.history:
-            last_index, last_classification = self.history.pop()
-            image_file = self.image_files[last_index]
-
-            self.move_image(
-                image_file,
-                self.destination_folder,
-                last_classification,
-                self.source_folder,
-                "",
+            last_index, seq = self.history.pop()
+
+            self.journal.revert(seq)
+            self.phash_index.remove(
+                self.image_files[last_index].replace("_user.jpg", "")
             )
 
             self.current_index = last_index
@@ -199,13 +285,13 @@ class ImageClassifierApp(QWidget):
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Moves and classifies images from input_dir to output_dir"
+        description="Classifies images from input_dir, recording the labels in output_dir"
     )
     parser.add_argument(
         "--output_dir",
         "-o",
         default=DEFAULT_OUTPUT_DIRECTORY,
-        help="Output directory to put images",
+        help="Output directory to record the labels in",
         dest="output_dir",
     )
     parser.add_argument(
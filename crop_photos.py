@@ -1,17 +1,255 @@
 import os
 import argparse
+import multiprocessing
 import shutil
 
+from concurrent.futures import ThreadPoolExecutor
+
 from tqdm import tqdm
 
-from modules.tensor_flow.person_detector import PersonDetector
+from modules.storage.crop_manifest import CropManifest
+from modules.storage.detection_store import DetectionStore
+from modules.storage.image_store import ImageStore
+from modules.storage.phash_index import PHASH_DB, PHashIndex, file_phash
+from modules.tensor_flow.person_detector import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_SCORE_THRESHOLD,
+    PERSON_CLASS_ID,
+    ImageProcessor,
+    PersonDetector,
+)
 
 DEFAULT_OUTPUT_DIRECTORY = "images/cropped"
 DEFAULT_INPUT_DIRECTORY = "images/downloaded"
 DEFAULT_MODEL = "https://tfhub.dev/tensorflow/efficientdet/lite2/detection/1"
 
+ORIGINAL = "original"
+CROP_MANIFEST = "crop_manifest.db"
+DETECTIONS_DIR = "detections"
+
+# Namespace of the cropped inputs in the perceptual hash index
+PHASH_SOURCE = "crop"
+
+# How many detector batches each worker process is sent at a time
+BATCHES_PER_CHUNK = 4
+
+# Detector and output directory of each worker process
+_worker = {}
+
+
+def list_input_images(input_dir):
+    """
+    Returns the paths of the images to crop, keyed by file name
+
+    If the input is the output of farm_photos.py, the original photos are read from its manifest
+    instead of listing the directory
+    """
+    store = ImageStore(input_dir)
+    if store.has_manifest:
+        return {name: store.path(ORIGINAL, name) for name in store.list(ORIGINAL)}
+
+    return {
+        f: os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith(".jpg")
+    }
+
+
+def skip_duplicates(pending, manifest, phash_index):
+    """
+    Records the pending {image path: (image name, content hash)} that are near-duplicates of an
+    input that was already cropped, or of an earlier pending one, and returns the others
+    """
+    image_paths = sorted(pending)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        phashes = list(pool.map(_safe_phash, image_paths))
+
+    unique = {}
+    for image_path, phash in zip(image_paths, phashes):
+        image_name, file_hash = pending[image_path]
+
+        # Unreadable files are reported by the detector
+        duplicate = None
+        if phash is not None:
+            duplicate = phash_index.add_if_new(image_name, phash)
+
+        if duplicate:
+            manifest.record_duplicate(file_hash, image_name, duplicate)
+        else:
+            unique[image_path] = pending[image_path]
+
+    return unique
+
+
+def _safe_phash(image_path):
+    try:
+        return file_phash(image_path)
+    except OSError:
+        return None
+
+
+def save_crops(image_path, image_name, person_images, output_dir):
+    """
+    Saves the crops of an image, named after the image and the index of the detection, or a
+    copy of the image if nobody was found. Returns the file names written
+    """
+    crops = []
+    if len(person_images) == 0:
+        crops.append(f"{image_name}_negative.jpg")
+        shutil.copyfile(image_path, os.path.join(output_dir, crops[-1]))
+
+    for idx, person_image in enumerate(person_images):
+        crops.append(f"{image_name}_{idx}.jpg")
+        person_image.save(os.path.join(output_dir, crops[-1]))
+
+    return crops
+
+
+def crop_images(detector, images, output_dir):
+    """
+    Detects the persons in the images and saves their crops. The crops only depend on each
+    image, so the output doesn't depend on how the images were split up
+
+    :param PersonDetector detector: detector to use
+    :param dict images: {image path: image name} of the images to crop
+    :param str output_dir: where to save the crops
+    :return: generator of (image path, crop file names, raw detections, error message)
+    """
+    for image_path, image, detections, error in detector.detect_images(images):
+        if error is not None:
+            yield image_path, [], None, f"Failed to read {image_path}: {error}"
+            continue
+
+        try:
+            crops = save_crops(
+                image_path,
+                images[image_path],
+                detector.person_images(image, detections),
+                output_dir,
+            )
+        except OSError as e:
+            yield image_path, [], None, f"Failed to save the crops of {image_path}: {e}"
+            continue
+
+        yield image_path, crops, detections, None
+
+
+def recrop_image(image_path, image_name, detections, output_dir, crop_options):
+    """
+    Crops an image again from its stored detections, returning the same tuple as crop_images
+    """
+    try:
+        image = ImageProcessor.load_image(image_path)
+        person_images = ImageProcessor.extract_objects(
+            image,
+            detections["detection_boxes"],
+            detections["detection_classes"],
+            detections["detection_scores"],
+            crop_options["class_id"],
+            crop_options["score_threshold"],
+            crop_options["padding"],
+        )
+        crops = save_crops(image_path, image_name, person_images, output_dir)
+    except (OSError, ValueError) as e:
+        return image_path, [], None, f"Failed to crop {image_path}: {e}"
+
+    return image_path, crops, None, None
+
+
+def recrop_images(images, detection_store, output_dir, crop_options):
+    """
+    Regenerates the crops of {image path: (image name, content hash)} from the stored
+    detections, without loading the detector
+    """
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        yield from pool.map(
+            lambda item: recrop_image(
+                item[0],
+                item[1][0],
+                detection_store.get(item[1][1]),
+                output_dir,
+                crop_options,
+            ),
+            images.items(),
+        )
+
+
+def init_worker(model, batch_size, output_dir, threads, crop_options):
+    """Loads the detector once per worker process"""
+    import tensorflow as tf
 
+    # Share the cores between the workers instead of each one using all of them
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
 
+    _worker["detector"] = PersonDetector(model, batch_size=batch_size, **crop_options)
+    _worker["output_dir"] = output_dir
+
+
+def crop_chunk_images(detector, images, output_dir):
+    """
+    Crops a chunk of {image path: image name} like crop_images
+
+    If the detector fails on a batch, the images it didn't get to are yielded with None
+    crops, as they aren't at fault and should be retried on the next run
+    """
+    done = set()
+    try:
+        for result in crop_images(detector, images, output_dir):
+            done.add(result[0])
+            yield result
+    except Exception as e:
+        # Don't lose the whole run if the detector fails on a batch
+        for image_path in images:
+            if image_path not in done:
+                yield (
+                    image_path,
+                    None,
+                    None,
+                    f"Failed to crop {image_path}, retrying on the next run: {e}",
+                )
+
+
+def chunk_images(images, chunk_size):
+    """Splits {image path: image name} into chunks of chunk_size images, in path order"""
+    image_paths = sorted(images)
+    return [
+        {image_path: images[image_path] for image_path in image_paths[i : i + chunk_size]}
+        for i in range(0, len(image_paths), chunk_size)
+    ]
+
+
+def crop_in_process(detector, images, output_dir):
+    """
+    Crops the images chunk by chunk in this process, so a detector failure only loses its
+    chunk like in crop_in_workers
+    """
+    for chunk in chunk_images(images, detector.batch_size * BATCHES_PER_CHUNK):
+        yield from crop_chunk_images(detector, chunk, output_dir)
+
+
+def crop_chunk(images):
+    """Crops a chunk of {image path: image name} in a worker process, see crop_chunk_images"""
+    return list(
+        crop_chunk_images(_worker["detector"], images, _worker["output_dir"])
+    )
+
+
+def crop_in_workers(images, model, batch_size, output_dir, workers, crop_options):
+    """
+    Shards the images between worker processes, yielding the crop_images results of each image
+    as the workers finish them, with None crops for the images to retry (see crop_chunk_images)
+    """
+    chunks = chunk_images(images, batch_size * BATCHES_PER_CHUNK)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    # TensorFlow isn't fork safe
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(
+        workers,
+        initializer=init_worker,
+        initargs=(model, batch_size, output_dir, threads, crop_options),
+    ) as pool:
+        for results in pool.imap_unordered(crop_chunk, chunks):
+            yield from results
 
 
 def main():
@@ -36,6 +274,53 @@ def main():
         help="tfhub URL with person detector model to load",
         dest="model",
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="How many images to run through the detector at once",
+        dest="batch_size",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="How many processes to split the images between, each with its own detector",
+        dest="workers",
+    )
+    parser.add_argument(
+        "--score_threshold",
+        type=float,
+        default=DEFAULT_SCORE_THRESHOLD,
+        help="Minimum detection score to crop",
+        dest="score_threshold",
+    )
+    parser.add_argument(
+        "--class_id",
+        type=int,
+        default=PERSON_CLASS_ID,
+        help="COCO class to crop, 1 is person",
+        dest="class_id",
+    )
+    parser.add_argument(
+        "--padding",
+        type=float,
+        default=0.0,
+        help="How much to grow each crop by on every side, as a fraction of its size",
+        dest="padding",
+    )
+    parser.add_argument(
+        "--recrop",
+        action="store_true",
+        help="Regenerate the crops of already cropped images from their stored detections, without running the detector",
+        dest="recrop",
+    )
+    parser.add_argument(
+        "--keep_duplicates",
+        action="store_true",
+        help="Crop images even if they are near-duplicates of already cropped images",
+        dest="keep_duplicates",
+    )
     args = parser.parse_args()
 
     input_dir = args.input_dir
@@ -44,29 +329,117 @@ def main():
 
     os.makedirs(output_dir, exist_ok=True)
 
-    # by using a set we significantly speed up the lookup times
-    existing_images = set(os.listdir(output_dir))
+    manifest = CropManifest(os.path.join(output_dir, CROP_MANIFEST))
+    image_files = list_input_images(input_dir)
+    hashes = manifest.hash_files(image_files.values())
 
-    detector = PersonDetector(model)
+    # Outputs from before the manifest existed
+    if len(manifest) == 0:
+        imported = manifest.import_outputs(
+            {
+                image.replace(".jpg", ""): hashes[image_path]
+                for image, image_path in image_files.items()
+            },
+            os.listdir(output_dir),
+        )
+        if imported:
+            print(f"Recorded {imported} previously cropped images in the manifest")
 
-    image_files = [f for f in os.listdir(input_dir) if f.endswith(".jpg")]
+    detection_store = DetectionStore(os.path.join(output_dir, DETECTIONS_DIR))
+    crop_options = {
+        "score_threshold": args.score_threshold,
+        "class_id": args.class_id,
+        "padding": args.padding,
+    }
 
-    for image in tqdm(image_files, desc="Cropping images"):
-        image_name = image.replace(".jpg", "")
+    if args.recrop:
+        # Every cropped input whose detections are stored
+        completed = manifest.completed()
+        pending = {
+            image_path: (completed[file_hash], file_hash)
+            for image_path, file_hash in hashes.items()
+            if file_hash in completed and file_hash in detection_store
+        }
+        missing = len(set(completed) & set(hashes.values())) - len(
+            {file_hash for _, file_hash in pending.values()}
+        )
+        if missing:
+            print(
+                f"{missing} cropped images have no stored detections, their crops are left as they are"
+            )
 
-        if any(image_name in existing_image for existing_image in existing_images):
-            continue
+        results = recrop_images(pending, detection_store, output_dir, crop_options)
+    else:
+        # Only new or changed inputs, and each content only once
+        processed = manifest.processed_hashes()
+        pending = {}
+        for image, image_path in image_files.items():
+            file_hash = hashes[image_path]
+            if file_hash not in processed:
+                processed.add(file_hash)
+                pending[image_path] = (image.replace(".jpg", ""), file_hash)
 
-        image_path = os.path.join(input_dir, image)
+        if not args.keep_duplicates:
+            with PHashIndex(os.path.join(input_dir, PHASH_DB), PHASH_SOURCE) as index:
+                unique = skip_duplicates(pending, manifest, index)
+            if len(unique) < len(pending):
+                print(f"Skipping {len(pending) - len(unique)} near-duplicate images")
+            pending = unique
 
-        person_images = detector.get_person_images(image_path)
-        if len(person_images) == 0:
-            shutil.copyfile(
-                image_path, os.path.join(output_dir, f"{image_name}_negative.jpg")
+        images = {
+            image_path: image_name for image_path, (image_name, _) in pending.items()
+        }
+        if args.workers > 1:
+            results = crop_in_workers(
+                images, model, args.batch_size, output_dir, args.workers, crop_options
             )
+        else:
+            detector = PersonDetector(model, batch_size=args.batch_size, **crop_options)
+            results = crop_in_process(detector, images, output_dir)
+
+    failed = 0
+    retried = 0
+    try:
+        for image_path, crops, detections, error in tqdm(
+            results,
+            total=len(pending),
+            desc="Recropping images" if args.recrop else "Cropping images",
+        ):
+            image_name, file_hash = pending[image_path]
+
+            if crops is None:
+                # Not recorded, so it's picked up again by the next run
+                retried += 1
+                tqdm.write(error)
+                continue
+
+            if error is not None:
+                failed += 1
+                tqdm.write(error)
+                # Keep the previous crops if they can't be regenerated
+                if not args.recrop:
+                    manifest.record(file_hash, image_name, [], error=error)
+                continue
+
+            if detections is not None:
+                detection_store.add(file_hash, detections)
+
+            # Remove the crops the input no longer produces, if it changed or was recropped
+            for stale_crop in manifest.record(file_hash, image_name, crops):
+                stale_path = os.path.join(output_dir, stale_crop)
+                if os.path.isfile(stale_path):
+                    os.remove(stale_path)
+    finally:
+        # Also write the buffered detections if the run is interrupted
+        detection_store.close()
+        manifest.close()
 
-        for idx, person_image in enumerate(person_images):
-            person_image.save(os.path.join(output_dir, f"{image_name}_{idx}.jpg"))
+    if failed and args.recrop:
+        print(f"{failed} images failed, their previous crops were kept")
+    elif failed:
+        print(f"{failed} images failed, they are retried when their file changes")
+    if retried:
+        print(f"{retried} images weren't cropped because of a detector error, run again to crop them")
 
 
 if __name__ == "__main__":
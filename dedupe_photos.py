@@ -0,0 +1,225 @@
+import argparse
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+from modules.storage.image_store import ImageStore
+from modules.storage.label_journal import read_labels
+from modules.storage.metadata_store import METADATA_DB, MetadataStore
+from modules.storage.phash_index import (
+    DEFAULT_RADIUS,
+    PHASH_DB,
+    PHashIndex,
+    file_phash,
+    hamming_distance,
+)
+
+DEFAULT_INPUT_DIRECTORY = "images/downloaded"
+DEFAULT_LABELS = "images/classified/labels.jsonl"
+DEFAULT_WORKERS = 8
+
+ORIGINAL = "original"
+FACES = "faces"
+USERS = "users"
+
+# The files farm_photos.py saves for every photo, by category
+SUFFIXES = {ORIGINAL: "_original.jpg", FACES: "_face.jpg", USERS: "_user.jpg"}
+
+FARM = "farm"
+CROP = "crop"
+CLASSIFY = "classify"
+SOURCES = [FARM, CROP, CLASSIFY]
+
+# How many of the largest clusters are listed in the report
+REPORT_CLUSTERS = 10
+
+
+def _safe_phash(path):
+    try:
+        return file_phash(path)
+    except OSError:
+        return None
+
+
+def index_farmed_photos(store, index, workers):
+    """
+    Hashes the farmed photos that aren't in the index yet, eg. the ones farmed before it
+    existed. farm_photos.py hashes the whole photo, so the photos saved without their original
+    are left out, the hash of a crop is never near the hash of the photo it was cropped from
+    """
+    suffix = SUFFIXES[ORIGINAL]
+    paths = {
+        image[: -len(suffix)]: store.path(ORIGINAL, image)
+        for image in store.list(ORIGINAL)
+        if image.endswith(suffix)
+    }
+
+    missing = sorted(name for name in paths if name not in index)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        phashes = pool.map(_safe_phash, [paths[name] for name in missing])
+        added = 0
+        for name, phash in tqdm(
+            zip(missing, phashes), total=len(missing), desc="Hashing photos"
+        ):
+            if phash is not None:
+                index.add(name, phash)
+                added += 1
+    return added
+
+
+def _farmed_image(name):
+    """(user id, position) of a farmed photo, from its {user id}_{name}_{position} name"""
+    user_id = name.split("_", 1)[0]
+    position = name.rsplit("_", 1)[1]
+    return user_id, int(position) if position.isdigit() else None
+
+
+def prune(clusters, store, index, labelled, radius, metadata, other_indexes):
+    """
+    Deletes every photo of the clusters that is within radius of a photo that's kept, keeping
+    a labelled photo if there is one, or else the first one farmed. Labelled photos are never
+    deleted.
+
+    Clusters link photos through chains of near-duplicates, so the photos of a cluster aren't
+    all within radius of each other. The photos too far from the kept one are pruned again
+    around a photo of their own.
+
+    Besides the files, the photos are removed from the index, from the metadata store and from
+    the hashes crop_photos.py and classify_photos.py recorded of them
+    """
+    removed = []
+    for cluster in clusters:
+        remaining = list(cluster)
+        while remaining:
+            keep = next((name for name in remaining if name in labelled), remaining[0])
+            kept_hash = index.get(keep)
+
+            far = []
+            for name in remaining:
+                if name == keep:
+                    continue
+                if hamming_distance(index.get(name), kept_hash) > radius:
+                    far.append(name)
+                elif name not in labelled:
+                    removed.append(name)
+            remaining = far
+
+    for name in removed:
+        for category, suffix in SUFFIXES.items():
+            image = f"{name}{suffix}"
+            path = store.path(category, image)
+            if os.path.isfile(path):
+                os.remove(path)
+                store.remove(category, image)
+
+        index.remove(name)
+        for other_index in other_indexes:
+            # crop_photos.py names its inputs after the files, classify_photos.py after the photo
+            other_index.remove(name)
+            for suffix in SUFFIXES.values():
+                other_index.remove(os.path.splitext(f"{name}{suffix}")[0])
+
+    metadata.remove_images(
+        [image for image in map(_farmed_image, removed) if image[1] is not None]
+    )
+    return len(removed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reports and prunes clusters of near-duplicate photos"
+    )
+    parser.add_argument(
+        "--input_dir",
+        "-i",
+        default=DEFAULT_INPUT_DIRECTORY,
+        help="Directory of the farmed photos and of the perceptual hash index",
+        dest="input_dir",
+    )
+    parser.add_argument(
+        "--source",
+        choices=SOURCES,
+        default=FARM,
+        help="Which tool's images to look at, farmed, cropped or labelled ones",
+        dest="source",
+    )
+    parser.add_argument(
+        "--radius",
+        type=int,
+        default=DEFAULT_RADIUS,
+        help="Maximum number of differing hash bits for two photos to be near-duplicates",
+        dest="radius",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="Hash the farmed photos that aren't in the index yet first, only the ones with an original",
+        dest="index",
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="Delete the farmed photos within radius of a photo that's kept, never deleting labelled photos",
+        dest="prune",
+    )
+    parser.add_argument(
+        "--labels",
+        default=DEFAULT_LABELS,
+        help="Label journal written by classify_photos.py, whose photos are kept when pruning",
+        dest="labels",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of threads hashing photos",
+        dest="workers",
+    )
+    args = parser.parse_args()
+
+    if (args.index or args.prune) and args.source != FARM:
+        parser.error("--index and --prune only apply to the farmed photos")
+
+    store = ImageStore(args.input_dir)
+
+    with PHashIndex(os.path.join(args.input_dir, PHASH_DB), args.source) as index:
+        if args.index:
+            print(f"Indexed {index_farmed_photos(store, index, args.workers)} photos")
+
+        clusters = index.clusters(args.radius)
+        duplicates = sum(len(cluster) - 1 for cluster in clusters)
+        print(
+            f"{len(index)} photos, {len(clusters)} clusters of near-duplicates, {duplicates} redundant photos"
+        )
+
+        for cluster in sorted(clusters, key=len, reverse=True)[:REPORT_CLUSTERS]:
+            print(f"  {len(cluster)}: {', '.join(cluster)}")
+
+        if args.prune:
+            labelled = set(read_labels(args.labels))
+
+            metadata = MetadataStore(os.path.join(args.input_dir, METADATA_DB))
+            other_indexes = [
+                PHashIndex(os.path.join(args.input_dir, PHASH_DB), source)
+                for source in [CROP, CLASSIFY]
+            ]
+            try:
+                removed = prune(
+                    clusters,
+                    store,
+                    index,
+                    labelled,
+                    args.radius,
+                    metadata,
+                    other_indexes,
+                )
+            finally:
+                metadata.close()
+                for other_index in other_indexes:
+                    other_index.close()
+            print(f"Deleted {removed} photos")
+
+
+if __name__ == "__main__":
+    main()
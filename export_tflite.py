@@ -0,0 +1,209 @@
+import argparse
+import os
+import random
+import time
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+from tqdm import tqdm
+
+from modules.storage.image_store import ImageStore
+from modules.storage.label_journal import LABEL_JOURNAL, read_labels
+from modules.tensor_flow.dataset import split_category_files
+from modules.tensor_flow.image_evaluator import (
+    ImageEvaluator,
+    KERAS,
+    TFLITE,
+    normalize,
+    resize_into_batch,
+)
+
+DEFAULT_MODEL_DIR = "model"
+DEFAULT_SOURCE_DIR = "images/classified"
+DEFAULT_IMAGES_DIR = "images/downloaded"
+CATEGORIES = ["users", "faces"]
+
+NONE = "none"
+DYNAMIC = "dynamic"
+INT8 = "int8"
+QUANTIZATIONS = [NONE, DYNAMIC, INT8]
+
+IMAGE_SIZE = 224
+DEFAULT_CALIBRATION_SAMPLES = 200
+EVALUATION_BATCH_SIZE = 32
+
+
+def load_image(path):
+    with Image.open(path) as image:
+        return image.convert("RGB")
+
+
+def representative_dataset(files, samples):
+    """Yields normalized training images to calibrate the int8 quantization ranges"""
+    files = list(files)
+    random.Random(0).shuffle(files)
+
+    def generator():
+        buffer = np.zeros((1, IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.uint8)
+        for path, _ in files[:samples]:
+            batch = resize_into_batch(
+                [load_image(path)], (IMAGE_SIZE, IMAGE_SIZE), buffer
+            )
+            yield [normalize(batch)]
+
+    return generator
+
+
+def convert(model_path, quantization, calibration_files, calibration_samples):
+    """Converts a Keras model to TFLite, returning the serialized model"""
+    model = tf.keras.models.load_model(model_path)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+
+    if quantization == DYNAMIC:
+        # Weights are stored as int8, activations stay float
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantization == INT8:
+        # Weights and activations are int8, the input and output stay float32 so the evaluator
+        # can feed the same normalized images to every backend
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset(
+            calibration_files, calibration_samples
+        )
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    return converter.convert()
+
+
+def evaluate(evaluator, files):
+    """Returns the scores of the files and the mean seconds per image"""
+    scores = []
+    elapsed = 0
+
+    for start in tqdm(
+        range(0, len(files), EVALUATION_BATCH_SIZE),
+        leave=False,
+        desc=f"Evaluating {evaluator.backend}",
+    ):
+        images = [
+            load_image(path) for path, _ in files[start : start + EVALUATION_BATCH_SIZE]
+        ]
+
+        batch_start = time.perf_counter()
+        scores.append(evaluator.evaluate_images(images))
+        elapsed += time.perf_counter() - batch_start
+
+    return np.concatenate(scores), elapsed / max(len(files), 1)
+
+
+def report(keras_path, tflite_path, validation_files):
+    """Prints the accuracy and speed of the TFLite model against the Keras model"""
+    labels = np.array([label for _, label in validation_files])
+
+    keras_evaluator = ImageEvaluator(
+        keras_path, target_size=(IMAGE_SIZE, IMAGE_SIZE), backend=KERAS
+    )
+    tflite_evaluator = ImageEvaluator(
+        tflite_path, target_size=(IMAGE_SIZE, IMAGE_SIZE), backend=TFLITE
+    )
+
+    keras_scores, keras_time = evaluate(keras_evaluator, validation_files)
+    tflite_scores, tflite_time = evaluate(tflite_evaluator, validation_files)
+
+    keras_accuracy = np.mean((keras_scores >= 0.5) == labels)
+    tflite_accuracy = np.mean((tflite_scores >= 0.5) == labels)
+
+    print(f"Validation images: {len(validation_files)}")
+    print(f"Keras accuracy:  {keras_accuracy:.4f}  ({keras_time * 1000:.1f}ms/image)")
+    print(f"TFLite accuracy: {tflite_accuracy:.4f}  ({tflite_time * 1000:.1f}ms/image)")
+    print(f"Accuracy delta:  {tflite_accuracy - keras_accuracy:+.4f}")
+    print(f"Mean score difference: {np.mean(np.abs(tflite_scores - keras_scores)):.4f}")
+    print(f"Speedup: {keras_time / tflite_time:.2f}x")
+    print(
+        f"Size: {os.path.getsize(keras_path) / 1024**2:.1f}MB -> {os.path.getsize(tflite_path) / 1024**2:.1f}MB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Converts the trained Keras models to quantized TFLite models"
+    )
+    parser.add_argument(
+        "--quantization",
+        "-q",
+        choices=QUANTIZATIONS,
+        default=INT8,
+        help="none keeps float32, dynamic stores int8 weights, int8 also quantizes activations",
+        dest="quantization",
+    )
+    parser.add_argument(
+        "--category",
+        choices=CATEGORIES,
+        action="append",
+        help="Which model to export, can be given several times. Defaults to all of them",
+        dest="categories",
+    )
+    parser.add_argument(
+        "--model_dir",
+        default=DEFAULT_MODEL_DIR,
+        help="Directory with the Keras models, the TFLite models are saved next to them",
+        dest="model_dir",
+    )
+    parser.add_argument(
+        "--source_dir",
+        default=DEFAULT_SOURCE_DIR,
+        help="Directory with the classified images used for calibration and validation",
+        dest="source_dir",
+    )
+    parser.add_argument(
+        "--labels",
+        help=f"Label journal written by classify_photos.py, defaults to {LABEL_JOURNAL} in source_dir",
+        dest="labels",
+    )
+    parser.add_argument(
+        "--images_dir",
+        default=DEFAULT_IMAGES_DIR,
+        help="Directory with the farmed images the label journal refers to",
+        dest="images_dir",
+    )
+    parser.add_argument(
+        "--calibration_samples",
+        type=int,
+        default=DEFAULT_CALIBRATION_SAMPLES,
+        help="How many training images to calibrate the int8 quantization with",
+        dest="calibration_samples",
+    )
+    parser.add_argument(
+        "--skip_report",
+        action="store_true",
+        help="Don't compare the exported model against the Keras model on the validation split",
+        dest="skip_report",
+    )
+    args = parser.parse_args()
+
+    labels = read_labels(args.labels or os.path.join(args.source_dir, LABEL_JOURNAL))
+
+    for category in args.categories or CATEGORIES:
+        keras_path = os.path.join(args.model_dir, f"{category}.keras")
+        tflite_path = os.path.join(
+            args.model_dir, f"{category}_{args.quantization}.tflite"
+        )
+
+        training_files, validation_files = split_category_files(
+            args.source_dir, category, labels, ImageStore(args.images_dir)
+        )
+
+        print(f"Converting {keras_path} ({args.quantization})...")
+        tflite_model = convert(
+            keras_path, args.quantization, training_files, args.calibration_samples
+        )
+        with open(tflite_path, "wb") as file:
+            file.write(tflite_model)
+        print(f"Saved {tflite_path}")
+
+        if not args.skip_report:
+            report(keras_path, tflite_path, validation_files)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,105 @@
 import argparse
 import os
-import requests
-import pickle
 
+from concurrent.futures import ThreadPoolExecutor, wait
 from tqdm import tqdm
-from time import sleep
 
 from dotenv import load_dotenv
-from random import random
 
+from modules.storage.image_store import ImageStore, FLAT, LAYOUTS
+from modules.storage.metadata_store import METADATA_DB, MetadataStore
+from modules.storage.phash_index import (
+    DEFAULT_RADIUS,
+    PHASH_DB,
+    PHashIndex,
+    image_phash,
+)
+from modules.storage.seen_filter import SEEN_DB, SeenFilter
 from modules.tinder.api import Api
+from modules.tinder.rate_limiter import RATE_LIMITS_DB, RECS, RateLimiter
+from modules.tinder.image_cache import ImageCache, DEFAULT_MAX_BYTES
+from modules.tinder.downloader import (
+    ImageDownloader,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_PER_HOST,
+)
 
 load_dotenv()
 
 DEFAULT_OUTPUT_DIRECTORY = "images/downloaded"
+DEFAULT_WORKERS = 4
 
 ORIGINAL = "original"
 FACES = "faces"
 USERS = "users"
+SUFFIXES = {ORIGINAL: "_original.jpg", FACES: "_face.jpg", USERS: "_user.jpg"}
 METADATA = "metadata"
 
+FACE_SIZE = 250
+USER_SIZE = 400
+
+# Namespace of the farmed photos in the perceptual hash index, and of the farmed users
+PHASH_SOURCE = "farm"
+SEEN_NAMESPACE = "farm"
+
+
+def save_image(image, data, image_filename, store, skip_original, phash_index=None):
+    """
+    Saves the downloaded bytes as the original, then decodes them and saves the face and user crops
+
+    If a phash index is given, photos that are near-duplicates of an already farmed photo aren't
+    saved, and the name of that photo is returned instead
+    """
+    # The original is saved untouched, so the crops can be decoded at reduced resolution
+    image.load_bytes(data, min_crop_size=max(FACE_SIZE, USER_SIZE))
+
+    phash = None
+    if phash_index is not None:
+        phash = image_phash(image.image)
+        phash_index.refresh()
+        matches = phash_index.query(phash, DEFAULT_RADIUS)
+        if matches:
+            return matches[0][0]
+
+    _save_files(image, data, image_filename, store, skip_original)
+
+    if phash_index is not None:
+        # Only indexed once saved, so the hash never stands for a photo that isn't there. A
+        # copy saved at the same time by another thread may have been indexed first
+        duplicate = phash_index.add_if_new(image_filename, phash, DEFAULT_RADIUS)
+        if duplicate:
+            _remove_files(image_filename, store)
+            return duplicate
+
+    return None
+
+
+def _save_files(image, data, image_filename, store, skip_original):
+    if not skip_original:
+        store.write(ORIGINAL, f"{image_filename}_original.jpg", data)
+
+    if image.face_box:
+        store.save(
+            FACES,
+            f"{image_filename}_face.jpg",
+            image.get_face().resize((FACE_SIZE, FACE_SIZE)),
+        )
+
+    if image.user_box:
+        store.save(
+            USERS,
+            f"{image_filename}_user.jpg",
+            image.get_user().resize((USER_SIZE, USER_SIZE)),
+        )
+
+
+def _remove_files(image_filename, store):
+    for category, suffix in SUFFIXES.items():
+        path = store.path(category, f"{image_filename}{suffix}")
+        if os.path.isfile(path):
+            os.remove(path)
+            store.remove(category, f"{image_filename}{suffix}")
+
 
 def main():
     auth_token = os.getenv("AUTH_TOKEN")
@@ -37,21 +117,114 @@ def main():
         help="Output directory to put images",
         dest="output_dir",
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Maximum number of photo downloads in flight",
+        dest="concurrency",
+    )
+    parser.add_argument(
+        "--per_host",
+        type=int,
+        default=DEFAULT_PER_HOST,
+        help="Maximum number of photo downloads in flight to a single host",
+        dest="per_host",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of workers decoding, cropping and saving photos",
+        dest="workers",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Directory to cache downloaded photos in, disabled if not given",
+        dest="cache_dir",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=DEFAULT_MAX_BYTES // 1024**2,
+        help="Maximum size of the photo cache in MB",
+        dest="cache_size",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=LAYOUTS,
+        default=FLAT,
+        help="How to lay out the images on disk, sharded spreads them over hashed subdirectories",
+        dest="layout",
+    )
+    parser.add_argument(
+        "--skip_originals",
+        action="store_true",
+        help="Don't save the original photos, only the face and user crops",
+        dest="skip_originals",
+    )
+    parser.add_argument(
+        "--keep_duplicates",
+        action="store_true",
+        help="Save photos even if they are near-duplicates of already farmed photos",
+        dest="keep_duplicates",
+    )
+    parser.add_argument(
+        "--rate_limits",
+        default=None,
+        help=f"Database of the API rate limits, pass the same one as tensor_flirt.py to share the limits of the account, defaults to {RATE_LIMITS_DB} in output_dir",
+        dest="rate_limits",
+    )
     args = parser.parse_args()
 
     output_dir = args.output_dir
-    original_dir = os.path.join(output_dir, ORIGINAL)
-    faces_dir = os.path.join(output_dir, FACES)
-    users_dir = os.path.join(output_dir, USERS)
     metadata_dir = os.path.join(output_dir, METADATA)
 
     os.makedirs(output_dir, exist_ok=True)
-    os.makedirs(original_dir, exist_ok=True)
-    os.makedirs(faces_dir, exist_ok=True)
-    os.makedirs(users_dir, exist_ok=True)
-    os.makedirs(metadata_dir, exist_ok=True)
 
-    api = Api(auth_token)
+    store = ImageStore(output_dir, layout=args.layout)
+    if not store.has_manifest:
+        for category in [ORIGINAL, FACES, USERS]:
+            store.index(category)
+    metadata = MetadataStore(os.path.join(output_dir, METADATA_DB))
+    phash_index = (
+        None
+        if args.keep_duplicates
+        else PHashIndex(os.path.join(output_dir, PHASH_DB), PHASH_SOURCE)
+    )
+
+    # Older versions saved one pickle per user, move them into the store once
+    if os.path.isdir(metadata_dir) and len(metadata) == 0:
+        imported = metadata.import_pickles(metadata_dir)
+        print(f"Imported {imported} users from {metadata_dir}")
+
+    # The farmed users are derived from the metadata store, which is written first. Users farmed
+    # before the filter existed, or whose batch was stored without being added, are added back
+    seen = SeenFilter(os.path.join(output_dir, SEEN_DB), SEEN_NAMESPACE)
+    if len(seen) != len(metadata):
+        seen.add(metadata.user_ids())
+
+    cache = (
+        ImageCache(args.cache_dir, max_bytes=args.cache_size * 1024**2)
+        if args.cache_dir
+        else None
+    )
+
+    # Shared with tensor_flirt.py, so both stay within the limits of the account together
+    api = Api(
+        auth_token,
+        rate_limiter=RateLimiter(
+            args.rate_limits or os.path.join(output_dir, RATE_LIMITS_DB)
+        ),
+    )
+    downloader = ImageDownloader(
+        api.session,
+        concurrency=args.concurrency,
+        per_host=args.per_host,
+        cache=cache,
+    )
+    savers = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="save")
 
     print("Farming photos, use 'ctrl + c' to stop")
 
@@ -60,46 +233,70 @@ def main():
     while True:
         nearby_users = api.get_nearby_users()
 
-        for user in tqdm(nearby_users, desc=f"Processing batch {batch_number + 1}"):
+        # Checked before anything is downloaded
+        new_users = seen.unseen(nearby_users)
+
+        image_filenames = {}
+        for user in new_users:
             user_prefix = f"{user.id}_{user.name}"
-            user_file = os.path.join(metadata_dir, f"{user_prefix}.pkl")
 
-            # User already farmed
-            if os.path.isfile(user_file):
-                continue
+            for i, image in enumerate(user.images):
+                image_filenames[id(image)] = f"{user_prefix}_{i}"
 
-            for i, image in enumerate(
-                tqdm(
-                    user.images, leave=False, desc=f"Downloading images for {user.name}"
-                )
-            ):
-                try:
-                    image.load()
+        images = [image for user in new_users for image in user.images]
+        saves = {}
 
-                    image_filename = f"{user_prefix}_{i}"
+        # Downloads run on their own pool, so the network stays busy while photos are encoded
+        for image, data, error in tqdm(
+            downloader.download(images),
+            total=len(images),
+            desc=f"Processing batch {batch_number + 1}",
+        ):
+            if error:
+                print(f"Failed to download {image.url}: {str(error)}")
+                continue
+
+            save = savers.submit(
+                save_image,
+                image,
+                data,
+                image_filenames[id(image)],
+                store,
+                args.skip_originals,
+                phash_index,
+            )
+            saves[save] = image
 
-                    image.get_original().save(
-                        os.path.join(original_dir, f"{image_filename}_original.jpg")
-                    )
+        wait(saves)
+        duplicates = 0
+        for save, image in saves.items():
+            if save.exception():
+                print(f"Failed to save {image.url}: {str(save.exception())}")
+            elif save.result():
+                duplicates += 1
 
-                    if image.face_box:
-                        image.get_face().resize((250, 250)).save(
-                            os.path.join(faces_dir, f"{image_filename}_face.jpg")
-                        )
+        if duplicates:
+            print(f"Skipped {duplicates} near-duplicates of already farmed photos")
 
-                    if image.user_box:
-                        image.get_user().resize((400, 400)).save(
-                            os.path.join(users_dir, f"{image_filename}_user.jpg")
-                        )
+        # Stored before they're marked as seen, so the filter can always be rebuilt from the store
+        metadata.add_users(new_users)
+        seen.add(user.id for user in new_users)
 
-                except requests.RequestException as e:
-                    print(f"Failed to download {image.url}: {str(e)}")
-                    continue
+        stats = seen.stats()
+        print(
+            f"Seen users: skipped {len(nearby_users) - len(new_users)}/{len(nearby_users)} in this batch, {stats['skipped']}/{stats['checked']} overall ({stats['skip_rate']:.0%})"
+        )
 
-            with open(user_file, "wb") as file:
-                pickle.dump(user, file)
+        if cache:
+            stats = cache.stats()
+            print(
+                f"Photo cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%})"
+            )
 
-            sleep(random() * 2)
+        recs = api.rate_limiter.stats()[RECS]
+        print(
+            f"Recs rate: {recs['rate']:.2f}/s, {recs['throttled']} throttled, {recs['errors']} errors"
+        )
 
         batch_number += 1
 
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+DONE = "done"
+FAILED = "failed"
+DUPLICATE = "duplicate"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS inputs (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS jobs (
+    hash TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    crops TEXT NOT NULL,
+    error TEXT,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS jobs_name ON jobs (name);
+"""
+
+
+def content_hash(path):
+    """Hashes the content of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CropManifest:
+    """
+    Persistent record of which input images crop_photos.py has processed, keyed by the hash of
+    their content, and the crops each one produced
+
+    Each image is recorded as soon as its crops are written, so an interrupted run resumes at
+    the first unrecorded image. The hashes of the inputs are cached by path, size and
+    modification time, so unchanged files aren't read again on every run.
+
+    :param str path: path of the database file
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def hash_files(self, paths):
+        """
+        Returns {path: content hash} of the given files, only hashing the files that are new
+        or whose size or modification time changed since they were last hashed
+        """
+        cached = {
+            path: (size, mtime_ns, file_hash)
+            for path, size, mtime_ns, file_hash in self._connection.execute(
+                "SELECT path, size, mtime_ns, hash FROM inputs"
+            )
+        }
+
+        hashes = {}
+        updated = []
+        for path in paths:
+            stat = os.stat(path)
+            entry = cached.get(path)
+
+            if entry and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                hashes[path] = entry[2]
+            else:
+                hashes[path] = content_hash(path)
+                updated.append((path, stat.st_size, stat.st_mtime_ns, hashes[path]))
+
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO inputs VALUES (?, ?, ?, ?)", updated
+            )
+        return hashes
+
+    def processed_hashes(self):
+        """Returns the hashes of every input that has been processed, successfully or not"""
+        return {row[0] for row in self._connection.execute("SELECT hash FROM jobs")}
+
+    def completed(self):
+        """Returns {content hash: name} of the inputs that were cropped successfully"""
+        return dict(
+            self._connection.execute("SELECT hash, name FROM jobs WHERE status = ?", (DONE,))
+        )
+
+    def crops(self, file_hash):
+        """Returns the crops produced from the input with the given hash"""
+        row = self._connection.execute(
+            "SELECT crops FROM jobs WHERE hash = ?", (file_hash,)
+        ).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def record(self, file_hash, name, crops, error=None):
+        """
+        Records that an input was processed
+
+        Replaces any earlier record of the input, or of an input with the same name but
+        different content, and returns the crops they produced that weren't produced again so
+        the caller can delete them.
+
+        :param str file_hash: content hash of the input
+        :param str name: name of the input, without extension
+        :param list crops: file names of the crops written
+        :param str error: why the input couldn't be processed, if it failed
+        """
+        with self._connection:
+            stale = set()
+            for (old_crops,) in self._connection.execute(
+                "SELECT crops FROM jobs WHERE name = ? OR hash = ?", (name, file_hash)
+            ):
+                stale.update(crop for crop in json.loads(old_crops) if crop not in crops)
+
+            self._connection.execute(
+                "DELETE FROM jobs WHERE name = ? AND hash != ?", (name, file_hash)
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    file_hash,
+                    name,
+                    FAILED if error else DONE,
+                    json.dumps(crops),
+                    error,
+                    time.time(),
+                ),
+            )
+        return sorted(stale)
+
+    def record_duplicate(self, file_hash, name, duplicate_of):
+        """Records that an input wasn't cropped because it's a near-duplicate of another one"""
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    file_hash,
+                    name,
+                    DUPLICATE,
+                    json.dumps([]),
+                    f"Duplicate of {duplicate_of}",
+                    time.time(),
+                ),
+            )
+
+    def import_outputs(self, names_to_hashes, output_files):
+        """
+        Records the inputs cropped by versions of crop_photos.py without a manifest, whose crops
+        are named <name>_<index>.jpg or <name>_negative.jpg
+
+        :param dict names_to_hashes: {input name: content hash} of the current inputs
+        :param iterable output_files: file names in the output directory
+        """
+        crops = {}
+        for output_file in output_files:
+            name, _, suffix = output_file.rpartition("_")
+            if name and suffix.endswith(".jpg"):
+                crops.setdefault(name, []).append(output_file)
+
+        rows = [
+            (file_hash, name, DONE, json.dumps(sorted(crops[name])), None, time.time())
+            for name, file_hash in names_to_hashes.items()
+            if name in crops
+        ]
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+        return len(rows)
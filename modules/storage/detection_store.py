@@ -0,0 +1,126 @@
+import os
+import tempfile
+
+import numpy as np
+
+# How many images are written per shard
+SHARD_SIZE = 1000
+SHARD_PREFIX = "shard-"
+
+
+class DetectionStore:
+    """
+    Raw detector output of every cropped image, keyed by the hash of the image's content, so
+    crops can be regenerated with different settings without running the detector again
+
+    Detections are buffered and written in columnar .npz shards of SHARD_SIZE images: the boxes,
+    scores and classes of all the images of a shard are concatenated, with offsets to find the
+    detections of each image. Shards are only ever added, a later shard overrides the
+    detections of an image in an earlier one.
+
+    :param str directory: where to store the shards
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self._buffer = []
+        self._shards = {}
+        self._index = {}
+
+        for shard in sorted(os.listdir(directory)):
+            if shard.startswith(SHARD_PREFIX) and shard.endswith(".npz"):
+                with np.load(os.path.join(directory, shard)) as data:
+                    for row, file_hash in enumerate(data["hashes"]):
+                        self._index[str(file_hash)] = (shard, row)
+
+        self._next_shard = len(
+            [shard for shard in os.listdir(directory) if shard.startswith(SHARD_PREFIX)]
+        )
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._index) + len(self._buffer)
+
+    def __contains__(self, file_hash):
+        return file_hash in self._index or any(
+            buffered_hash == file_hash for buffered_hash, _ in self._buffer
+        )
+
+    def add(self, file_hash, detections):
+        """
+        Stores the detections of an image, writing a shard when SHARD_SIZE images are buffered
+
+        :param str file_hash: content hash of the image
+        :param dict detections: detection_boxes, detection_scores and detection_classes of the
+            image, as returned by PersonDetector.detect_images
+        """
+        self._buffer.append((file_hash, detections))
+        if len(self._buffer) >= SHARD_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered detections to a new shard"""
+        if not self._buffer:
+            return
+
+        hashes = [file_hash for file_hash, _ in self._buffer]
+        counts = [len(detections["detection_scores"]) for _, detections in self._buffer]
+
+        def column(key, dtype, shape):
+            arrays = [
+                np.asarray(detections[key], dtype=dtype).reshape(shape)
+                for _, detections in self._buffer
+            ]
+            return np.concatenate(arrays) if arrays else np.zeros(shape, dtype)
+
+        shard = f"{SHARD_PREFIX}{self._next_shard:05d}.npz"
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            np.savez(
+                file,
+                hashes=np.array(hashes),
+                offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                boxes=column("detection_boxes", np.float32, (-1, 4)),
+                scores=column("detection_scores", np.float32, (-1,)),
+                classes=column("detection_classes", np.int16, (-1,)),
+            )
+        os.replace(temp_path, os.path.join(self.directory, shard))
+
+        for row, file_hash in enumerate(hashes):
+            self._index[file_hash] = (shard, row)
+        self._next_shard += 1
+        self._buffer = []
+
+    def _load_shard(self, shard):
+        if shard not in self._shards:
+            with np.load(os.path.join(self.directory, shard)) as data:
+                self._shards[shard] = {key: data[key] for key in data.files}
+        return self._shards[shard]
+
+    def get(self, file_hash):
+        """Returns the detections of an image in the same format as add, or None"""
+        for buffered_hash, detections in reversed(self._buffer):
+            if buffered_hash == file_hash:
+                return detections
+
+        if file_hash not in self._index:
+            return None
+
+        shard, row = self._index[file_hash]
+        data = self._load_shard(shard)
+        start, end = data["offsets"][row], data["offsets"][row + 1]
+        return {
+            "detection_boxes": data["boxes"][start:end],
+            "detection_scores": data["scores"][start:end],
+            "detection_classes": data["classes"][start:end].astype(int),
+        }
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from io import BytesIO
+
+FLAT = "flat"
+SHARDED = "sharded"
+LAYOUTS = [FLAT, SHARDED]
+
+MANIFEST = "manifest.jsonl"
+
+
+class ImageStore:
+    """
+    Stores farmed images under a root directory, one subdirectory per category (eg. faces)
+
+    Every image written is recorded in an append-only manifest, so downstream tools can find
+    the images without listing huge directories. Directories written before the manifest
+    existed are listed from disk instead.
+
+    :param str root: root directory of the store
+    :param str layout: FLAT puts every image of a category in the same directory, SHARDED spreads
+        them over 256 subdirectories by the hash of their name
+    """
+
+    def __init__(self, root, layout=FLAT):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown layout {layout}, expected one of {LAYOUTS}")
+
+        self.root = root
+        self.layout = layout
+        self._manifest_path = os.path.join(root, MANIFEST)
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _relative_path(self, category, name):
+        if self.layout == SHARDED:
+            shard = hashlib.md5(name.encode()).hexdigest()[:2]
+            return os.path.join(category, shard, name)
+        return os.path.join(category, name)
+
+    def _load_manifest(self):
+        """Reads the manifest into {category: {name: relative path}}"""
+        entries = {}
+        if os.path.isfile(self._manifest_path):
+            with open(self._manifest_path, "r") as file:
+                for line in file:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    category = entries.setdefault(entry["category"], {})
+                    if entry.get("removed"):
+                        category.pop(entry["name"], None)
+                    else:
+                        category[entry["name"]] = entry["path"]
+        return entries
+
+    def _manifest(self):
+        if self._entries is None:
+            self._entries = self._load_manifest()
+        return self._entries
+
+    def _append(self, entry):
+        """Appends an entry to the manifest, must be called holding the lock"""
+        with open(self._manifest_path, "a") as file:
+            file.write(json.dumps(entry) + "\n")
+
+        category = self._manifest().setdefault(entry["category"], {})
+        if entry.get("removed"):
+            category.pop(entry["name"], None)
+        else:
+            category[entry["name"]] = entry["path"]
+
+    @property
+    def has_manifest(self):
+        return os.path.isfile(self._manifest_path)
+
+    def write(self, category, name, data):
+        """
+        Writes the raw bytes of an image atomically and records it in the manifest
+
+        :param str category: eg. original, faces or users
+        :param str name: file name of the image
+        :param bytes data: the encoded image
+        """
+        relative_path = self._relative_path(category, name)
+        path = os.path.join(self.root, relative_path)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            self._append(
+                {
+                    "category": category,
+                    "name": name,
+                    "path": relative_path,
+                    "size": len(data),
+                }
+            )
+
+    def save(self, category, name, image, format="JPEG"):
+        """Encodes a PIL image and writes it to the store"""
+        data = BytesIO()
+        image.save(data, format=format)
+        self.write(category, name, data.getvalue())
+
+    def index(self, category):
+        """Adds the images of a category that are on disk but missing from the manifest, eg. written by older versions"""
+        directory = os.path.join(self.root, category)
+        if not os.path.isdir(directory):
+            return 0
+
+        with self._lock:
+            known = self._manifest().get(category, {})
+            added = 0
+            for root, _, files in os.walk(directory):
+                for name in files:
+                    if name in known or name.endswith(".tmp"):
+                        continue
+                    relative_path = os.path.relpath(os.path.join(root, name), self.root)
+                    self._append(
+                        {"category": category, "name": name, "path": relative_path}
+                    )
+                    added += 1
+        return added
+
+    def add(self, category, name, path=None):
+        """
+        Records an image that was put in the store by some other means, eg. moved back into it
+
+        :param str path: where the image is, defaults to where the store would have written it
+        """
+        relative_path = (
+            os.path.relpath(path, self.root)
+            if path
+            else self._relative_path(category, name)
+        )
+        with self._lock:
+            self._append({"category": category, "name": name, "path": relative_path})
+
+    def remove(self, category, name):
+        """Records that an image has been moved out of the store"""
+        with self._lock:
+            self._append({"category": category, "name": name, "removed": True})
+
+    def list(self, category, extension=".jpg"):
+        """Returns the names of the images in a category"""
+        if self.has_manifest:
+            with self._lock:
+                names = list(self._manifest().get(category, {}))
+            return [name for name in names if name.endswith(extension)]
+
+        directory = os.path.join(self.root, category)
+        if not os.path.isdir(directory):
+            return []
+        return [f for f in os.listdir(directory) if f.endswith(extension)]
+
+    def path(self, category, name):
+        """Returns the path of an image in the store"""
+        with self._lock:
+            relative_path = self._manifest().get(category, {}).get(name)
+        return os.path.join(
+            self.root, relative_path or self._relative_path(category, name)
+        )
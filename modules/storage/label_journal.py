@@ -0,0 +1,156 @@
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where only one session should label at a time
+    fcntl = None
+
+LABEL_JOURNAL = "labels.jsonl"
+
+
+def _apply(active, record):
+    """Applies a journal record to {seq: (name, label)}"""
+    if "revert" in record:
+        active.pop(record["revert"], None)
+    else:
+        active[record["seq"]] = (record["name"], record["label"])
+
+
+def _parse(data):
+    """Parses the records of a chunk of journal lines"""
+    records = []
+    for line in data.splitlines():
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            # A line cut short by a crash while it was being written
+            continue
+    return records
+
+
+def _latest(active):
+    return {name: label for _, (name, label) in sorted(active.items())}
+
+
+def read_labels(path):
+    """
+    Reads the labels of a journal without opening it for writing, eg. to train on them
+
+    :param str path: path of the journal file
+    :return: {name: label} like LabelJournal.labels, empty if there is no journal
+    """
+    active = {}
+    if os.path.isfile(path):
+        with open(path, "rb") as file:
+            for record in _parse(file.read()):
+                _apply(active, record)
+    return _latest(active)
+
+
+class LabelJournal:
+    """
+    Append-only journal of the labels given in classify_photos.py
+
+    Every label is a line that is fsynced before returning, so a crash never loses or half
+    applies a swipe, and undoing a label appends a revert record instead of rewriting
+    anything. Labelling never touches the image files.
+
+    Appends hold an exclusive lock on the file and first read the records other sessions
+    appended since, so sessions labelling at the same time never reuse a sequence number.
+
+    :param str path: path of the journal file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._active = {}
+        self._seq = 0
+        # How far the journal has been read, in bytes
+        self._offset = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a")
+        self._catch_up()
+
+    def _catch_up(self):
+        """
+        Applies the records appended since the journal was last read, by any session
+
+        :return: whether the journal ends with a torn line, left by a crash or still being
+            written, which is only read once it's complete
+        """
+        with open(self.path, "rb") as file:
+            file.seek(self._offset)
+            data = file.read()
+        complete = data[: data.rfind(b"\n") + 1]
+        self._offset += len(complete)
+
+        for record in _parse(complete):
+            self._apply(record)
+        return len(complete) < len(data)
+
+    def _apply(self, record):
+        self._seq = max(self._seq, record["seq"])
+        _apply(self._active, record)
+
+    def _append(self, record):
+        with self._lock:
+            if fcntl:
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                # Nobody else is appending, so a torn line was cut short by a crash. The record
+                # starts on a line of its own, or it would be merged into the torn one and lost
+                torn = self._catch_up()
+
+                self._seq += 1
+                record = {"seq": self._seq, **record, "time": time.time()}
+
+                self._file.write(("\n" if torn else "") + json.dumps(record) + "\n")
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+                # Reads back the record, so the offset stays past it
+                self._catch_up()
+                return record["seq"]
+            finally:
+                if fcntl:
+                    fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.labels())
+
+    def __contains__(self, name):
+        return name in self.labels()
+
+    def label(self, name, label):
+        """
+        Records the label of an image
+
+        :param str name: name of the image, shared by its user, face and original files
+        :param str label: positive or negative
+        :return: sequence number of the record, to revert it
+        """
+        return self._append({"name": name, "label": label})
+
+    def revert(self, seq):
+        """Undoes the label recorded with the given sequence number"""
+        return self._append({"revert": seq})
+
+    def labels(self):
+        """Returns {name: label} with the latest label of each image that isn't reverted"""
+        with self._lock:
+            return _latest(self._active)
@@ -0,0 +1,245 @@
+import json
+import os
+import pickle
+import sqlite3
+import time
+
+from datetime import datetime
+
+from modules.tinder.image import Image
+from modules.tinder.user import Job, User
+
+METADATA_DB = "metadata.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    bio TEXT,
+    distance REAL,
+    birth_date TEXT,
+    gender TEXT,
+    jobs TEXT,
+    schools TEXT,
+    looking_for TEXT,
+    farmed_at REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS users_farmed_at ON users (farmed_at);
+
+CREATE TABLE IF NOT EXISTS images (
+    user_id TEXT NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    face_width REAL,
+    face_x_offset REAL,
+    face_height REAL,
+    face_y_offset REAL,
+    user_width REAL,
+    user_x_offset REAL,
+    user_height REAL,
+    user_y_offset REAL,
+    PRIMARY KEY (user_id, position)
+) WITHOUT ROWID;
+"""
+
+# SQLite limits the number of parameters in a single query
+MAX_QUERY_PARAMETERS = 900
+
+
+def _box_columns(box):
+    if not box:
+        return (None, None, None, None)
+    return (
+        box.width_percent,
+        box.x_offset_percent,
+        box.height_percent,
+        box.y_offset_percent,
+    )
+
+
+def _box_from_columns(width, x_offset, height, y_offset):
+    if width is None:
+        return None
+    return Image.BoundingBox(
+        width_percent=width,
+        x_offset_percent=x_offset,
+        height_percent=height,
+        y_offset_percent=y_offset,
+    )
+
+
+class MetadataStore:
+    """
+    Indexed SQLite store of the farmed users, their images and bounding boxes
+
+    Uses WAL journaling so farming can keep writing while other tools read the store
+
+    :param str path: path of the database file
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA foreign_keys=ON")
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def __contains__(self, user_id):
+        return self.has_user(user_id)
+
+    def has_user(self, user_id):
+        """Whether the user with the given id has already been farmed"""
+        row = self._connection.execute(
+            "SELECT 1 FROM users WHERE id = ?", (user_id,)
+        ).fetchone()
+        return row is not None
+
+    def seen_user_ids(self, user_ids):
+        """Returns which of the given user ids have already been farmed"""
+        user_ids = list(user_ids)
+        seen = set()
+        for start in range(0, len(user_ids), MAX_QUERY_PARAMETERS):
+            chunk = user_ids[start : start + MAX_QUERY_PARAMETERS]
+            rows = self._connection.execute(
+                f"SELECT id FROM users WHERE id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            seen.update(row[0] for row in rows)
+        return seen
+
+    def user_ids(self):
+        """Returns the ids of every farmed user, in the order they were farmed"""
+        return [
+            row[0]
+            for row in self._connection.execute("SELECT id FROM users ORDER BY farmed_at")
+        ]
+
+    def add_users(self, users, farmed_at=None):
+        """
+        Stores a batch of users and their images in a single transaction
+
+        :param list users: User objects to store, users already stored are replaced
+        :param float farmed_at: unix timestamp of when they were farmed, defaults to now
+        """
+        farmed_at = farmed_at or time.time()
+        self._insert([(user, farmed_at) for user in users])
+
+    def _insert(self, entries):
+        """Inserts (user, farmed_at) pairs in a single transaction"""
+        user_rows = [
+            (
+                user.id,
+                user.name,
+                user.bio,
+                user.distance,
+                user.birth_date.isoformat() if user.birth_date else None,
+                user.gender,
+                json.dumps([[job.title, job.company] for job in user.jobs]),
+                json.dumps(user.schools),
+                user.looking_for,
+                farmed_at,
+            )
+            for user, farmed_at in entries
+        ]
+        image_rows = [
+            (user.id, position, image.url)
+            + _box_columns(image.face_box)
+            + _box_columns(image.user_box)
+            for user, _ in entries
+            for position, image in enumerate(user.images)
+        ]
+
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                user_rows,
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                image_rows,
+            )
+
+    def remove_images(self, images):
+        """
+        Deletes images of farmed users, eg. pruned near-duplicates, the other images of the
+        users keep their position
+
+        :param list images: (user id, position) of the images
+        """
+        with self._connection:
+            self._connection.executemany(
+                "DELETE FROM images WHERE user_id = ? AND position = ?", images
+            )
+
+    def load_users(self, since=None):
+        """
+        Rebuilds the stored users with their images, in the order they were farmed
+
+        :param float since: only load users farmed after this unix timestamp
+        """
+        since = since or 0
+
+        images = {}
+        for row in self._connection.execute(
+            """
+            SELECT images.* FROM images JOIN users ON users.id = images.user_id
+            WHERE users.farmed_at >= ? ORDER BY images.user_id, images.position
+            """,
+            (since,),
+        ):
+            images.setdefault(row[0], []).append(
+                Image(
+                    url=row[2],
+                    face_box=_box_from_columns(*row[3:7]),
+                    user_box=_box_from_columns(*row[7:11]),
+                    image=None,
+                )
+            )
+
+        users = []
+        for row in self._connection.execute(
+            "SELECT * FROM users WHERE farmed_at >= ? ORDER BY farmed_at", (since,)
+        ):
+            users.append(
+                User(
+                    id=row[0],
+                    name=row[1],
+                    bio=row[2],
+                    distance=row[3],
+                    birth_date=datetime.fromisoformat(row[4]) if row[4] else None,
+                    gender=row[5],
+                    images=images.get(row[0], []),
+                    jobs=[Job(title, company) for title, company in json.loads(row[6])],
+                    schools=json.loads(row[7]),
+                    looking_for=row[8],
+                )
+            )
+        return users
+
+    def import_pickles(self, metadata_dir):
+        """Imports the per-user pickles written by older versions of farm_photos.py"""
+        entries = []
+        for file in os.listdir(metadata_dir):
+            if not file.endswith(".pkl"):
+                continue
+
+            path = os.path.join(metadata_dir, file)
+            with open(path, "rb") as f:
+                entries.append((pickle.load(f), os.path.getmtime(path)))
+
+        self._insert(entries)
+        return len(entries)
@@ -0,0 +1,278 @@
+import os
+import sqlite3
+import threading
+import time
+
+from itertools import combinations
+
+import numpy as np
+from PIL import Image
+
+PHASH_DB = "phash.db"
+
+HASH_BITS = 64
+# The hash is split into this many chunks, each indexed on its own
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# Hashes at most this many bits apart are considered the same photo
+DEFAULT_RADIUS = 6
+
+# The hash is taken from the lowest DCT frequencies of a downscaled grayscale image
+DCT_SIZE = 32
+LOW_FREQUENCIES = 8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    key TEXT NOT NULL,
+    hash INTEGER NOT NULL,
+    added_at REAL NOT NULL,
+    UNIQUE (source, key)
+);
+"""
+
+
+def _dct_matrix(size):
+    """Orthonormal DCT-II matrix, so the 2D DCT of x is M @ x @ M.T"""
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT = _dct_matrix(DCT_SIZE)
+
+
+def image_phash(image):
+    """
+    Perceptual hash of a PIL image, as a 64 bit integer
+
+    Resizing, recompressing and small colour changes only flip a few bits, so near-identical
+    photos have hashes a small Hamming distance apart.
+    """
+    pixels = np.asarray(
+        image.convert("L").resize((DCT_SIZE, DCT_SIZE), Image.Resampling.LANCZOS),
+        dtype=np.float64,
+    )
+    low = (_DCT @ pixels @ _DCT.T)[:LOW_FREQUENCIES, :LOW_FREQUENCIES].flatten()
+
+    # The first coefficient is the average brightness, which says nothing about the content
+    bits = low > np.median(low[1:])
+
+    phash = 0
+    for bit in bits:
+        phash = (phash << 1) | int(bit)
+    return phash
+
+
+def file_phash(path):
+    """Perceptual hash of an image file"""
+    with Image.open(path) as image:
+        # The hash only looks at a 32x32 version, decode JPEGs at a reduced resolution
+        image.draft("L", (DCT_SIZE * 4, DCT_SIZE * 4))
+        return image_phash(image)
+
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+def _to_signed(phash):
+    """SQLite integers are signed 64 bit"""
+    return phash - (1 << HASH_BITS) if phash >= 1 << (HASH_BITS - 1) else phash
+
+
+def _to_unsigned(value):
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+
+def _chunks(phash):
+    return [(phash >> (i * CHUNK_BITS)) & CHUNK_MASK for i in range(CHUNKS)]
+
+
+def _neighbours(chunk, distance):
+    """Every chunk value at most distance bits away from chunk"""
+    yield chunk
+    for flips in range(1, distance + 1):
+        for bits in combinations(range(CHUNK_BITS), flips):
+            flipped = chunk
+            for bit in bits:
+                flipped ^= 1 << bit
+            yield flipped
+
+
+class PHashIndex:
+    """
+    Persistent near-duplicate index of image perceptual hashes, using multi-index hashing
+
+    The 64 bit hashes are split into CHUNKS chunks with a table each. Two hashes within radius
+    bits of each other have at least one chunk within radius // CHUNKS bits, so a lookup only
+    compares the hashes that share a nearby chunk instead of every hash, which keeps lookups
+    well under a millisecond at hundreds of thousands of images for the usual radii.
+
+    Hashes are stored in SQLite, several tools (and processes) share one database file with a
+    source each. Rows added by other processes are picked up by refresh.
+
+    :param str path: path of the database file
+    :param str source: namespace of the hashes, eg. farm or classify
+    """
+
+    def __init__(self, path, source):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.source = source
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        self._lock = threading.RLock()
+
+        self._hashes = {}
+        self._tables = [{} for _ in range(CHUNKS)]
+        self._last_id = 0
+        self.refresh()
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, key):
+        return key in self._hashes
+
+    def get(self, key):
+        """Returns the stored hash of an image, or None"""
+        with self._lock:
+            return self._hashes.get(key)
+
+    def _index(self, key, phash):
+        previous = self._hashes.get(key)
+        if previous is not None:
+            self._unindex(key, previous)
+
+        self._hashes[key] = phash
+        for table, chunk in zip(self._tables, _chunks(phash)):
+            table.setdefault(chunk, set()).add(key)
+
+    def _unindex(self, key, phash):
+        for table, chunk in zip(self._tables, _chunks(phash)):
+            keys = table.get(chunk)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del table[chunk]
+
+    def refresh(self):
+        """Loads the hashes added since the last refresh, including by other processes"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, key, hash FROM hashes WHERE source = ? AND id > ? ORDER BY id",
+                (self.source, self._last_id),
+            ).fetchall()
+            for row_id, key, value in rows:
+                self._index(key, _to_unsigned(value))
+                self._last_id = row_id
+
+    def query(self, phash, radius=DEFAULT_RADIUS):
+        """Returns the (key, distance) of the stored hashes within radius bits, closest first"""
+        chunk_radius = radius // CHUNKS
+        candidates = set()
+
+        with self._lock:
+            for table, chunk in zip(self._tables, _chunks(phash)):
+                for neighbour in _neighbours(chunk, chunk_radius):
+                    candidates.update(table.get(neighbour, ()))
+
+            matches = []
+            for key in candidates:
+                distance = hamming_distance(phash, self._hashes[key])
+                if distance <= radius:
+                    matches.append((key, distance))
+
+        return sorted(matches, key=lambda match: (match[1], match[0]))
+
+    def add(self, key, phash):
+        """Stores the hash of an image, replacing any previous hash of the same key"""
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO hashes (source, key, hash, added_at) VALUES (?, ?, ?, ?)",
+                    (self.source, key, _to_signed(phash), time.time()),
+                )
+            # The row is read again by the next refresh, that's harmless and doesn't skip the
+            # rows other processes added in the meantime
+            self._index(key, phash)
+
+    def add_if_new(self, key, phash, radius=DEFAULT_RADIUS):
+        """
+        Stores the hash of an image unless a near-duplicate of it is already stored, atomically
+        so two copies of the same photo can't both be added
+
+        :return: the key of the closest duplicate, or None if the image was added
+        """
+        with self._lock:
+            self.refresh()
+            matches = [match for match in self.query(phash, radius) if match[0] != key]
+            if matches:
+                return matches[0][0]
+
+            self.add(key, phash)
+            return None
+
+    def remove(self, key):
+        with self._lock:
+            phash = self._hashes.pop(key, None)
+            if phash is None:
+                return
+
+            self._unindex(key, phash)
+            with self._connection:
+                self._connection.execute(
+                    "DELETE FROM hashes WHERE source = ? AND key = ?", (self.source, key)
+                )
+
+    def order(self):
+        """Returns the keys in the order they were added"""
+        with self._lock:
+            return [
+                key
+                for (key,) in self._connection.execute(
+                    "SELECT key FROM hashes WHERE source = ? ORDER BY id", (self.source,)
+                )
+                if key in self._hashes
+            ]
+
+    def clusters(self, radius=DEFAULT_RADIUS):
+        """
+        Groups the stored images into clusters of near-duplicates, linking any two images
+        within radius bits. Returns the clusters with more than one image, each in the order
+        the images were added
+        """
+        keys = self.order()
+        parents = {key: key for key in keys}
+
+        def find(key):
+            while parents[key] != key:
+                parents[key] = parents[parents[key]]
+                key = parents[key]
+            return key
+
+        for key in keys:
+            for match, _ in self.query(self._hashes[key], radius):
+                parents[find(match)] = find(key)
+
+        clusters = {}
+        for key in keys:
+            clusters.setdefault(find(key), []).append(key)
+
+        return [cluster for cluster in clusters.values() if len(cluster) > 1]
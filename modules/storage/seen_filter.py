@@ -0,0 +1,180 @@
+import hashlib
+import math
+import os
+import sqlite3
+import time
+
+SEEN_DB = "seen.db"
+
+# Users a fresh filter is sized for, it's rebuilt twice as large whenever it fills up
+DEFAULT_CAPACITY = 100_000
+FALSE_POSITIVE_RATE = 0.01
+
+# SQLite limits the number of parameters in a single query
+MAX_QUERY_PARAMETERS = 900
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen (
+    id INTEGER PRIMARY KEY,
+    namespace TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    seen_at REAL NOT NULL,
+    UNIQUE (namespace, user_id)
+);
+"""
+
+
+class BloomFilter:
+    """
+    Bit array membership filter, never has false negatives and has false positives at about
+    false_positive_rate once capacity items are added
+
+    :param int capacity: number of items the filter is sized for
+    :param float false_positive_rate: false positive rate at capacity
+    """
+
+    def __init__(self, capacity, false_positive_rate=FALSE_POSITIVE_RATE):
+        self.capacity = capacity
+        self.size = math.ceil(
+            -capacity * math.log(false_positive_rate) / math.log(2) ** 2
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Two independent hashes combined give all k positions (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class SeenFilter:
+    """
+    Persistent set of the user ids a tool has already seen, eg. farmed or swiped
+
+    The ids are stored in SQLite, with an in-memory Bloom filter in front so the ids that were
+    never seen, which is most of them, are answered without touching the database. Ids the
+    filter matches are confirmed against the database, so there are no false positives.
+
+    Several processes can share the database, the ids they add are picked up incrementally
+    on every check.
+
+    :param str path: path of the database file
+    :param str namespace: what seen means, eg. farm or swipe
+    """
+
+    def __init__(self, path, namespace, capacity=DEFAULT_CAPACITY):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.namespace = namespace
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+
+        self._bloom = BloomFilter(capacity)
+        self._last_id = 0
+
+        self.checked = 0
+        self.skipped = 0
+        self.false_positives = 0
+        self.refresh()
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM seen WHERE namespace = ?", (self.namespace,)
+        ).fetchone()[0]
+
+    def refresh(self):
+        """Adds the ids stored since the last refresh, including by other processes, to the filter"""
+        rows = self._connection.execute(
+            "SELECT id, user_id FROM seen WHERE namespace = ? AND id > ? ORDER BY id",
+            (self.namespace, self._last_id),
+        ).fetchall()
+
+        if self._bloom.count + len(rows) > self._bloom.capacity:
+            self._rebuild(max(self._bloom.capacity, self._bloom.count + len(rows)) * 2)
+            return
+
+        for row_id, user_id in rows:
+            self._bloom.add(user_id)
+            self._last_id = row_id
+
+    def _rebuild(self, capacity):
+        self._bloom = BloomFilter(capacity)
+        self._last_id = 0
+        for row_id, user_id in self._connection.execute(
+            "SELECT id, user_id FROM seen WHERE namespace = ? ORDER BY id",
+            (self.namespace,),
+        ):
+            self._bloom.add(user_id)
+            self._last_id = row_id
+
+    def seen_user_ids(self, user_ids):
+        """Returns which of the given user ids have already been seen"""
+        self.refresh()
+
+        user_ids = list(user_ids)
+        candidates = [user_id for user_id in user_ids if user_id in self._bloom]
+
+        seen = set()
+        for start in range(0, len(candidates), MAX_QUERY_PARAMETERS):
+            chunk = candidates[start : start + MAX_QUERY_PARAMETERS]
+            rows = self._connection.execute(
+                f"SELECT user_id FROM seen WHERE namespace = ? AND user_id IN ({','.join('?' * len(chunk))})",
+                [self.namespace, *chunk],
+            )
+            seen.update(row[0] for row in rows)
+
+        self.checked += len(user_ids)
+        self.skipped += sum(user_id in seen for user_id in user_ids)
+        self.false_positives += len(set(candidates) - seen)
+        return seen
+
+    def unseen(self, users):
+        """Returns the users whose id hasn't been seen, in the same order"""
+        users = list(users)
+        seen = self.seen_user_ids(user.id for user in users)
+        return [user for user in users if user.id not in seen]
+
+    def add(self, user_ids):
+        """Records that the given user ids have been seen"""
+        now = time.time()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO seen (namespace, user_id, seen_at) VALUES (?, ?, ?)",
+                [(self.namespace, user_id, now) for user_id in user_ids],
+            )
+
+    def skip_rate(self):
+        """Fraction of the checked ids that had already been seen"""
+        return self.skipped / self.checked if self.checked else 0.0
+
+    def stats(self):
+        return {
+            "checked": self.checked,
+            "skipped": self.skipped,
+            "skip_rate": self.skip_rate(),
+            "false_positives": self.false_positives,
+        }
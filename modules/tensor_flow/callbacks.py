@@ -0,0 +1,137 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# How many times the reference step is timed at the end of every epoch, the median is used
+REFERENCE_STEPS = 5
+
+
+class InputStallMonitor(tf.keras.callbacks.Callback):
+    """
+    Estimates how long each training epoch spent waiting on the input pipeline
+
+    Only the callbacks are timed, so the pipeline itself isn't touched. A training step is
+    fetching the next batch from the dataset iterator plus running the model on it. The model
+    part is timed on its own at the end of every epoch: a forward and backward pass on a batch
+    kept in memory, which never waits for data. The time any step took beyond that is counted
+    as waiting for data, so a steadily input-bound pipeline shows up as a stall on every step.
+
+    The reference step doesn't apply the gradients, so the optimizer update, a small part of
+    the step, is counted as stall.
+
+    :param tf.data.Dataset dataset: the training dataset, one batch of it is kept in memory
+    """
+
+    def __init__(self, dataset):
+        super().__init__()
+        self.dataset = dataset
+        self._batch = None
+        self._reference_step = None
+        self._step_start = None
+        self._epoch_start = None
+        self._step_seconds = []
+        self.stall_seconds = 0.0
+
+    def on_train_begin(self, logs=None):
+        images, labels = next(iter(self.dataset.take(1)))[:2]
+        self._batch = (images, labels)
+
+        @tf.function
+        def reference_step(images, labels):
+            with tf.GradientTape() as tape:
+                predictions = self.model(images, training=True)
+                loss = self.model.compute_loss(x=images, y=labels, y_pred=predictions)
+            return tape.gradient(loss, self.model.trainable_variables)
+
+        self._reference_step = reference_step
+
+    def _model_step_seconds(self):
+        """Median time of a step on the batch in memory"""
+        # Traced and warmed up first
+        tf.nest.map_structure(lambda x: x.numpy(), self._reference_step(*self._batch))
+
+        seconds = []
+        for _ in range(REFERENCE_STEPS):
+            start = time.perf_counter()
+            # Reading the gradients back waits for the step to finish running
+            tf.nest.map_structure(
+                lambda x: x.numpy(), self._reference_step(*self._batch)
+            )
+            seconds.append(time.perf_counter() - start)
+        return float(np.median(seconds))
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._step_seconds = []
+        self._epoch_start = time.perf_counter()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._step_seconds.append(time.perf_counter() - self._step_start)
+
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = time.perf_counter() - self._epoch_start
+        model_step = self._model_step_seconds()
+
+        # The first step of the epoch includes tracing, and isn't representative
+        steps = self._step_seconds[1:] or self._step_seconds
+        self.stall_seconds = float(sum(max(0.0, step - model_step) for step in steps))
+
+        print(
+            f"Epoch {epoch + 1}: waited about {self.stall_seconds:.1f}s for input out of {elapsed:.1f}s "
+            f"({self.stall_seconds / elapsed:.0%}), {model_step * 1000:.0f}ms per step when not waiting"
+        )
+        if logs is not None:
+            logs["input_stall_seconds"] = self.stall_seconds
+
+
+class ThroughputMonitor(tf.keras.callbacks.Callback):
+    """
+    Reports the training throughput of each epoch in images per second, leaving out
+    validation, and the best epoch when training ends
+
+    :param int images_per_epoch: how many training images one epoch goes through
+    :param str label: describes the training setup in the report
+    """
+
+    def __init__(self, images_per_epoch, label):
+        super().__init__()
+        self.images_per_epoch = images_per_epoch
+        self.label = label
+        self.throughputs = []
+        self._train_start = None
+        self._train_seconds = 0.0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._train_seconds = 0.0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self._train_start is None:
+            self._train_start = time.perf_counter()
+
+    def on_test_begin(self, logs=None):
+        self._stop_clock()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self._stop_clock()
+        throughput = self.images_per_epoch / max(self._train_seconds, 1e-9)
+        self.throughputs.append(throughput)
+        print(f"Epoch {epoch + 1}: {throughput:.1f} images/sec ({self.label})")
+
+    def on_train_end(self, logs=None):
+        if not self.throughputs:
+            return
+
+        # The first epoch includes tracing and compilation
+        steady = self.throughputs[1:] or self.throughputs
+        print(
+            f"{self.label}: {max(steady):.1f} images/sec best, "
+            f"{sum(steady) / len(steady):.1f} images/sec mean after the first epoch"
+        )
+
+    def _stop_clock(self):
+        if self._train_start is not None:
+            self._train_seconds += time.perf_counter() - self._train_start
+            self._train_start = None
@@ -0,0 +1,252 @@
+import os
+import random
+
+import numpy as np
+import tensorflow as tf
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+POSITIVE = "positive"
+NEGATIVE = "negative"
+# Classes in the order Keras assigns them their labels (alphabetical)
+CLASSES = [NEGATIVE, POSITIVE]
+
+# Suffix of the file of each category, after the image name, written by farm_photos.py
+CATEGORY_SUFFIXES = {"users": "_user.jpg", "faces": "_face.jpg"}
+
+
+def list_class_files(directory):
+    """
+    Lists the images of a class directory in the same order as Keras' flow_from_directory
+    """
+    files = []
+    for root, _, filenames in sorted(os.walk(directory), key=lambda walk: walk[0]):
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                files.append(os.path.join(root, filename))
+    return files
+
+
+def split_class_files(class_files, validation_split=0.2):
+    """
+    Splits {label: paths} into training and validation the same way as
+    ImageDataGenerator(validation_split=...), ie. the first validation_split of each class' files
+    are used for validation
+
+    Returns:
+    tuple: (training, validation) lists of (path, label) pairs.
+    """
+    training = []
+    validation = []
+
+    for label, files in sorted(class_files.items()):
+        split = int(validation_split * len(files))
+
+        validation += [(path, label) for path in files[:split]]
+        training += [(path, label) for path in files[split:]]
+
+    return training, validation
+
+
+def split_category_files(
+    classified_directory, category, labels, store, validation_split=0.2
+):
+    """
+    Lists the labelled images of a category, both the ones moved into classified_directory by
+    older versions of classify_photos.py and the ones labelled in the label journal, and splits
+    them like split_class_files
+
+    :param str classified_directory: directory with a category/positive|negative tree
+    :param str category: users or faces
+    :param dict labels: {image name: positive or negative}, from read_labels
+    :param ImageStore store: store the labelled images are in
+    :return: (training, validation) lists of (path, label) pairs, where label is 1 for positive images
+    """
+    class_files = {
+        label: list_class_files(
+            os.path.join(classified_directory, category, class_name)
+        )
+        for label, class_name in enumerate(CLASSES)
+    }
+
+    suffix = CATEGORY_SUFFIXES[category]
+    for name, class_name in labels.items():
+        path = store.path(category, f"{name}{suffix}")
+        # Not every photo has a face
+        if os.path.isfile(path):
+            class_files[CLASSES.index(class_name)].append(path)
+
+    # Ordered by image name rather than path, so the validation split draws from the legacy
+    # and the journal labelled images alike instead of mostly from whichever directory sorts first
+    return split_class_files(
+        {
+            label: sorted(files, key=lambda path: (os.path.basename(path), path))
+            for label, files in class_files.items()
+        },
+        validation_split,
+    )
+
+
+def load_image(path, image_size):
+    """Reads, decodes and resizes an image file into a square uint8 tensor"""
+    image = tf.io.decode_image(
+        tf.io.read_file(path), channels=3, expand_animations=False
+    )
+    image = tf.image.resize(image, (image_size, image_size), antialias=True)
+    return tf.saturate_cast(tf.round(image), tf.uint8)
+
+
+def _matrices(*entries):
+    """Stacks 9 per-image entries, in row-major order, into a batch of 3x3 matrices"""
+    batch_size = tf.shape(entries[0])[0]
+    entries = [
+        tf.broadcast_to(tf.cast(entry, tf.float32), [batch_size]) for entry in entries
+    ]
+    return tf.reshape(tf.stack(entries, axis=1), [-1, 3, 3])
+
+
+def augment_batch(
+    images,
+    rotation_range=0,
+    width_shift_range=0.0,
+    height_shift_range=0.0,
+    shear_range=0.0,
+    zoom_range=0.0,
+    horizontal_flip=False,
+    fill_mode="nearest",
+    seed=None,
+):
+    """
+    Randomly rotates, shifts, shears, zooms and flips a batch of images in a single affine
+    transform per image, on the graph
+
+    The parameters mean the same as in ImageDataGenerator: rotation_range and shear_range are
+    in degrees, the shifts are fractions of the image size and zoom_range is the range around
+    1 that each axis is scaled by.
+
+    :param tf.Tensor images: float32 batch of shape (batch, height, width, 3)
+    :param seed: optional seed of shape (2,) to make the augmentation reproducible
+    """
+    shape = tf.shape(images)
+    batch_size = shape[0]
+    height = tf.cast(shape[1], tf.float32)
+    width = tf.cast(shape[2], tf.float32)
+
+    seeds = (
+        [None] * 7
+        if seed is None
+        else tf.unstack(tf.random.experimental.stateless_split(seed, 7))
+    )
+
+    def uniform(index, minval, maxval):
+        if seed is None:
+            return tf.random.uniform([batch_size], minval, maxval)
+        return tf.random.stateless_uniform([batch_size], seeds[index], minval, maxval)
+
+    degrees = np.pi / 180
+    theta = uniform(0, -rotation_range, rotation_range) * degrees
+    tx = uniform(1, -width_shift_range, width_shift_range) * width
+    ty = uniform(2, -height_shift_range, height_shift_range) * height
+    shear = uniform(3, -shear_range, shear_range) * degrees
+    zx = uniform(4, 1 - zoom_range, 1 + zoom_range)
+    zy = uniform(5, 1 - zoom_range, 1 + zoom_range)
+    flip = (
+        tf.where(uniform(6, 0, 1) < 0.5, -1.0, 1.0)
+        if horizontal_flip
+        else tf.ones([batch_size])
+    )
+
+    zeros = tf.zeros([batch_size])
+    ones = tf.ones([batch_size])
+    cx = (width - 1) / 2
+    cy = (height - 1) / 2
+
+    # Same composition as ImageDataGenerator, mapping output pixels to input pixels around
+    # the centre of the image
+    transform = tf.linalg.matmul(
+        _matrices(ones, zeros, cx, zeros, ones, cy, zeros, zeros, ones),
+        _matrices(
+            tf.cos(theta), -tf.sin(theta), zeros,
+            tf.sin(theta), tf.cos(theta), zeros,
+            zeros, zeros, ones,
+        ),
+    )
+    for matrix in [
+        _matrices(ones, zeros, tx, zeros, ones, ty, zeros, zeros, ones),
+        _matrices(
+            ones, -tf.sin(shear), zeros,
+            zeros, tf.cos(shear), zeros,
+            zeros, zeros, ones,
+        ),
+        _matrices(zx * flip, zeros, zeros, zeros, zy, zeros, zeros, zeros, ones),
+        _matrices(ones, zeros, -cx, zeros, ones, -cy, zeros, zeros, ones),
+    ]:
+        transform = tf.linalg.matmul(transform, matrix)
+
+    return tf.raw_ops.ImageProjectiveTransformV3(
+        images=images,
+        transforms=tf.reshape(transform, [-1, 9])[:, :8],
+        output_shape=shape[1:3],
+        fill_value=0.0,
+        interpolation="BILINEAR",
+        fill_mode=fill_mode.upper(),
+    )
+
+
+def build_dataset(
+    files,
+    image_size,
+    batch_size,
+    augmentation=None,
+    shuffle_buffer=None,
+    cache_file="",
+):
+    """
+    Builds a tf.data pipeline of normalized image batches and labels
+
+    Images are decoded in parallel and cached as uint8 after the first epoch, in memory or in
+    cache_file. Augmentation runs on whole batches after the cache, so every epoch sees new
+    augmentations.
+
+    :param list files: (path, label) pairs, as returned by split_category_files
+    :param dict augmentation: augment_batch parameters, no augmentation if not given
+    :param int shuffle_buffer: shuffle the images with a buffer of this size, if given
+    :param str cache_file: where to cache the decoded images, in memory if empty
+    """
+    files = list(files)
+    if shuffle_buffer:
+        # The files are grouped by class, mix them up so the bounded buffer sees both
+        random.Random(0).shuffle(files)
+
+    dataset = tf.data.Dataset.from_tensor_slices(
+        (
+            [path for path, _ in files],
+            np.array([label for _, label in files], dtype=np.float32),
+        )
+    )
+    dataset = dataset.map(
+        lambda path, label: (load_image(path, image_size), label),
+        num_parallel_calls=tf.data.AUTOTUNE,
+    )
+    dataset = dataset.cache(cache_file)
+
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+
+    def prepare(images, labels):
+        images = tf.cast(images, tf.float32)
+        if augmentation:
+            images = augment_batch(images, **augmentation)
+        return images / 255.0, labels
+
+    dataset = dataset.batch(batch_size).map(
+        prepare, num_parallel_calls=tf.data.AUTOTUNE
+    )
+
+    # The images come from a list of files rather than file shards, so split the batches
+    # between workers when training with a multi-worker strategy
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = (
+        tf.data.experimental.AutoShardPolicy.DATA
+    )
+    return dataset.with_options(options).prefetch(tf.data.AUTOTUNE)
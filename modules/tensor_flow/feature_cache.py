@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+FEATURES = "features.bin"
+INDEX = "index.jsonl"
+META = "meta.json"
+
+
+def file_hash(path):
+    """Hashes the content of a file, so renamed or moved images keep their cached features"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """
+    Append-only on-disk cache of backbone features, memory-mapped for reading
+
+    Features are stored per (file hash, variant), where variant 0 is the unaugmented image and
+    the other variants are fixed augmentations of it. Rows are only ever appended, so new
+    images can be added to an existing cache without recomputing the old ones.
+
+    Augmented rows are stored with the augmentation they were made with, and rows of any other
+    augmentation are ignored, so changing it computes the variants again.
+
+    :param str directory: where to store the cache
+    :param tuple feature_shape: shape of the features of one image
+    :param dtype: dtype the features are stored as
+    :param str augmentation: identifies the augmentation of the variants, eg. a version and its parameters
+    """
+
+    def __init__(self, directory, feature_shape, dtype=np.float16, augmentation=None):
+        self.directory = directory
+        self.feature_shape = tuple(feature_shape)
+        self.dtype = np.dtype(dtype)
+        self.augmentation = augmentation
+
+        os.makedirs(directory, exist_ok=True)
+        self._features_path = os.path.join(directory, FEATURES)
+        self._index_path = os.path.join(directory, INDEX)
+        self._check_meta()
+
+        self._rows = {}
+        if os.path.isfile(self._index_path):
+            with open(self._index_path, "r") as file:
+                for line in file:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    # Made by another augmentation, rows written before it was recorded included
+                    if entry["variant"] and entry.get("augmentation") != augmentation:
+                        continue
+                    self._rows[(entry["hash"], entry["variant"])] = entry["row"]
+
+        # Ignore index entries whose features didn't make it to disk, eg. after a crash
+        stored_rows = self._stored_rows()
+        self._rows = {key: row for key, row in self._rows.items() if row < stored_rows}
+        self._count = stored_rows
+        self._features = None
+
+    def _check_meta(self):
+        meta = {"feature_shape": list(self.feature_shape), "dtype": self.dtype.name}
+        meta_path = os.path.join(self.directory, META)
+
+        if os.path.isfile(meta_path):
+            with open(meta_path, "r") as file:
+                if json.load(file) != meta:
+                    raise ValueError(
+                        f"Feature cache in {self.directory} was built for a different backbone"
+                    )
+        else:
+            with open(meta_path, "w") as file:
+                json.dump(meta, file)
+
+    @property
+    def _row_bytes(self):
+        return int(np.prod(self.feature_shape)) * self.dtype.itemsize
+
+    def _stored_rows(self):
+        if not os.path.isfile(self._features_path):
+            return 0
+        return os.path.getsize(self._features_path) // self._row_bytes
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, keys, features):
+        """
+        Appends the features of a batch
+
+        :param list keys: (file hash, variant) of each row
+        :param numpy.ndarray features: features of shape (len(keys), *feature_shape)
+        """
+        features = np.ascontiguousarray(features, dtype=self.dtype)
+
+        # Features first, so the index never points past the end of the features file
+        with open(self._features_path, "ab") as file:
+            file.truncate(self._count * self._row_bytes)
+            file.write(features.tobytes())
+
+        with open(self._index_path, "a") as file:
+            for i, (content_hash, variant) in enumerate(keys):
+                row = self._count + i
+                self._rows[(content_hash, variant)] = row
+
+                entry = {"hash": content_hash, "variant": variant, "row": row}
+                if variant:
+                    entry["augmentation"] = self.augmentation
+                file.write(json.dumps(entry) + "\n")
+
+        self._count += len(keys)
+        self._features = None
+
+    def rows(self, keys):
+        """Returns the rows of the given (file hash, variant) keys"""
+        return np.array([self._rows[key] for key in keys], dtype=np.int64)
+
+    @property
+    def features(self):
+        """Read-only memory map of all the stored features"""
+        if self._features is None:
+            self._features = np.memmap(
+                self._features_path,
+                dtype=self.dtype,
+                mode="r",
+                shape=(self._count,) + self.feature_shape,
+            )
+        return self._features
@@ -1,19 +1,101 @@
+import os
+import threading
+import time
+
+from collections import deque
+
 import numpy as np
+import tensorflow as tf
 from tensorflow.keras.models import load_model
-from tensorflow.keras.preprocessing.image import img_to_array
+
+# Larger inputs are run in chunks of this many images, through one reused input buffer
+MAX_BATCH_SIZE = 64
+
+# How many images the warmup checks the compiled function against model.predict with, and how
+# far apart their predictions may be
+WARMUP_IMAGES = 2
+WARMUP_TOLERANCE = 1e-3
+
+# How many call latencies are kept for latency_stats
+LATENCY_HISTORY = 1000
+
+KERAS = "keras"
+TFLITE = "tflite"
+BACKENDS = [KERAS, TFLITE]
+
+# Output order of the shared backbone model trained by train.py --shared
+SHARED_OUTPUTS = ("faces", "users")
+
+
+def resize_into_batch(images, target_size, out):
+    """
+    Resize PIL.Image objects and write their pixels straight into a uint8 batch array.
+
+    Args:
+    images (list): List of PIL.Image objects.
+    target_size (tuple): Size (width, height) to resize the images to.
+    out (numpy.ndarray): uint8 array of shape (>= len(images), height, width, 3) to write into.
+
+    Returns:
+    numpy.ndarray: View of out holding the images.
+    """
+    for i, img in enumerate(images):
+        if img.size != target_size:
+            img = img.resize(target_size)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        out[i] = np.asarray(img)
+
+    return out[: len(images)]
+
+
+def normalize(batch):
+    """
+    Scale a uint8 batch to float32 in the 0-1 range in a single vectorized operation.
+    """
+    return np.divide(batch, np.float32(255.0), dtype=np.float32)
 
 
 class ImageEvaluator:
-    def __init__(self, model_path, target_size=(224, 224)):
+    def __init__(
+        self, model_path, target_size=(224, 224), fast=True, warmup=True, backend=None
+    ):
         """
         Initialize the ImageEvaluator with a path to a model and optional target image size.
 
         Args:
         model_path (str): Path to the trained model.
         target_size (tuple): Desired size (width, height) as expected by the model.
+        fast (bool): Whether to use the compiled inference function instead of model.predict.
+        warmup (bool): Whether to trace the compiled function at startup, so the first real call isn't slow, and check it against model.predict.
+        backend (str): KERAS or TFLITE (exported with export_tflite.py), guessed from the file extension if not given.
         """
-        self.model = self.load_trained_model(model_path)
+        self.backend = backend or (TFLITE if model_path.endswith(".tflite") else KERAS)
+        if self.backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {self.backend}, expected one of {BACKENDS}")
+
+        if self.backend == TFLITE:
+            self.model = self.load_tflite_model(model_path)
+        else:
+            self.model = self.load_trained_model(model_path)
+
         self.target_size = target_size
+        self.fast = fast
+        self.latencies = deque(maxlen=LATENCY_HISTORY)
+
+        # Reusable uint8 input buffer of MAX_BATCH_SIZE images
+        self._buffer = None
+        self._buffer_lock = threading.Lock()
+
+        if self.model is not None and self.backend == KERAS:
+            width, height = target_size
+            self._infer = tf.function(
+                self._call_model,
+                input_signature=[tf.TensorSpec([None, height, width, 3], tf.uint8)],
+            )
+
+            if fast and warmup:
+                self.warmup()
 
     def load_trained_model(self, model_path):
         """
@@ -27,25 +109,153 @@ class ImageEvaluator:
             print(f"Error loading model: {e}")
             return None
 
+    def load_tflite_model(self, model_path):
+        """
+        Load a TFLite model from the specified path, returning its signature runner.
+        """
+        try:
+            interpreter = tf.lite.Interpreter(
+                model_path=model_path, num_threads=os.cpu_count()
+            )
+            runner = interpreter.get_signature_runner()
+            self._tflite_input = next(iter(runner.get_input_details()))
+            print("Model loaded successfully.")
+            return runner
+        except (RuntimeError, ValueError) as e:
+            print(f"Error loading model: {e}")
+            return None
+
+    def _call_model(self, images):
+        # Normalize to 0-1 in the graph, so only uint8 pixels are copied in
+        images = tf.cast(images, tf.float32) / 255.0
+        return self.model(images, training=False)
+
+    def warmup(self):
+        """
+        Traces the inference function, whose batch dimension is dynamic so it's only traced
+        once, and checks that it predicts the same as model.predict.
+        """
+        width, height = self.target_size
+        images = np.random.default_rng(0).integers(
+            0, 256, (WARMUP_IMAGES, height, width, 3), dtype=np.uint8
+        )
+
+        compiled = tf.nest.map_structure(lambda output: output.numpy(), self._infer(images))
+        expected = self.model.predict(normalize(images), verbose=0)
+
+        for compiled_output, expected_output in zip(
+            tf.nest.flatten(compiled), tf.nest.flatten(expected)
+        ):
+            if not np.allclose(compiled_output, expected_output, atol=WARMUP_TOLERANCE):
+                raise ValueError(
+                    "The compiled inference function doesn't match model.predict, use fast=False"
+                )
+
+    def _batch_buffer(self):
+        """
+        Get the reusable uint8 input buffer, allocating it on first use.
+        """
+        if self._buffer is None:
+            width, height = self.target_size
+            self._buffer = np.zeros((MAX_BATCH_SIZE, height, width, 3), dtype=np.uint8)
+        return self._buffer
+
     def _preprocess_images(self, images):
         """
-        Preprocess a list of PIL.Image objects: resize and convert them to numpy arrays.
+        Preprocess a list of PIL.Image objects: resize them into a new uint8 batch array.
 
         Args:
         images (list): List of PIL.Image objects.
 
         Returns:
-        numpy.ndarray: Array of preprocessed image data.
+        numpy.ndarray: uint8 array of image data, not yet normalized.
+        """
+        width, height = self.target_size
+        out = np.empty((len(images), height, width, 3), dtype=np.uint8)
+        return resize_into_batch(images, self.target_size, out)
+
+    def _predict_fast(self, images):
+        """
+        Runs the compiled inference function on PIL.Image objects, in chunks of at most
+        MAX_BATCH_SIZE images.
+
+        The images are written into a uint8 buffer that is reused across calls, and only the
+        rows holding images are passed in. The function's batch dimension is dynamic, so any
+        chunk size runs the same traced graph without padding. Models with several outputs
+        return a list with the predictions of each output.
+        """
+        predictions = []
+
+        with self._buffer_lock:
+            for start in range(0, len(images), MAX_BATCH_SIZE):
+                chunk = images[start : start + MAX_BATCH_SIZE]
+                batch = resize_into_batch(
+                    chunk, self.target_size, self._batch_buffer()
+                )
+
+                predictions.append(
+                    tf.nest.map_structure(
+                        lambda output: output.numpy(), self._infer(batch)
+                    )
+                )
+
+        return tf.nest.map_structure(
+            lambda *chunks: np.concatenate(chunks), *predictions
+        )
+
+    def _predict_tflite(self, images):
+        """
+        Runs the TFLite model on PIL.Image objects, in chunks of at most MAX_BATCH_SIZE images.
+
+        Models with several outputs return a dict with the predictions of each output.
+        """
+        predictions = []
+
+        with self._buffer_lock:
+            for start in range(0, len(images), MAX_BATCH_SIZE):
+                chunk = images[start : start + MAX_BATCH_SIZE]
+                buffer = self._batch_buffer()
+                batch = resize_into_batch(chunk, self.target_size, buffer)
+
+                outputs = self.model(**{self._tflite_input: normalize(batch)})
+                predictions.append(
+                    next(iter(outputs.values())) if len(outputs) == 1 else outputs
+                )
+
+        return tf.nest.map_structure(
+            lambda *chunks: np.concatenate(chunks), *predictions
+        )
+
+    def _predict(self, images):
+        """
+        Predicts a list of PIL.Image objects with the TFLite model, the compiled function, or
+        model.predict if not fast.
+        """
+        if self.backend == TFLITE:
+            return self._predict_tflite(images)
+
+        if self.fast:
+            return self._predict_fast(images)
+
+        return self.model.predict(normalize(self._preprocess_images(images)))
+
+    def latency_stats(self):
+        """
+        Summarise the latency of the recent evaluate_images calls.
+
+        Returns:
+        dict: Number of calls and mean, median and 95th percentile latency in milliseconds.
         """
-        processed_images = []
-        for img in images:
-            if img.size != self.target_size:
-                img = img.resize(self.target_size)
-            img_array = img_to_array(img)
-            img_array /= 255.0  # Normalize to 0-1
-            processed_images.append(img_array)
+        if not self.latencies:
+            return {"calls": 0, "mean_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0}
 
-        return np.array(processed_images)
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "calls": len(latencies),
+            "mean_ms": float(np.mean(latencies)),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+        }
 
     def evaluate_images(self, images):
         """
@@ -61,9 +271,55 @@ class ImageEvaluator:
             print("Model is not loaded.")
             return []
 
-        # Preprocess the images
-        images_preprocessed = self._preprocess_images(images)
+        if len(images) == 0:
+            return np.array([], dtype=np.float32)
 
-        # Make predictions
-        predictions = self.model.predict(images_preprocessed)
+        start = time.perf_counter()
+
+        # Preprocess the images and make predictions
+        predictions = self._predict(list(images))
+
+        self.latencies.append(time.perf_counter() - start)
         return predictions.flatten()
+
+
+class SharedImageEvaluator(ImageEvaluator):
+    """
+    Evaluates faces and users with a single model trained by train.py --shared, which has one
+    frozen backbone and a face and a user head, so both go through the backbone in one batch.
+    """
+
+    def evaluate_faces_and_users(self, faces, users):
+        """
+        Evaluate faces and users in a single batch.
+
+        Args:
+        faces (list): List of PIL.Image face crops.
+        users (list): List of PIL.Image user crops.
+
+        Returns:
+        tuple: Face predictions and user predictions.
+        """
+        if self.model is None:
+            print("Model is not loaded.")
+            return [], []
+
+        if len(faces) + len(users) == 0:
+            return np.array([], dtype=np.float32), np.array([], dtype=np.float32)
+
+        start = time.perf_counter()
+
+        predictions = self._predict(list(faces) + list(users))
+
+        # TFLite returns the outputs by name
+        if isinstance(predictions, dict):
+            predictions = [predictions[name] for name in SHARED_OUTPUTS]
+        face_predictions, user_predictions = predictions
+
+        self.latencies.append(time.perf_counter() - start)
+
+        # Both heads see every image, only keep the face head for faces and the user head for users
+        return (
+            face_predictions[: len(faces)].flatten(),
+            user_predictions[len(faces) :].flatten(),
+        )
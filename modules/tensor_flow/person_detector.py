@@ -1,8 +1,20 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import tensorflow as tf
 import tensorflow_hub as hub
 import numpy as np
 from PIL import Image
 
+# How many images go through the detector per call
+DEFAULT_BATCH_SIZE = 8
+# Images are letterboxed to this size, the input resolution of EfficientDet-Lite2
+DEFAULT_INPUT_SIZE = 448
+DEFAULT_DECODE_WORKERS = 4
+
+PERSON_CLASS_ID = 1  # COCO dataset class ID for person
+DEFAULT_SCORE_THRESHOLD = 0.5
+
 
 class ObjectDetector:
     def __init__(self, model_url):
@@ -10,46 +22,84 @@ class ObjectDetector:
         self.detector = hub.load(model_url)
 
     def detect(self, image_tensor):
-        """Runs the model and returns a dictionary of detection outputs."""
+        """
+        Runs the model on a batch of images and returns a dictionary of detection outputs for
+        each image, with only its num_detections detections.
+        """
         # Run the detector and unpack the tuple
         detection_boxes, detection_scores, detection_classes, num_detections = (
             self.detector(image_tensor)
         )
 
-        # Convert each tensor to numpy array
-        return {
-            "detection_boxes": detection_boxes.numpy()[0],
-            "detection_scores": np.atleast_1d(detection_scores.numpy()[0]),
-            "detection_classes": np.atleast_1d(detection_classes.numpy()[0]).astype(
-                int
-            ),
-            "num_detections": int(num_detections.numpy()[0]),  # Convert to int
-        }
+        detection_boxes = detection_boxes.numpy()
+        detection_scores = detection_scores.numpy()
+        detection_classes = detection_classes.numpy().astype(int)
+        num_detections = num_detections.numpy().astype(int)
+
+        return [
+            {
+                "detection_boxes": detection_boxes[i, : num_detections[i]],
+                "detection_scores": detection_scores[i, : num_detections[i]],
+                "detection_classes": detection_classes[i, : num_detections[i]],
+                "num_detections": int(num_detections[i]),
+            }
+            for i in range(len(num_detections))
+        ]
 
 
 class ImageProcessor:
+    @staticmethod
+    def load_image(image_path):
+        """Reads an image from file in RGB format."""
+        with Image.open(image_path) as image:
+            return image.convert("RGB")
+
     @staticmethod
     def load_image_into_tensor(image_path):
         """Reads an image from file, converts it to a tensor."""
-        image = Image.open(image_path)
-        image = image.convert("RGB")  # Ensure image is in RGB format
+        image = ImageProcessor.load_image(image_path)
         image_np = np.array(image)
         image_tensor = tf.convert_to_tensor(image_np, dtype=tf.uint8)[tf.newaxis, ...]
         return image_tensor, image
 
+    @staticmethod
+    def letterbox(image, size, out):
+        """
+        Scales an image to fit in a size x size uint8 array, keeping its aspect ratio, and
+        writes it to the top left corner of out, padding the rest with black.
+
+        Returns the scale, to map the detected boxes back to the original image.
+        """
+        scale = size / max(image.size)
+        width = max(1, round(image.width * scale))
+        height = max(1, round(image.height * scale))
+
+        out[:] = 0
+        out[:height, :width] = np.asarray(image.resize((width, height)))
+        return scale
+
     @staticmethod
     def extract_objects(
-        image, boxes, class_ids, scores, target_class_id, score_threshold
+        image, boxes, class_ids, scores, target_class_id, score_threshold, padding=0.0
     ):
-        """Extracts objects of a specific class from the image based on detection results."""
+        """
+        Extracts objects of a specific class from the image based on detection results,
+        growing each box by padding times its size on every side.
+        """
         object_images = []
-        
+
         scores = np.atleast_1d(scores)
         class_ids = np.atleast_1d(class_ids)
-        
+
         for box, score, class_id in zip(boxes, scores, class_ids):
             if score > score_threshold and class_id == target_class_id:
                 ymin, xmin, ymax, xmax = box
+                if padding:
+                    pad_y = (ymax - ymin) * padding
+                    pad_x = (xmax - xmin) * padding
+                    ymin, ymax = max(0, ymin - pad_y), min(image.height, ymax + pad_y)
+                    xmin, xmax = max(0, xmin - pad_x), min(image.width, xmax + pad_x)
+
                 cropped_image = image.crop(
                     (
                         xmin,
@@ -63,27 +113,127 @@ class ImageProcessor:
 
 
 class PersonDetector:
-    def __init__(self, model_url):
+    def __init__(
+        self,
+        model_url,
+        batch_size=DEFAULT_BATCH_SIZE,
+        input_size=DEFAULT_INPUT_SIZE,
+        decode_workers=DEFAULT_DECODE_WORKERS,
+        score_threshold=DEFAULT_SCORE_THRESHOLD,
+        class_id=PERSON_CLASS_ID,
+        padding=0.0,
+    ):
+        """
+        :param str model_url: tfhub URL of the detector
+        :param int batch_size: how many images go through the detector per call
+        :param int input_size: side of the square the images are letterboxed to
+        :param int decode_workers: how many threads decode the next images in the background
+        :param float score_threshold: minimum score of the detections that are cropped
+        :param int class_id: COCO class of the detections that are cropped
+        :param float padding: how much to grow the crops by on every side, relative to their size
+        """
         self.object_detector = ObjectDetector(model_url)
-        self.person_class_id = 1  # COCO dataset class ID for person
-        self.score_threshold = 0.5
+        self.person_class_id = class_id
+        self.score_threshold = score_threshold
+        self.padding = padding
+        self.batch_size = batch_size
+        self.input_size = input_size
+        self.decode_workers = decode_workers
 
-    def get_person_images(self, image_path):
-        """Detect persons in an image and extract their images."""
-        image_tensor, original_image = ImageProcessor.load_image_into_tensor(image_path)
-        output_dict = self.object_detector.detect(image_tensor)
-
-        boxes = output_dict["detection_boxes"]
-        class_ids = output_dict["detection_classes"][0].astype(int)
-        scores = output_dict["detection_scores"][0]
-
-        person_images = ImageProcessor.extract_objects(
-            original_image,
-            boxes,
-            class_ids,
-            scores,
+    def _prepare(self, image_path):
+        image = ImageProcessor.load_image(image_path)
+        letterboxed = np.empty((self.input_size, self.input_size, 3), dtype=np.uint8)
+        scale = ImageProcessor.letterbox(image, self.input_size, letterboxed)
+        return image, letterboxed, scale
+
+    def _detect_batch(self, batch):
+        """Runs the detector on (path, future) pairs, yielding (path, image, detections, error)"""
+        prepared = []
+        for image_path, future in batch:
+            try:
+                prepared.append((image_path, *future.result(), None))
+            except (OSError, ValueError) as e:
+                prepared.append((image_path, None, None, None, e))
+
+        ready = [letterboxed for _, _, letterboxed, _, error in prepared if error is None]
+        detections = iter(
+            self.object_detector.detect(tf.convert_to_tensor(np.stack(ready)))
+            if ready
+            else []
+        )
+
+        for image_path, image, _, scale, error in prepared:
+            if error is not None:
+                yield image_path, None, None, error
+                continue
+
+            output_dict = next(detections)
+
+            # Map the boxes from the letterboxed image back to the original image
+            boxes = output_dict["detection_boxes"] / scale
+            output_dict["detection_boxes"] = np.minimum(
+                np.maximum(boxes, 0),
+                [image.height, image.width, image.height, image.width],
+            )
+            yield image_path, image, output_dict, None
+
+    def detect_images(self, image_paths):
+        """
+        Runs the detector over image files in batches, decoding the next images in the
+        background.
+
+        Yields (image path, image, detections, error) in the same order as image_paths, where
+        detections has the boxes (in original image pixels), scores and classes of every
+        detection. Files that can't be read have an error and no image or detections.
+        """
+        image_paths = iter(image_paths)
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.decode_workers) as pool:
+
+            def fill():
+                # Keep the next batch decoding while the current one is detected
+                while len(pending) < 2 * self.batch_size:
+                    image_path = next(image_paths, None)
+                    if image_path is None:
+                        return
+                    pending.append((image_path, pool.submit(self._prepare, image_path)))
+
+            fill()
+            while pending:
+                batch = [
+                    pending.popleft() for _ in range(min(self.batch_size, len(pending)))
+                ]
+                fill()
+                yield from self._detect_batch(batch)
+
+    def person_images(self, image, output_dict):
+        """Extracts the images of the persons in a detect_images result."""
+        return ImageProcessor.extract_objects(
+            image,
+            output_dict["detection_boxes"],
+            output_dict["detection_classes"],
+            output_dict["detection_scores"],
             self.person_class_id,
             self.score_threshold,
+            self.padding,
         )
-            
+
+    def get_people(self, image_paths):
+        """
+        Detects persons in image files in batches, yielding (image path, person images, error)
+        in the same order as image_paths.
+        """
+        for image_path, image, output_dict, error in self.detect_images(image_paths):
+            if error is not None:
+                yield image_path, [], error
+            else:
+                yield image_path, self.person_images(image, output_dict), None
+
+    def get_person_images(self, image_path):
+        """Detect persons in an image and extract their images."""
+        _, person_images, error = next(self.get_people([image_path]))
+        if error is not None:
+            raise error
+
         return person_images
@@ -1,14 +1,58 @@
+import random
 import requests
+import time
 
 from dataclasses import dataclass
 
 from modules.tinder.account import Account
 from modules.tinder.user import User
 from modules.tinder.match import Match
+from modules.tinder.rate_limiter import THROTTLED, RateLimiter, endpoint_for
+from modules.tinder.transport import (
+    DEFAULT_BACKOFF_FACTOR,
+    DEFAULT_BACKOFF_JITTER,
+    DEFAULT_MAX_RETRIES,
+    RETRY_METHODS,
+    RETRY_STATUSES,
+    create_adapter,
+    create_session,
+)
 
 
 BASE_URL = "https://api.gotinder.com"
 DEFAULT_TIMEOUT = 300
+# How many times a request answered with 429 is sent again, once the rate limiter allows it
+MAX_THROTTLED_RETRIES = 3
+
+
+def parse_nearby_users(data):
+    """Creates the users from a /v2/recs/core response"""
+    users = []
+    for result in data.get("data", {}).get("results", []):
+        if "user" in result:
+            user_data = result["user"]
+            user_data["distance_mi"] = result.get("distance_mi", 0)
+            user = User.from_api_data(user_data)
+            users.append(user)
+    return users
+
+
+def parse_matches(data):
+    """Creates the matches from a /v2/matches response"""
+    matches = []
+    for result in data.get("data", {}).get("matches", []):
+        user = Match.from_api_data(result)
+        matches.append(user)
+    return matches
+
+
+def parse_result_users(data):
+    """Creates the users from a response with a list of results, eg. /v2/fast-match"""
+    users = []
+    for result in data.get("data", {}).get("results", []):
+        user = User.from_api_data(result["user"])
+        users.append(user)
+    return users
 
 
 class Api:
@@ -16,37 +60,112 @@ class Api:
     Deals with the tinder API
 
     :param str token: X-Auth-Token obtained from browser
+    :param requests.Session session: pooled session to send requests through, one is created if not given. A
+        given session is used as it is, if it retries 5xx responses those retries bypass the rate limiter
+    :param str base_url: root of the API, can be pointed at a local stub server
+    :param RateLimiter rate_limiter: paces the requests, pass one backed by a file to share it between processes
     """
 
-    def __init__(self, token, timeout=DEFAULT_TIMEOUT):
+    def __init__(
+        self,
+        token,
+        timeout=DEFAULT_TIMEOUT,
+        session=None,
+        base_url=BASE_URL,
+        rate_limiter=None,
+    ):
         self._token = token
         self._timeout = timeout
+        if session is None:
+            session = create_session()
+            # Requests that reach the API are retried by _request, through the rate limiter,
+            # the session only retries the connections that couldn't be opened
+            session.mount(base_url, create_adapter(connect_only=True))
+        self._session = session
+        self._base_url = base_url
+        self._rate_limiter = rate_limiter or RateLimiter()
+
+    @property
+    def session(self):
+        """The pooled session used by the API, can be passed to Image.load to reuse connections"""
+        return self._session
+
+    @property
+    def rate_limiter(self):
+        return self._rate_limiter
+
+    def _request(self, method, path, json=None):
+        """
+        Sends a request once the rate limiter allows it, sending it again after a 429 once the
+        rate limiter allows it again. Like AsyncApi, timeouts and 5xx responses are retried with
+        jittered exponential backoff, only for idempotent methods since a like or pass may have
+        been applied already
+        """
+        endpoint = endpoint_for(path)
+        idempotent = method in RETRY_METHODS
+        throttled = 0
+        errors = 0
+
+        while True:
+            last_attempt = errors == DEFAULT_MAX_RETRIES
+
+            self._rate_limiter.acquire(endpoint)
+            try:
+                response = self._session.request(
+                    method,
+                    f"{self._base_url}{path}",
+                    headers={"X-Auth-Token": self._token},
+                    timeout=self._timeout,
+                    json=json,
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                self._rate_limiter.record(endpoint)
+                if last_attempt or not idempotent:
+                    raise
+            except requests.RequestException:
+                self._rate_limiter.record(endpoint)
+                raise
+            else:
+                self._rate_limiter.record(
+                    endpoint, response.status_code, response.headers.get("Retry-After")
+                )
+                if (
+                    response.status_code == THROTTLED
+                    and throttled < MAX_THROTTLED_RETRIES
+                ):
+                    # The rate limiter waits until the server allows it again, no backoff
+                    throttled += 1
+                    continue
+                if (
+                    response.status_code not in RETRY_STATUSES
+                    or not idempotent
+                    or last_attempt
+                ):
+                    return response
+
+            backoff = DEFAULT_BACKOFF_FACTOR * (2**errors)
+            time.sleep(backoff + DEFAULT_BACKOFF_JITTER * random.random())
+            errors += 1
+
+    def _get(self, path):
+        return self._request("GET", path)
+
+    def _post(self, path, json=None):
+        return self._request("POST", path, json=json)
 
     def get_account(self):
         """Gets the account of the current user"""
-        data = requests.get(
-            f"{BASE_URL}/v2/profile?include=account,user",
-            headers={"X-Auth-Token": self._token},
-            timeout=self._timeout,
-        ).json()
+        data = self._get("/v2/profile?include=account,user").json()
         return Account.from_api_data(data["data"])
 
     def get_user(self, user_id):
         """Gets the details of a user with a given user_id. The user must be matched or else it returns 403"""
-        data = requests.get(
-            f"{BASE_URL}/user/{user_id}",
-            headers={"X-Auth-Token": self._token},
-            timeout=self._timeout,
-        ).json()
+        data = self._get(f"/user/{user_id}").json()
         return User.from_api_data(data["results"])
 
     def matches(self, limit=10):
         """Gets the account matches limited by limit"""
-        data = requests.get(
-            f"{BASE_URL}/v2/matches?count={limit}",
-            headers={"X-Auth-Token": self._token},
-            timeout=self._timeout,
-        ).json()
+        data = self._get(f"/v2/matches?count={limit}").json()
         return list(
             map(
                 lambda match: User.from_api_data(match["person"]),
@@ -60,42 +179,30 @@ class Api:
 
         is_match: bool
         likes_remaining: int
+        # Set when the like wasn't made because the account ran out of likes
+        rate_limited_until: int = None
 
     def like(self, user_id) -> LikeResult:
         """Likes the profile with the given user_id"""
-        data = requests.post(
-            f"{BASE_URL}/like/{user_id}",
-            headers={"X-Auth-Token": self._token},
-            timeout=self._timeout,
-        ).json()
+        response = self._post(f"/like/{user_id}")
+        response.raise_for_status()
+        data = response.json()
 
-        return Api.LikeResult(data["match"], data["likes_remaining"])
+        return Api.LikeResult(
+            data["match"], data["likes_remaining"], data.get("rate_limited_until")
+        )
 
     def dislike(self, user_id):
         """Passes the profile with the given user_id"""
-        requests.post(
-            f"{BASE_URL}/pass/{user_id}",
-            headers={"X-Auth-Token": self._token},
-            timeout=self._timeout,
-        ).json()
+        response = self._post(f"/pass/{user_id}")
+        response.raise_for_status()
+        response.json()
         return True
 
     def get_nearby_users(self):
         """Gets nearby users. These are usually random and come in batches of ~20"""
-        data = requests.get(
-            f"{BASE_URL}/v2/recs/core",
-            headers={"X-Auth-Token": self._token},
-            timeout=self._timeout,
-        ).json()
-
-        users = []
-        for result in data.get("data", {}).get("results", []):
-            if "user" in result:
-                user_data = result["user"]
-                user_data["distance_mi"] = result.get("distance_mi", 0)
-                user = User.from_api_data(user_data)
-                users.append(user)
-        return users
+        data = self._get("/v2/recs/core").json()
+        return parse_nearby_users(data)
 
     def update_location(self, latitude, longitude):
         """
@@ -106,12 +213,7 @@ class Api:
         :param float latitude: The latitude in decimal format (eg. 35.9372)
         :param float longitude: The longitude in decimal format (eg. 22.47239)
         """
-        requests.post(
-            f"{BASE_URL}/v2/meta",
-            headers={"X-Auth-Token": self._token},
-            timeout=self._timeout,
-            json={"lat": latitude, "lon": longitude},
-        ).json()
+        self._post("/v2/meta", json={"lat": latitude, "lon": longitude}).json()
         return True
 
     def get_matches(self, include_messages=True, count=100):
@@ -121,42 +223,17 @@ class Api:
         :param bool include_messages: whether to include users that have messaged
         :param int count: how many users to return
         """
-        data = requests.get(
-            f"{BASE_URL}/v2/matches?count={count}&message={1 if include_messages else 0}",
-            headers={"X-Auth-Token": self._token},
-            timeout=self._timeout,
+        data = self._get(
+            f"/v2/matches?count={count}&message={1 if include_messages else 0}"
         ).json()
-
-        matches = []
-        for result in data.get("data", {}).get("matches", []):
-            user = Match.from_api_data(result)
-            matches.append(user)
-        return matches
+        return parse_matches(data)
 
     def get_fast_matches(self):
         """Gets fast matches for the account, eg. the users who have liked the account"""
-        data = requests.get(
-            f"{BASE_URL}/v2/fast-match",
-            headers={"X-Auth-Token": self._token},
-            timeout=self._timeout,
-        ).json()
-
-        users = []
-        for result in data.get("data", {}).get("results", []):
-            user = User.from_api_data(result["user"])
-            users.append(user)
-        return users
+        data = self._get("/v2/fast-match").json()
+        return parse_result_users(data)
     
     def get_liked_users(self):
         """Gets fast users this account has liked"""
-        data = requests.get(
-            f"{BASE_URL}/v2/my-likes",
-            headers={"X-Auth-Token": self._token},
-            timeout=self._timeout,
-        ).json()
-
-        users = []
-        for result in data.get("data", {}).get("results", []):
-            user = User.from_api_data(result["user"])
-            users.append(user)
-        return users
+        data = self._get("/v2/my-likes").json()
+        return parse_result_users(data)
@@ -0,0 +1,236 @@
+import asyncio
+import random
+
+import aiohttp
+
+from modules.tinder.account import Account
+from modules.tinder.user import User
+from modules.tinder.api import (
+    Api,
+    BASE_URL,
+    DEFAULT_TIMEOUT,
+    MAX_THROTTLED_RETRIES,
+    parse_matches,
+    parse_nearby_users,
+    parse_result_users,
+)
+from modules.tinder.rate_limiter import THROTTLED, RateLimiter, endpoint_for
+from modules.tinder.transport import (
+    DEFAULT_BACKOFF_FACTOR,
+    DEFAULT_BACKOFF_JITTER,
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_POOL_MAXSIZE,
+    RETRY_METHODS,
+    RETRY_STATUSES,
+)
+
+DEFAULT_CONNECTION_LIMIT = 100
+
+
+class AsyncApi:
+    """
+    Deals with the tinder API using asyncio, so many requests can be in flight at once
+
+    Mirrors Api and returns the same dataclasses. Use it as an async context manager so the
+    underlying connections are closed when done:
+
+        async with AsyncApi(token) as api:
+            users = await api.get_nearby_users()
+            await asyncio.gather(*(image.load_async(api.session) for image in users[0].images))
+
+    :param str token: X-Auth-Token obtained from browser
+    :param aiohttp.ClientSession session: session to send requests through, one is created if not given
+    :param str base_url: root of the API, can be pointed at a local stub server
+    :param int limit: maximum number of connections open at the same time
+    :param int limit_per_host: maximum number of connections open to a single host
+    :param int max_retries: how many times a failed request is retried
+    :param RateLimiter rate_limiter: paces the requests, pass one backed by a file to share it between processes
+    """
+
+    def __init__(
+        self,
+        token,
+        timeout=DEFAULT_TIMEOUT,
+        session=None,
+        base_url=BASE_URL,
+        limit=DEFAULT_CONNECTION_LIMIT,
+        limit_per_host=DEFAULT_POOL_MAXSIZE,
+        max_retries=DEFAULT_MAX_RETRIES,
+        rate_limiter=None,
+    ):
+        self._token = token
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._base_url = base_url
+        self._max_retries = max_retries
+        self._rate_limiter = rate_limiter or RateLimiter()
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._owns_session = session is None
+        # aiohttp wants sessions created inside the event loop, so it's created on first use
+        self._session = session
+
+    async def __aenter__(self):
+        self._ensure_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close()
+
+    async def close(self):
+        """Closes the session if it was created by this object"""
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _ensure_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self._limit, limit_per_host=self._limit_per_host
+                )
+            )
+        return self._session
+
+    @property
+    def session(self):
+        """
+        The session used by the API, can be passed to Image.load_async to reuse connections.
+        Must be used from within the event loop
+        """
+        return self._ensure_session()
+
+    async def _request(self, method, path, json=None):
+        """
+        Sends a request once the rate limiter allows it, retrying 429s once the rate limiter
+        allows it again, and connection errors with jittered exponential backoff. Like the
+        sync session, timeouts and 5xx responses are only retried for idempotent methods,
+        since a like or pass may have been applied already
+
+        :raises aiohttp.ClientResponseError: if the API still answers with an error status
+        """
+        endpoint = endpoint_for(path)
+        session = self._ensure_session()
+        idempotent = method in RETRY_METHODS
+        throttled = 0
+        errors = 0
+
+        while True:
+            last_attempt = errors == self._max_retries
+
+            # Reserved without blocking, so the other requests keep going while this one waits
+            await asyncio.sleep(await self._call_limiter("reserve", endpoint))
+            try:
+                async with session.request(
+                    method,
+                    f"{self._base_url}{path}",
+                    headers={"X-Auth-Token": self._token},
+                    timeout=self._timeout,
+                    json=json,
+                ) as response:
+                    await self._call_limiter(
+                        "record",
+                        endpoint,
+                        response.status,
+                        response.headers.get("Retry-After"),
+                    )
+                    if (
+                        response.status == THROTTLED
+                        and throttled < MAX_THROTTLED_RETRIES
+                    ):
+                        # The rate limiter waits until the server allows it again, no backoff
+                        throttled += 1
+                        continue
+                    if (
+                        response.status not in RETRY_STATUSES
+                        or not idempotent
+                        or last_attempt
+                    ):
+                        response.raise_for_status()
+                        return await response.json(content_type=None)
+            except aiohttp.ClientConnectorError:
+                # The connection couldn't be opened, so the request never reached the server
+                await self._call_limiter("record", endpoint)
+                if last_attempt:
+                    raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                await self._call_limiter("record", endpoint)
+                if last_attempt or not idempotent:
+                    raise
+
+            backoff = DEFAULT_BACKOFF_FACTOR * (2**errors)
+            await asyncio.sleep(backoff + DEFAULT_BACKOFF_JITTER * random.random())
+            errors += 1
+
+    async def _call_limiter(self, method, *args):
+        """
+        Calls a rate limiter method in a thread, its SQLite transactions can wait on other
+        processes sharing the database and would block the event loop meanwhile
+        """
+        return await asyncio.to_thread(getattr(self._rate_limiter, method), *args)
+
+    async def _get(self, path):
+        return await self._request("GET", path)
+
+    async def _post(self, path, json=None):
+        return await self._request("POST", path, json=json)
+
+    async def get_account(self):
+        """Gets the account of the current user"""
+        data = await self._get("/v2/profile?include=account,user")
+        return Account.from_api_data(data["data"])
+
+    async def get_user(self, user_id):
+        """Gets the details of a user with a given user_id. The user must be matched or else it returns 403"""
+        data = await self._get(f"/user/{user_id}")
+        return User.from_api_data(data["results"])
+
+    async def like(self, user_id) -> Api.LikeResult:
+        """Likes the profile with the given user_id"""
+        data = await self._post(f"/like/{user_id}")
+        return Api.LikeResult(
+            data["match"], data["likes_remaining"], data.get("rate_limited_until")
+        )
+
+    async def dislike(self, user_id):
+        """Passes the profile with the given user_id"""
+        await self._post(f"/pass/{user_id}")
+        return True
+
+    async def get_nearby_users(self):
+        """Gets nearby users. These are usually random and come in batches of ~20"""
+        data = await self._get("/v2/recs/core")
+        return parse_nearby_users(data)
+
+    async def update_location(self, latitude, longitude):
+        """
+        Updates the location of the logged in user
+
+        If called too often it can trigger a cool down period where the location is not updated for ~15min
+
+        :param float latitude: The latitude in decimal format (eg. 35.9372)
+        :param float longitude: The longitude in decimal format (eg. 22.47239)
+        """
+        await self._post("/v2/meta", json={"lat": latitude, "lon": longitude})
+        return True
+
+    async def get_matches(self, include_messages=True, count=100):
+        """
+        Gets the users that have matches with the account
+
+        :param bool include_messages: whether to include users that have messaged
+        :param int count: how many users to return
+        """
+        data = await self._get(
+            f"/v2/matches?count={count}&message={1 if include_messages else 0}"
+        )
+        return parse_matches(data)
+
+    async def get_fast_matches(self):
+        """Gets fast matches for the account, eg. the users who have liked the account"""
+        data = await self._get("/v2/fast-match")
+        return parse_result_users(data)
+
+    async def get_liked_users(self):
+        """Gets fast users this account has liked"""
+        data = await self._get("/v2/my-likes")
+        return parse_result_users(data)
@@ -0,0 +1,77 @@
+import threading
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+from modules.tinder.transport import create_session
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_PER_HOST = 8
+
+
+class ImageDownloader:
+    """
+    Downloads the raw bytes of many images in parallel
+
+    :param requests.Session session: session to download through, eg. Api.session
+    :param int concurrency: maximum number of downloads in flight
+    :param int per_host: maximum number of downloads in flight to a single host
+    :param ImageCache cache: on-disk cache to serve already downloaded images from
+    """
+
+    def __init__(
+        self,
+        session=None,
+        concurrency=DEFAULT_CONCURRENCY,
+        per_host=DEFAULT_PER_HOST,
+        cache=None,
+    ):
+        self._session = session or create_session(pool_maxsize=per_host)
+        self._cache = cache
+        self._executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="download"
+        )
+        self._per_host = per_host
+        self._host_slots = defaultdict(self._new_host_slot)
+        self._host_slots_lock = threading.Lock()
+
+    def _new_host_slot(self):
+        return threading.BoundedSemaphore(self._per_host)
+
+    def _host_slot(self, url):
+        with self._host_slots_lock:
+            return self._host_slots[urlparse(url).netloc]
+
+    def _fetch(self, image):
+        with self._host_slot(image.url):
+            return image.fetch(self._session, self._cache)
+
+    def submit(self, image):
+        """Schedules the download of an image, returning a future with its bytes"""
+        return self._executor.submit(self._fetch, image)
+
+    def download(self, images):
+        """
+        Downloads the given images, yielding them as soon as each one finishes
+
+        :param list images: the Image objects to download
+        :return: generator of (image, data, error) tuples, where data is None if the download failed
+        """
+        futures = {self.submit(image): image for image in images}
+        for future in as_completed(futures):
+            image = futures[future]
+            try:
+                yield image, future.result(), None
+            except Exception as e:
+                yield image, None, e
+
+    def close(self):
+        """Waits for pending downloads and stops the worker threads"""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
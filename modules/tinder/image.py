@@ -1,3 +1,5 @@
+import asyncio
+import math
 import requests
 
 from dataclasses import dataclass
@@ -7,6 +9,56 @@ from io import BytesIO
 
 import PIL.Image
 
+# Photos larger than this are aborted mid-download
+MAX_IMAGE_BYTES = 20 * 1024**2
+MAX_IMAGE_PIXELS = 50_000_000
+
+CHUNK_SIZE = 64 * 1024
+
+# The JPEG header with the image size is at the start of the file, stop looking for it after this
+HEADER_PROBE_BYTES = 256 * 1024
+
+
+class _DownloadBuffer:
+    """Accumulates a photo as it downloads, aborting it as soon as it is known to be too big"""
+
+    def __init__(self, url, max_bytes):
+        self._url = url
+        self._max_bytes = max_bytes
+        self._buffer = bytearray()
+        self._probing_header = True
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        if len(self._buffer) > self._max_bytes:
+            raise requests.RequestException(
+                f"Image {self._url} is larger than {self._max_bytes} bytes"
+            )
+
+        if self._probing_header:
+            self._check_dimensions()
+
+    def _check_dimensions(self):
+        try:
+            with PIL.Image.open(BytesIO(self._buffer)) as image:
+                width, height = image.size
+        except PIL.Image.DecompressionBombError as e:
+            # Raised by PIL itself for headers declaring a huge image
+            raise requests.RequestException(f"Image {self._url} is too large: {e}")
+        except (OSError, SyntaxError):
+            # Header not fully downloaded yet
+            self._probing_header = len(self._buffer) < HEADER_PROBE_BYTES
+            return
+
+        self._probing_header = False
+        if width * height > MAX_IMAGE_PIXELS:
+            raise requests.RequestException(
+                f"Image {self._url} is too large ({width}x{height})"
+            )
+
+    def getvalue(self) -> bytes:
+        return bytes(self._buffer)
+
 
 @dataclass
 class Image:
@@ -89,14 +141,125 @@ class Image:
         # Crop the image to these new bounds
         return self.image.crop((left, top, right, bottom))
 
-    def load(self):
-        """Loads the URL image into the object"""
-        req = requests.get(self.url, stream=True, timeout=300)
-        if req.status_code != 200:
-            raise requests.RequestException(f"Could not load image, status code {req.status_code}")
+    def load(self, session=None, cache=None, min_crop_size=None):
+        """
+        Loads the URL image into the object
+
+        :param requests.Session session: session to download through, eg. Api.session to reuse its pooled connections
+        :param ImageCache cache: on-disk cache to serve the image from, if it has already been downloaded
+        :param int min_crop_size: see load_bytes
+        """
+        self.load_bytes(self.fetch(session, cache), min_crop_size)
+
+    def fetch(self, session=None, cache=None, max_bytes=MAX_IMAGE_BYTES) -> bytes:
+        """
+        Downloads the raw image bytes without decoding them
+
+        :param requests.Session session: session to download through, eg. Api.session to reuse its pooled connections
+        :param ImageCache cache: on-disk cache to serve the image from, if it has already been downloaded
+        :param int max_bytes: the download is aborted if the image is larger than this
+        """
+        if cache:
+            data = cache.get(self.url)
+            if data is not None:
+                return data
+
+        http = session or requests
+        with http.get(self.url, stream=True, timeout=300) as req:
+            if req.status_code != 200:
+                raise requests.RequestException(f"Could not load image, status code {req.status_code}")
 
-        image_bytes = BytesIO(req.content)
+            if int(req.headers.get("Content-Length", 0)) > max_bytes:
+                raise requests.RequestException(
+                    f"Image {self.url} is larger than {max_bytes} bytes"
+                )
+
+            buffer = _DownloadBuffer(self.url, max_bytes)
+            for chunk in req.iter_content(CHUNK_SIZE):
+                buffer.feed(chunk)
+
+        data = buffer.getvalue()
+        if cache:
+            cache.put(self.url, data)
+        return data
+
+    async def load_async(
+        self, session, cache=None, min_crop_size=None, max_bytes=MAX_IMAGE_BYTES
+    ):
+        """
+        Loads the URL image into the object without blocking the event loop
+
+        :param aiohttp.ClientSession session: session to download through, eg. AsyncApi.session
+        :param ImageCache cache: on-disk cache to serve the image from, if it has already been downloaded
+        :param int min_crop_size: see load_bytes
+        :param int max_bytes: the download is aborted if the image is larger than this
+        """
+        # Only the async callers need aiohttp
+        import aiohttp
+
+        data = cache.get(self.url) if cache else None
+
+        if data is None:
+            async with session.get(
+                self.url, timeout=aiohttp.ClientTimeout(total=300)
+            ) as req:
+                if req.status != 200:
+                    raise requests.RequestException(f"Could not load image, status code {req.status}")
+
+                if (req.content_length or 0) > max_bytes:
+                    raise requests.RequestException(
+                        f"Image {self.url} is larger than {max_bytes} bytes"
+                    )
+
+                buffer = _DownloadBuffer(self.url, max_bytes)
+                async for chunk in req.content.iter_chunked(CHUNK_SIZE):
+                    buffer.feed(chunk)
+
+            data = buffer.getvalue()
+            if cache:
+                cache.put(self.url, data)
+
+        # Decoding is CPU bound, so keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.load_bytes, data, min_crop_size
+        )
+
+    def _draft_size(self, width, height, min_crop_size):
+        """
+        Finds the smallest size the image can be decoded at while its face and user crops are
+        still at least min_crop_size pixels wide
+        """
+        boxes = [box for box in (self.face_box, self.user_box) if box]
+        if not boxes:
+            return None
+
+        # The crops are squares as wide as the largest side of their bounding box
+        reduction = min(
+            max(box.width_percent * width, box.height_percent * height) / min_crop_size
+            for box in boxes
+        )
+        if reduction <= 1:
+            return None
+
+        return (math.ceil(width / reduction), math.ceil(height / reduction))
+
+    def load_bytes(self, data, min_crop_size=None):
+        """
+        Loads the image from already downloaded JPEG bytes
+
+        :param bytes data: the encoded image
+        :param int min_crop_size: if given, the JPEG is decoded directly at a reduced resolution (using DCT
+            scaling) as long as the face and user crops stay at least this many pixels wide. The original
+            image is then reduced as well
+        """
+        image_bytes = BytesIO(data)
         self.image = PIL.Image.open(image_bytes)
+
+        if min_crop_size:
+            draft_size = self._draft_size(*self.image.size, min_crop_size)
+            if draft_size:
+                self.image.draft("RGB", draft_size)
+
         self.image = self.image.convert("RGB")
 
     def get_user(self) -> PIL.Image:
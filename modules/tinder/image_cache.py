@@ -0,0 +1,180 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+BLOBS = "blobs"
+URLS = "urls"
+
+# After evicting, the cache is shrunk to this fraction of its maximum size so that
+# every put doesn't trigger a new directory scan
+EVICTION_TARGET = 0.9
+
+# The size is tracked per process, it's recounted from disk after this many writes so photos
+# added by other processes sharing the directory are accounted for
+SIZE_RESYNC_PUTS = 500
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _atomic_write(path, data):
+    """Writes to a temporary file and renames it so readers never see partial files"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ImageCache:
+    """
+    Content-addressed on-disk cache of raw image bytes
+
+    URLs map to the hash of their content, and each distinct content is stored once, so the
+    same photo served from different URLs is deduplicated. Least recently used photos are
+    evicted once the cache grows over max_bytes, along with the URLs pointing at them. Writes
+    are atomic so several processes can share the same directory, each one recounting the size
+    of the cache from disk every SIZE_RESYNC_PUTS writes.
+
+    :param str directory: where to store the cache
+    :param int max_bytes: maximum size of the stored photos
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, BLOBS), exist_ok=True)
+        os.makedirs(os.path.join(directory, URLS), exist_ok=True)
+        self._size = sum(size for _, size, _ in self._blobs())
+        self._puts_since_resync = 0
+
+    def _blob_path(self, content_hash):
+        return os.path.join(
+            self.directory, BLOBS, content_hash[:2], f"{content_hash}.jpg"
+        )
+
+    def _url_path(self, url):
+        url_hash = _sha256(url.encode())
+        return os.path.join(self.directory, URLS, url_hash[:2], url_hash)
+
+    def _blobs(self):
+        """Yields (path, size, last access) of every stored photo"""
+        for root, _, files in os.walk(os.path.join(self.directory, BLOBS)):
+            for file in files:
+                if not file.endswith(".jpg"):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Evicted by another process
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def get(self, url):
+        """Returns the cached bytes for the URL, or None if they are not cached"""
+        try:
+            with open(self._url_path(url), "r") as file:
+                blob_path = self._blob_path(file.read().strip())
+            with open(blob_path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # The modification time doubles as the last access time for LRU eviction
+        try:
+            os.utime(blob_path)
+        except FileNotFoundError:
+            # Evicted by another process since it was read, the bytes are still good
+            pass
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, url, data):
+        """Stores the bytes downloaded from the URL"""
+        content_hash = _sha256(data)
+        blob_path = self._blob_path(content_hash)
+
+        try:
+            os.utime(blob_path)
+        except FileNotFoundError:
+            _atomic_write(blob_path, data)
+            with self._lock:
+                self._size += len(data)
+
+        _atomic_write(self._url_path(url), content_hash.encode())
+
+        with self._lock:
+            self._puts_since_resync += 1
+            if self._puts_since_resync >= SIZE_RESYNC_PUTS:
+                self._size = sum(size for _, size, _ in self._blobs())
+                self._puts_since_resync = 0
+
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used photos until the cache is back under its limit"""
+        with self._lock:
+            blobs = sorted(self._blobs(), key=lambda blob: blob[2])
+            size = sum(size for _, size, _ in blobs)
+            target = self.max_bytes * EVICTION_TARGET
+
+            for path, blob_size, _ in blobs:
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= blob_size
+
+            self._size = size
+            self._puts_since_resync = 0
+            self._remove_dangling_urls()
+
+    def _remove_dangling_urls(self):
+        """Removes the URL entries pointing at photos that are no longer stored"""
+        for root, _, files in os.walk(os.path.join(self.directory, URLS)):
+            for file in files:
+                if file.endswith(".tmp"):
+                    # Still being written
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    with open(path, "r") as url_file:
+                        content_hash = url_file.read().strip()
+                    if not os.path.exists(self._blob_path(content_hash)):
+                        os.remove(path)
+                except FileNotFoundError:
+                    # Removed by another process
+                    continue
+
+    def stats(self):
+        """Returns the hit/miss counters and current size of the cache"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size_bytes": self._size,
+            }
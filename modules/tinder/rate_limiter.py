@@ -0,0 +1,270 @@
+import os
+import sqlite3
+import threading
+import time
+
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+
+RATE_LIMITS_DB = "rate_limits.db"
+
+
+@dataclass
+class Budget:
+    """
+    Request budget of an endpoint
+
+    :param float rate: requests per second it starts at
+    :param float burst: how many requests can be made at once after being idle
+    :param float max_rate: requests per second it can grow to while the server doesn't push back
+    """
+
+    rate: float
+    burst: float
+    max_rate: float
+
+
+RECS = "recs"
+LIKE = "like"
+PASS = "pass"
+LOCATION = "location"
+DEFAULT = "default"
+
+BUDGETS = {
+    RECS: Budget(rate=0.5, burst=2, max_rate=2),
+    LIKE: Budget(rate=1, burst=5, max_rate=4),
+    PASS: Budget(rate=2, burst=10, max_rate=8),
+    # Updating the location too often triggers a ~15 minute cool down
+    LOCATION: Budget(rate=1 / 900, burst=2, max_rate=1 / 900),
+    DEFAULT: Budget(rate=1, burst=5, max_rate=4),
+}
+
+# AIMD: every successful request adds a fraction of the starting rate, a 429 halves the rate
+# and other server or connection errors cut it by a quarter. Other client errors, eg. a 404,
+# say nothing about the load of the server and leave the rate as it is
+ADDITIVE_INCREASE = 0.05
+THROTTLED_DECREASE = 0.5
+ERROR_DECREASE = 0.75
+MIN_RATE_FRACTION = 0.05
+
+THROTTLED = 429
+# How long to back off after a 429 without a Retry-After header, in seconds
+DEFAULT_RETRY_AFTER = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    endpoint TEXT PRIMARY KEY,
+    rate REAL NOT NULL,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    blocked_until REAL NOT NULL,
+    requests INTEGER NOT NULL DEFAULT 0,
+    throttled INTEGER NOT NULL DEFAULT 0,
+    errors INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+"""
+
+
+def endpoint_for(path):
+    """Which budget a request to an API path is counted against"""
+    if path.startswith("/v2/recs"):
+        return RECS
+    if path.startswith("/like/"):
+        return LIKE
+    if path.startswith("/pass/"):
+        return PASS
+    if path.startswith("/v2/meta"):
+        return LOCATION
+    return DEFAULT
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header, either a number of seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """
+    Adaptive token bucket rate limiter, with a budget per endpoint
+
+    Every request takes a token from the bucket of its endpoint, which refills at the rate of
+    the endpoint. The rate adapts to the server (AIMD): it grows slowly while requests succeed,
+    up to the max_rate of the budget, and is cut when the server answers 429 or fails. A
+    Retry-After header blocks the endpoint until then.
+
+    The buckets are stored in SQLite and updated in immediate transactions, so every process
+    using the same file, eg. farm_photos.py and tensor_flirt.py, shares the budgets. Without a
+    path they are only shared within the process.
+
+    :param str path: path of the database file, or None to keep the buckets in memory
+    :param dict budgets: {endpoint: Budget}, defaults to BUDGETS
+    """
+
+    def __init__(self, path=None, budgets=None):
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.budgets = budgets or BUDGETS
+        self._lock = threading.Lock()
+        # Transactions are handled explicitly, to lock the database before reading a bucket
+        self._connection = sqlite3.connect(
+            path or ":memory:", check_same_thread=False, isolation_level=None
+        )
+        if path:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def _budget(self, endpoint):
+        return self.budgets.get(endpoint, self.budgets[DEFAULT])
+
+    def _update(self, endpoint, update):
+        """
+        Runs update(bucket, now) on the refilled bucket of an endpoint in a transaction that
+        locks the database, then stores the bucket it modified. Returns what update returns
+        """
+        budget = self._budget(endpoint)
+
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self._connection.execute(
+                    "SELECT rate, tokens, updated_at, blocked_until, requests, throttled, errors FROM buckets WHERE endpoint = ?",
+                    (endpoint,),
+                ).fetchone()
+
+                if row is None:
+                    bucket = {
+                        "rate": budget.rate,
+                        "tokens": budget.burst,
+                        "blocked_until": 0.0,
+                        "requests": 0,
+                        "throttled": 0,
+                        "errors": 0,
+                    }
+                else:
+                    rate, tokens, updated_at, blocked_until, requests, throttled, errors = row
+                    bucket = {
+                        # The budget may have changed since the bucket was stored
+                        "rate": min(
+                            budget.max_rate,
+                            max(budget.rate * MIN_RATE_FRACTION, rate),
+                        ),
+                        "tokens": min(
+                            budget.burst, tokens + max(0.0, now - updated_at) * rate
+                        ),
+                        "blocked_until": blocked_until,
+                        "requests": requests,
+                        "throttled": throttled,
+                        "errors": errors,
+                    }
+
+                result = update(bucket, now)
+
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        endpoint,
+                        bucket["rate"],
+                        bucket["tokens"],
+                        now,
+                        bucket["blocked_until"],
+                        bucket["requests"],
+                        bucket["throttled"],
+                        bucket["errors"],
+                    ),
+                )
+                self._connection.execute("COMMIT")
+                return result
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def reserve(self, endpoint):
+        """
+        Takes a token for a request to an endpoint, returning how many seconds to wait before
+        making it. Doesn't block, so it can be awaited with asyncio.sleep
+        """
+
+        def take(bucket, now):
+            bucket["tokens"] -= 1
+            bucket["requests"] += 1
+
+            # A negative balance is a token reserved from the future
+            delay = -bucket["tokens"] / bucket["rate"] if bucket["tokens"] < 0 else 0.0
+            return max(delay, bucket["blocked_until"] - now)
+
+        return self._update(endpoint, take)
+
+    def acquire(self, endpoint):
+        """Blocks until a request to an endpoint can be made"""
+        delay = self.reserve(endpoint)
+        if delay > 0:
+            time.sleep(delay)
+
+    def record(self, endpoint, status=None, retry_after=None):
+        """
+        Adapts the rate of an endpoint to the outcome of a request
+
+        :param str endpoint: endpoint the request was counted against
+        :param int status: HTTP status of the response, None if the request failed to connect
+        :param str retry_after: Retry-After header of the response
+        """
+        budget = self._budget(endpoint)
+        min_rate = budget.rate * MIN_RATE_FRACTION
+
+        def adapt(bucket, now):
+            if status == THROTTLED:
+                bucket["throttled"] += 1
+                bucket["rate"] = max(min_rate, bucket["rate"] * THROTTLED_DECREASE)
+                # The tokens taken since were spent too fast
+                bucket["tokens"] = min(bucket["tokens"], 0.0)
+
+                wait = parse_retry_after(retry_after)
+                bucket["blocked_until"] = max(
+                    bucket["blocked_until"],
+                    now + (DEFAULT_RETRY_AFTER if wait is None else wait),
+                )
+            elif status is None or status >= 500:
+                bucket["errors"] += 1
+                bucket["rate"] = max(min_rate, bucket["rate"] * ERROR_DECREASE)
+            elif 200 <= status < 300:
+                bucket["rate"] = min(
+                    budget.max_rate, bucket["rate"] + budget.rate * ADDITIVE_INCREASE
+                )
+
+        self._update(endpoint, adapt)
+
+    def stats(self):
+        """Returns {endpoint: {rate, requests, throttled, errors}} of the endpoints used"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT endpoint, rate, requests, throttled, errors FROM buckets"
+            ).fetchall()
+        return {
+            endpoint: {
+                "rate": rate,
+                "requests": requests,
+                "throttled": throttled,
+                "errors": errors,
+            }
+            for endpoint, rate, requests, throttled, errors in rows
+        }
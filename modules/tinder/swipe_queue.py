@@ -0,0 +1,245 @@
+import os
+import requests
+import sqlite3
+import threading
+import time
+
+from modules.tinder.rate_limiter import THROTTLED
+
+SWIPE_QUEUE_DB = "swipe_queue.db"
+
+LIKE = "like"
+PASS = "pass"
+
+PENDING = "pending"
+SENT = "sent"
+FAILED = "failed"
+
+# How many times an action is sent before it's given up on, and the backoff between attempts
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 2
+MAX_RETRY_BACKOFF = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS actions (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    name TEXT,
+    action TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    is_match INTEGER,
+    likes_remaining INTEGER,
+    created_at REAL NOT NULL,
+    sent_at REAL
+);
+
+CREATE INDEX IF NOT EXISTS actions_status ON actions (status, id);
+"""
+
+
+def _is_permanent(error):
+    """
+    Whether sending an action again can't succeed, ie. the API refused it with a client error
+    other than 429, so it's given up on at once instead of holding up the actions behind it
+    """
+    response = getattr(error, "response", None)
+    if not isinstance(error, requests.HTTPError) or response is None:
+        return False
+    return 400 <= response.status_code < 500 and response.status_code != THROTTLED
+
+
+class SwipeQueue:
+    """
+    Durable queue of likes and passes, sent in order by a background thread so scoring never
+    waits on the API
+
+    Actions are committed to SQLite before enqueue returns and only marked as sent once the
+    API answered, so the actions still pending after a crash or ctrl + c are sent by the next
+    run. Only one queue should send from a database at a time.
+
+    Once a like reports no likes remaining, enqueue_like refuses new likes, and the likes that
+    the API rate limited are kept pending for the next run instead of being lost.
+
+    :param str path: path of the database file
+    :param Api api: API to send the actions through
+    """
+
+    def __init__(self, path, api):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._api = api
+        self._connection = self._connect()
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopping = False
+        self._in_flight = 0
+
+        self.likes_remaining = None
+        self.sent = 0
+        self.matches = 0
+        self.failed = 0
+
+        self._sender = threading.Thread(
+            target=self._send_loop, name="swipe-sender", daemon=True
+        )
+        self._sender.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        return connection
+
+    @property
+    def out_of_likes(self):
+        return self.likes_remaining == 0
+
+    def _enqueue(self, user_id, action, name):
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    "INSERT INTO actions (user_id, name, action, status, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (user_id, name, action, PENDING, time.time()),
+                )
+            self._wakeup.notify()
+
+    def enqueue_like(self, user_id, name=None):
+        """
+        Queues a like, unless the account ran out of likes
+
+        :return: whether the like was queued
+        """
+        if self.out_of_likes:
+            return False
+        self._enqueue(user_id, LIKE, name)
+        return True
+
+    def enqueue_pass(self, user_id, name=None):
+        """Queues a pass"""
+        self._enqueue(user_id, PASS, name)
+
+    def pending(self):
+        """How many actions haven't been sent yet, including the one being sent"""
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM actions WHERE status = ?", (PENDING,)
+            ).fetchone()[0]
+
+    def _next_action(self, skip_likes):
+        """The oldest pending action, skipping the likes once they ran out"""
+        query = "SELECT id, user_id, name, action, attempts FROM actions WHERE status = ?"
+        parameters = [PENDING]
+        if skip_likes:
+            query += " AND action != ?"
+            parameters.append(LIKE)
+        return self._connection.execute(
+            query + " ORDER BY id LIMIT 1", parameters
+        ).fetchone()
+
+    def _send_loop(self):
+        while True:
+            with self._lock:
+                row = self._next_action(self.out_of_likes)
+                while row is None and not self._stopping:
+                    self._wakeup.wait()
+                    row = self._next_action(self.out_of_likes)
+                if self._stopping:
+                    return
+                self._in_flight = 1
+
+            try:
+                self._send(*row)
+            finally:
+                with self._lock:
+                    self._in_flight = 0
+                    self._wakeup.notify_all()
+
+    def _send(self, action_id, user_id, name, action, attempts):
+        try:
+            if action == LIKE:
+                result = self._api.like(user_id)
+            else:
+                self._api.dislike(user_id)
+                result = None
+        except Exception as e:
+            attempts += 1
+            status = (
+                FAILED if attempts >= MAX_ATTEMPTS or _is_permanent(e) else PENDING
+            )
+            with self._lock, self._connection:
+                self._connection.execute(
+                    "UPDATE actions SET status = ?, attempts = ?, error = ? WHERE id = ?",
+                    (status, attempts, str(e), action_id),
+                )
+
+            if status == FAILED:
+                self.failed += 1
+                print(f"Gave up on the {action} of {name or user_id}: {str(e)}")
+            else:
+                # Woken early by close, so stopping doesn't wait for the backoff
+                with self._lock:
+                    if not self._stopping:
+                        self._wakeup.wait(min(RETRY_BACKOFF**attempts, MAX_RETRY_BACKOFF))
+            return
+
+        if result is not None:
+            self.likes_remaining = result.likes_remaining
+            if result.rate_limited_until:
+                # The like wasn't made, it stays pending until the likes are replenished. The
+                # API may still report likes remaining, the other likes would be refused too
+                self.likes_remaining = 0
+                print("Out of likes, the remaining likes will be sent on the next run")
+                return
+
+            if result.is_match:
+                self.matches += 1
+                print(f"\u001b[32mIt's a match with {name or user_id}!\u001b[37m")
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE actions SET status = ?, attempts = ?, error = NULL, is_match = ?, likes_remaining = ?, sent_at = ? WHERE id = ?",
+                (
+                    SENT,
+                    attempts + 1,
+                    result.is_match if result else None,
+                    result.likes_remaining if result else None,
+                    time.time(),
+                    action_id,
+                ),
+            )
+        self.sent += 1
+
+    def _wait_sent(self):
+        while not self._stopping and (
+            self._next_action(self.out_of_likes) or self._in_flight
+        ):
+            self._wakeup.wait()
+
+    def flush(self):
+        """Waits until every pending action that can be sent has been sent"""
+        with self._lock:
+            self._wait_sent()
+
+    def close(self, wait=True):
+        """
+        Stops the sender, after it sent every pending action if wait is set, the actions left
+        are sent by the next run
+        """
+        with self._lock:
+            if wait:
+                self._wait_sent()
+            self._stopping = True
+            self._wakeup.notify_all()
+
+        self._sender.join()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
@@ -0,0 +1,86 @@
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 16
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+# Seconds of random jitter added to every backoff, so that several workers failing at the same
+# time don't all hammer the server again in lockstep
+DEFAULT_BACKOFF_JITTER = 0.5
+
+RETRY_STATUSES = (500, 502, 503, 504)
+# Read errors and 5xx responses are only retried for idempotent requests, a like or pass that
+# timed out may have been applied already. Connection errors are retried for every method,
+# since the request never reached the server
+RETRY_METHODS = ("GET",)
+
+
+def create_adapter(
+    pool_connections=DEFAULT_POOL_CONNECTIONS,
+    pool_maxsize=DEFAULT_POOL_MAXSIZE,
+    max_retries=DEFAULT_MAX_RETRIES,
+    backoff_factor=DEFAULT_BACKOFF_FACTOR,
+    backoff_jitter=DEFAULT_BACKOFF_JITTER,
+    connect_only=False,
+):
+    """
+    Creates a pooled adapter that retries connection errors, and 5xx and read errors of GET
+    requests
+
+    :param bool connect_only: only retry the connections that couldn't be opened, eg. when the
+        caller retries the requests that reached the server itself, through a rate limiter
+    """
+    response_retries = 0 if connect_only else max_retries
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=response_retries,
+        status=response_retries,
+        other=response_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=RETRY_METHODS,
+        raise_on_status=False,
+        backoff_jitter=backoff_jitter,
+    )
+
+    return HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=True,
+        max_retries=retry,
+    )
+
+
+def create_session(
+    pool_connections=DEFAULT_POOL_CONNECTIONS,
+    pool_maxsize=DEFAULT_POOL_MAXSIZE,
+    max_retries=DEFAULT_MAX_RETRIES,
+    backoff_factor=DEFAULT_BACKOFF_FACTOR,
+    backoff_jitter=DEFAULT_BACKOFF_JITTER,
+):
+    """
+    Creates a pooled, keep-alive session that retries connection errors, and 5xx and read
+    errors of GET requests
+
+    The same session can be shared by the Api and by Image.load so that photo downloads
+    reuse the connections to the CDN instead of doing a new TCP + TLS handshake every time
+
+    :param int pool_connections: how many hosts to keep connection pools for
+    :param int pool_maxsize: maximum number of connections kept open to a single host
+    :param int max_retries: how many times a failed request is retried
+    :param float backoff_factor: base of the exponential backoff between retries, in seconds
+    :param float backoff_jitter: maximum seconds of random jitter added to the backoff
+    """
+    adapter = create_adapter(
+        pool_connections, pool_maxsize, max_retries, backoff_factor, backoff_jitter
+    )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
@@ -4,16 +4,22 @@ import requests
 
 from matplotlib import pyplot as plt
 
-from tqdm import tqdm
-from time import sleep
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from time import time
 
 from dotenv import load_dotenv
-from random import random
 import numpy as np
 from datetime import datetime
 
+from modules.storage.seen_filter import SEEN_DB, SeenFilter
 from modules.tinder.api import Api
-from modules.tensor_flow.image_evaluator import ImageEvaluator
+from modules.tinder.downloader import ImageDownloader, DEFAULT_CONCURRENCY
+from modules.tinder.image_cache import ImageCache
+from modules.tinder.rate_limiter import RATE_LIMITS_DB, RateLimiter
+from modules.tinder.swipe_queue import SWIPE_QUEUE_DB, SwipeQueue
+from modules.tensor_flow.image_evaluator import ImageEvaluator, SharedImageEvaluator
 
 load_dotenv()
 
@@ -29,6 +35,25 @@ USER_THRESHOLD = 0.3
 
 USERS_TO_PROCESS = 100
 
+# Input size of the models, photos are decoded at the smallest resolution that still fills it
+IMAGE_SIZE = 224
+
+# How many users are downloaded ahead of the one being scored
+DEFAULT_LOOKAHEAD = 16
+# How many users are scored in a single inference batch
+DEFAULT_BATCH_USERS = 8
+DEFAULT_WORKERS = 4
+
+FACES_MODEL = "model/faces.keras"
+USERS_MODEL = "model/users.keras"
+SHARED_MODEL = "model/shared.keras"
+
+# How many recs batches in a row can hold nothing but already swiped users before giving up
+MAX_REPEATED_RECS = 3
+
+# Namespace of the swiped users in the seen filter
+SEEN_NAMESPACE = "swipe"
+
 
 def remove_outliers(data):
     """
@@ -47,6 +72,208 @@ def remove_outliers(data):
     return data[(data >= lower_bound) & (data <= upper_bound)]
 
 
+def recs_batches(api, seen_filter, wait_for_swipes):
+    """
+    Yields the users of each recs batch that weren't swiped yet, only fetching the next batch
+    once the consumer asks for it, ie. once the previous batch has been swiped
+
+    Recs repeat the users whose swipe hasn't reached the server yet, so when a batch has
+    nothing new, the queued swipes are sent before fetching again.
+    """
+    empty_batches = 0
+
+    while True:
+        print("Fetching new profile set...")
+        nearby_users = api.get_nearby_users()
+        print(f"Got {len(nearby_users)} profiles\n\n")
+
+        if len(nearby_users) == 0:
+            return
+
+        unseen = seen_filter.unseen(nearby_users)
+        if unseen:
+            empty_batches = 0
+            yield unseen
+            continue
+
+        empty_batches += 1
+        if empty_batches > MAX_REPEATED_RECS:
+            print("Recs keep returning profiles that were already swiped")
+            return
+        wait_for_swipes()
+
+
+def prepare_user(user, downloader):
+    """Downloads the photos of a user and crops their faces and bodies"""
+    images = [image for image in user.images if image.face_box and image.user_box]
+    downloads = [(image, downloader.submit(image)) for image in images]
+
+    faces = []
+    users = []
+    originals = []
+
+    for image, download in downloads:
+        try:
+            data = download.result()
+        except requests.RequestException as e:
+            print(f"Failed to download {image.url}: {str(e)}")
+            continue
+
+        try:
+            image.load_bytes(data, min_crop_size=IMAGE_SIZE)
+            faces.append(image.get_face())
+            users.append(image.get_user())
+            originals.append(image.get_original())
+        except Exception as e:
+            # A corrupt photo shouldn't stop the run, the user is scored on the others
+            print(f"Failed to decode {image.url}: {str(e)}")
+            continue
+
+    return faces, users, originals
+
+
+def prepared_batches(recs, downloader, workers, lookahead, batch_users):
+    """
+    Yields lists of up to batch_users (user, faces, users, originals), in the order the users
+    were received, while the photos of at most the next lookahead users of the same recs
+    batch are downloaded and cropped in the background
+
+    A list never spans two recs batches, so every user of a batch has been swiped before the
+    next one is fetched.
+    """
+    for nearby_users in recs:
+        remaining = iter(nearby_users)
+        pending = deque(
+            (user, workers.submit(prepare_user, user, downloader))
+            for user in islice(remaining, max(1, lookahead))
+        )
+
+        batch = []
+        while pending:
+            user, prepared = pending.popleft()
+            for next_user in islice(remaining, 1):
+                pending.append(
+                    (next_user, workers.submit(prepare_user, next_user, downloader))
+                )
+
+            try:
+                batch.append((user, *prepared.result()))
+            except Exception as e:
+                # Not swiped nor recorded as seen, so they come up again
+                print(f"Failed to prepare {user.name} ({user.id}): {str(e)}")
+
+            if batch and (len(batch) == batch_users or not pending):
+                yield batch
+                batch = []
+
+
+def score_users(batch, evaluate):
+    """
+    Scores the faces and bodies of several users in one inference batch
+
+    Args:
+    batch (list): (user, faces, users, originals) tuples.
+    evaluate (callable): Takes the faces and bodies of the whole batch and returns their scores.
+
+    Returns the face and user scores of each user, in the same order as the batch
+    """
+    faces = [face for _, user_faces, _, _ in batch for face in user_faces]
+    users = [body for _, _, user_bodies, _ in batch for body in user_bodies]
+
+    if not faces or not users:
+        return [(np.array([]), np.array([])) for _ in batch]
+
+    face_results, user_results = evaluate(faces, users)
+
+    # Split the flat results back into one array per user
+    face_splits = np.cumsum([len(user_faces) for _, user_faces, _, _ in batch])[:-1]
+    user_splits = np.cumsum([len(user_bodies) for _, _, user_bodies, _ in batch])[:-1]
+
+    return list(
+        zip(
+            np.split(face_results, face_splits),
+            np.split(user_results, user_splits),
+        )
+    )
+
+
+def print_user(user, num_users_processed):
+    today = datetime.today()
+    age = (
+        (
+            today.year
+            - user.birth_date.year
+            - (
+                (today.month, today.day)
+                < (user.birth_date.month, user.birth_date.day)
+            )
+        )
+        if user.birth_date
+        else None
+    )
+
+    print(
+        f"\n\n\n---- {user.name} ({age}) {user.distance:.0f}km ---- ({num_users_processed}/{USERS_TO_PROCESS})"
+    )
+    print(f"{user.id}")
+    print(f"Looking for: {user.looking_for}")
+    print(f"\n{user.bio}")
+
+
+def should_like_user(user, face_results, user_results):
+    # face_avg = np.mean(face_results)
+    # user_avg = np.mean(user_results)
+
+    face_avg_no_outliers = np.mean(remove_outliers(face_results))
+    user_avg_no_outliers = np.mean(remove_outliers(user_results))
+
+    should_like_face = face_avg_no_outliers >= FACE_THRESHOLD
+    should_like_user = user_avg_no_outliers >= USER_THRESHOLD
+    should_like = should_like_face or should_like_user
+
+    if user.looking_for and "Short-term fun" in user.looking_for:
+        should_like = True
+
+    if user.bio and "f1" in user.bio.lower():
+        should_like = True
+
+    # Display images with scores using matplotlib
+    # fig, axs = plt.subplots(2, max(len(faces), len(users)), figsize=(20, 12))
+    # fig.suptitle(f"Results for {user.name}")
+
+    # for i, (face, score) in enumerate(zip(faces, face_results)):
+    #     axs[0, i].imshow(face)
+    #     axs[0, i].set_title(f"Face Score: {score:.3f}")
+    #     axs[0, i].axis("off")
+    # axs[0, -1].text(
+    #     1.05,
+    #     0.5,
+    #     f"Face Avg: {face_avg:.3f}\n\nAvg no outliers: {face_avg_no_outliers:.3f}",
+    #     transform=axs[0, -1].transAxes,
+    #     verticalalignment="center",
+    # )
+
+    # for i, (user, score) in enumerate(zip(originals, user_results)):
+    #     axs[1, i].imshow(user)
+    #     axs[1, i].set_title(f"User Score: {score:.3f}")
+    #     axs[1, i].axis("off")
+    # axs[1, -1].text(
+    #     1.05,
+    #     0.5,
+    #     f"User Avg: {user_avg:.3f}\n\nAvg no outliers: {user_avg_no_outliers:.3f}",
+    #     transform=axs[1, -1].transAxes,
+    #     verticalalignment="center",
+    # )
+
+    # fig.text(0.5, 0.01, f"Face: {should_like_face}          User: {should_like_user}           Like: {should_like}", ha="center", va="bottom", fontsize=20)
+
+    # plt.show()
+
+    print(f"\nFace: {face_avg_no_outliers:.3f}\t Body: {user_avg_no_outliers:.3f}")
+
+    return should_like
+
+
 def main():
     auth_token = os.getenv("AUTH_TOKEN")
     if not auth_token:
@@ -55,138 +282,183 @@ def main():
         )
         return
 
-    api = Api(auth_token)
+    parser = argparse.ArgumentParser(description="Swipes on nearby users")
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Directory to cache downloaded photos in, disabled if not given",
+        dest="cache_dir",
+    )
+    parser.add_argument(
+        "--lookahead",
+        type=int,
+        default=DEFAULT_LOOKAHEAD,
+        help="How many users to download ahead of the one being scored",
+        dest="lookahead",
+    )
+    parser.add_argument(
+        "--batch_users",
+        type=int,
+        default=DEFAULT_BATCH_USERS,
+        help="How many users to score in a single inference batch",
+        dest="batch_users",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Maximum number of photo downloads in flight",
+        dest="concurrency",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of workers decoding and cropping photos",
+        dest="workers",
+    )
+    parser.add_argument(
+        "--face_model",
+        default=FACES_MODEL,
+        help="Face model, either .keras or .tflite exported with export_tflite.py",
+        dest="face_model",
+    )
+    parser.add_argument(
+        "--user_model",
+        default=USERS_MODEL,
+        help="User model, either .keras or .tflite exported with export_tflite.py",
+        dest="user_model",
+    )
+    parser.add_argument(
+        "--shared_model",
+        action="store_true",
+        help=f"Use the single shared backbone model ({SHARED_MODEL}) trained with train.py --shared",
+        dest="shared_model",
+    )
+    parser.add_argument(
+        "--swipe_queue",
+        default=os.path.join(DEFAULT_OUTPUT_DIRECTORY, SWIPE_QUEUE_DB),
+        help="Database of the swipes waiting to be sent, the ones left by an interrupted run are sent first",
+        dest="swipe_queue",
+    )
+    parser.add_argument(
+        "--seen_db",
+        default=os.path.join(DEFAULT_OUTPUT_DIRECTORY, SEEN_DB),
+        help="Database of the users already swiped, the same file as farm_photos.py keeps its farmed users in, but kept apart from them",
+        dest="seen_db",
+    )
+    parser.add_argument(
+        "--rate_limits",
+        default=os.path.join(DEFAULT_OUTPUT_DIRECTORY, RATE_LIMITS_DB),
+        help="Database of the API rate limits, pass the same one as farm_photos.py to share the limits of the account",
+        dest="rate_limits",
+    )
+    args = parser.parse_args()
+
+    cache = ImageCache(args.cache_dir) if args.cache_dir else None
+
+    # Shared with farm_photos.py, so both stay within the limits of the account together
+    api = Api(auth_token, rate_limiter=RateLimiter(args.rate_limits))
+    seen_filter = SeenFilter(args.seen_db, SEEN_NAMESPACE)
+    # Swipes are sent in the background, so the next users are scored right away
+    swipes = SwipeQueue(args.swipe_queue, api)
+    if swipes.pending():
+        print(f"Sending {swipes.pending()} swipes left by the last run")
+    downloader = ImageDownloader(api.session, concurrency=args.concurrency, cache=cache)
+    workers = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="prepare")
+
+    if args.shared_model:
+        shared_evaluator = SharedImageEvaluator(
+            SHARED_MODEL, target_size=(IMAGE_SIZE, IMAGE_SIZE)
+        )
+        evaluators = {"shared": shared_evaluator}
+        evaluate = shared_evaluator.evaluate_faces_and_users
+    else:
+        face_evaluator = ImageEvaluator(
+            args.face_model, target_size=(IMAGE_SIZE, IMAGE_SIZE)
+        )
+        user_evaluator = ImageEvaluator(
+            args.user_model, target_size=(IMAGE_SIZE, IMAGE_SIZE)
+        )
+        evaluators = {"face": face_evaluator, "body": user_evaluator}
 
-    face_evaluator = ImageEvaluator("model/faces.keras")
-    user_evaluator = ImageEvaluator("model/users.keras")
+        def evaluate(faces, users):
+            return (
+                face_evaluator.evaluate_images(faces),
+                user_evaluator.evaluate_images(users),
+            )
 
     num_users_processed = 0
+    num_users_swiped = 0
+    start_time = time()
 
-    while num_users_processed < USERS_TO_PROCESS:
-        print("Fetching new profile set...")
-        nearby_users = api.get_nearby_users()
-        print(f"Got {len(nearby_users)} profiles\n\n")
+    batches = prepared_batches(
+        recs_batches(api, seen_filter, swipes.flush),
+        downloader,
+        workers,
+        args.lookahead,
+        args.batch_users,
+    )
 
-        if len(nearby_users) == 0:
+    while num_users_processed < USERS_TO_PROCESS:
+        batch = next(batches, None)
+        if batch is None:
             print("Ran out of profiles. Try again tomorrow or expand search settings")
-            exit()
-
-        for user in nearby_users:
-            today = datetime.today()
-            age = (
-                (
-                    today.year
-                    - user.birth_date.year
-                    - (
-                        (today.month, today.day)
-                        < (user.birth_date.month, user.birth_date.day)
-                    )
-                )
-                if user.birth_date
-                else None
-            )
+            break
 
-            print(
-                f"\n\n\n---- {user.name} ({age}) {user.distance:.0f}km ---- ({num_users_processed}/{USERS_TO_PROCESS})"
-            )
-            print(f"{user.id}")
-            print(f"Looking for: {user.looking_for}")
-            print(f"\n{user.bio}")
-
-            faces = []
-            users = []
-            originals = []
-
-            for image in tqdm(
-                user.images, leave=False, desc=f"Downloading images for {user.name}"
-            ):
-                if not image.face_box or not image.user_box:
-                    continue
-                try:
-                    image.load()
-                    faces.append(image.get_face())
-                    users.append(image.get_user())
-                    originals.append(image.get_original())
-
-                except requests.RequestException as e:
-                    print(f"Failed to download {image.url}: {str(e)}")
-                    continue
-
-            if len(faces) == 0 or len(users) == 0:
+        scores = score_users(batch, evaluate)
+
+        # Swipes are still made in the order the users were received
+        for (user, faces, bodies, originals), (face_results, user_results) in zip(
+            batch, scores
+        ):
+            if num_users_processed >= USERS_TO_PROCESS:
+                break
+
+            print_user(user, num_users_processed)
+            num_users_swiped += 1
+
+            if len(faces) == 0 or len(bodies) == 0:
                 print(
                     "\u001b[31mUser has no photos of themselves. Passing...\u001b[37m"
                 )
                 print("-----------------------------\n\n")
 
-                api.dislike(user.id)
-                sleep(random() * 2)
+                swipes.enqueue_pass(user.id, user.name)
+                seen_filter.add([user.id])
                 continue
 
-            face_results = face_evaluator.evaluate_images(faces)
-            user_results = user_evaluator.evaluate_images(users)
-
-            # face_avg = np.mean(face_results)
-            # user_avg = np.mean(user_results)
-
-            face_avg_no_outliers = np.mean(remove_outliers(face_results))
-            user_avg_no_outliers = np.mean(remove_outliers(user_results))
-
-            should_like_face = face_avg_no_outliers >= FACE_THRESHOLD
-            should_like_user = user_avg_no_outliers >= USER_THRESHOLD
-            should_like = should_like_face or should_like_user
-
-            if user.looking_for and "Short-term fun" in user.looking_for:
-                should_like = True
-
-            if user.bio and "f1" in user.bio.lower():
-                should_like = True
-
-            # Display images with scores using matplotlib
-            # fig, axs = plt.subplots(2, max(len(faces), len(users)), figsize=(20, 12))
-            # fig.suptitle(f"Results for {user.name}")
-
-            # for i, (face, score) in enumerate(zip(faces, face_results)):
-            #     axs[0, i].imshow(face)
-            #     axs[0, i].set_title(f"Face Score: {score:.3f}")
-            #     axs[0, i].axis("off")
-            # axs[0, -1].text(
-            #     1.05,
-            #     0.5,
-            #     f"Face Avg: {face_avg:.3f}\n\nAvg no outliers: {face_avg_no_outliers:.3f}",
-            #     transform=axs[0, -1].transAxes,
-            #     verticalalignment="center",
-            # )
-
-            # for i, (user, score) in enumerate(zip(originals, user_results)):
-            #     axs[1, i].imshow(user)
-            #     axs[1, i].set_title(f"User Score: {score:.3f}")
-            #     axs[1, i].axis("off")
-            # axs[1, -1].text(
-            #     1.05,
-            #     0.5,
-            #     f"User Avg: {user_avg:.3f}\n\nAvg no outliers: {user_avg_no_outliers:.3f}",
-            #     transform=axs[1, -1].transAxes,
-            #     verticalalignment="center",
-            # )
-
-            # fig.text(0.5, 0.01, f"Face: {should_like_face}          User: {should_like_user}           Like: {should_like}", ha="center", va="bottom", fontsize=20)
-
-            # plt.show()
-
-            print(
-                f"\nFace: {face_avg_no_outliers:.3f}\t Body: {user_avg_no_outliers:.3f}"
-            )
-
-            if should_like:
+            if should_like_user(user, face_results, user_results):
+                if not swipes.enqueue_like(user.id, user.name):
+                    # Not recorded as seen, so they come up again once likes are replenished
+                    break
                 print("\u001b[32mLiking...\u001b[37m")
                 num_users_processed += 1
-                api.like(user.id)
             else:
                 print("\u001b[31mPassing...\u001b[37m")
-                api.dislike(user.id)
+                swipes.enqueue_pass(user.id, user.name)
+            seen_filter.add([user.id])
 
             print("-----------------------------\n\n")
 
+        elapsed_minutes = (time() - start_time) / 60
+        latencies = ", ".join(
+            f"{name} {evaluator.latency_stats()['p50_ms']:.0f}ms"
+            for name, evaluator in evaluators.items()
+        )
+        print(
+            f"{num_users_swiped / elapsed_minutes:.1f} users/minute, inference p50 {latencies}, "
+            f"{seen_filter.skip_rate():.0%} of profiles already swiped, {swipes.pending()} swipes queued"
+        )
+
+        if swipes.out_of_likes:
+            print("Out of likes. Try again tomorrow")
+            break
+
+    print(f"Sending the {swipes.pending()} queued swipes...")
+    swipes.close()
+    print(f"Sent {swipes.sent} swipes, {swipes.matches} matches")
+
 
 if __name__ == "__main__":
     main()
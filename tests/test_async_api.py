@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+pytest.importorskip("PIL")
+pytest.importorskip("requests")
+
+from aiohttp import web
+
+from modules.tinder.async_api import AsyncApi
+from modules.tinder.rate_limiter import Budget, DEFAULT, RateLimiter
+
+# Fast enough that the tests never wait on the limiter
+BUDGETS = {DEFAULT: Budget(rate=1000, burst=1000, max_rate=1000)}
+
+RECS = {
+    "data": {
+        "results": [
+            {
+                "distance_mi": 3,
+                "user": {
+                    "_id": "a1",
+                    "name": "Alice",
+                    "photos": [{"url": "http://photos.test/a1.jpg"}],
+                },
+            }
+        ]
+    }
+}
+
+
+def run_with_stub(test, **api_options):
+    """Runs test(api, calls) against a local stub of the API"""
+    calls = []
+    failures = {"recs": 1, "throttled_likes": 1}
+
+    async def recs(request):
+        calls.append(request.path)
+        if failures["recs"]:
+            failures["recs"] -= 1
+            return web.json_response({}, status=503)
+        return web.json_response(RECS)
+
+    async def like(request):
+        calls.append(request.path)
+        user_id = request.match_info["user_id"]
+        if user_id == "gone":
+            return web.json_response({"status": 404}, status=404)
+        if user_id == "throttled" and failures["throttled_likes"]:
+            failures["throttled_likes"] -= 1
+            return web.json_response({}, status=429, headers={"Retry-After": "0"})
+        return web.json_response({"match": user_id == "match", "likes_remaining": 99})
+
+    async def dislike(request):
+        calls.append(request.path)
+        return web.json_response({}, status=500)
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/v2/recs/core", recs)
+        app.router.add_post("/like/{user_id}", like)
+        app.router.add_post("/pass/{user_id}", dislike)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            async with AsyncApi(
+                "token",
+                base_url=f"http://127.0.0.1:{port}",
+                rate_limiter=RateLimiter(budgets=BUDGETS),
+                **api_options,
+            ) as api:
+                await test(api, calls)
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(main())
+
+
+def test_get_retries_server_errors():
+    async def test(api, calls):
+        users = await api.get_nearby_users()
+
+        assert [user.id for user in users] == ["a1"]
+        assert users[0].images[0].url == "http://photos.test/a1.jpg"
+        assert calls == ["/v2/recs/core", "/v2/recs/core"]
+
+    run_with_stub(test)
+
+
+def test_like_retries_429():
+    async def test(api, calls):
+        result = await api.like("throttled")
+
+        assert not result.is_match
+        assert result.likes_remaining == 99
+        assert calls == ["/like/throttled", "/like/throttled"]
+
+    run_with_stub(test)
+
+
+def test_error_statuses_raise():
+    async def test(api, calls):
+        with pytest.raises(aiohttp.ClientResponseError) as error:
+            await api.like("gone")
+        assert error.value.status == 404
+
+        # A pass may have been applied already, so a 5xx isn't retried
+        with pytest.raises(aiohttp.ClientResponseError) as error:
+            await api.dislike("someone")
+        assert error.value.status == 500
+
+        assert calls == ["/like/gone", "/pass/someone"]
+
+    run_with_stub(test)
+
+
+def test_requests_run_concurrently():
+    async def test(api, calls):
+        results = await asyncio.gather(*(api.like(f"user{i}") for i in range(20)))
+
+        assert len(results) == 20
+        assert sorted(calls) == sorted(f"/like/user{i}" for i in range(20))
+
+    run_with_stub(test)
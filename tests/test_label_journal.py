@@ -0,0 +1,54 @@
+import json
+
+from modules.storage.label_journal import LabelJournal, read_labels
+
+
+def test_labels_and_reverts(tmp_path):
+    path = tmp_path / "labels.jsonl"
+    with LabelJournal(str(path)) as journal:
+        journal.label("a", "positive")
+        seq = journal.label("b", "negative")
+        journal.label("a", "negative")
+        journal.revert(seq)
+
+        assert journal.labels() == {"a": "negative"}
+
+    assert read_labels(str(path)) == {"a": "negative"}
+
+
+def test_sessions_never_share_a_sequence_number(tmp_path):
+    path = str(tmp_path / "labels.jsonl")
+    with LabelJournal(path) as first, LabelJournal(path) as second:
+        seqs = [
+            first.label("a", "positive"),
+            second.label("b", "negative"),
+            first.label("c", "positive"),
+        ]
+        second.revert(seqs[0])
+
+    assert seqs == [1, 2, 3]
+    assert read_labels(path) == {"b": "negative", "c": "positive"}
+
+
+def test_append_after_torn_line(tmp_path):
+    path = tmp_path / "labels.jsonl"
+    with LabelJournal(str(path)) as journal:
+        journal.label("a", "positive")
+
+    # A crash while the next record was being written
+    with open(path, "a") as file:
+        file.write(json.dumps({"seq": 2, "name": "b"})[:10])
+
+    with LabelJournal(str(path)) as journal:
+        seq = journal.label("c", "negative")
+        assert journal.labels() == {"a": "positive", "c": "negative"}
+
+    assert seq == 2
+    assert read_labels(str(path)) == {"a": "positive", "c": "negative"}
+
+
+def test_read_labels_without_journal(tmp_path):
+    path = tmp_path / "missing" / "labels.jsonl"
+
+    assert read_labels(str(path)) == {}
+    assert not path.parent.exists()
@@ -0,0 +1,24 @@
+from modules.tinder.rate_limiter import DEFAULT, Budget, RateLimiter
+
+BUDGETS = {DEFAULT: Budget(rate=1, burst=5, max_rate=4)}
+
+
+def rate_after(*statuses):
+    with RateLimiter(budgets=BUDGETS) as limiter:
+        for status in statuses:
+            limiter.reserve(DEFAULT)
+            limiter.record(DEFAULT, status)
+        return limiter.stats()[DEFAULT]["rate"]
+
+
+def test_successes_raise_the_rate():
+    assert rate_after(200, 204) > rate_after(200)
+
+
+def test_client_errors_leave_the_rate():
+    assert rate_after(200, 404, 403, 401) == rate_after(200)
+
+
+def test_server_errors_and_throttling_cut_the_rate():
+    assert rate_after(200, 503) < rate_after(200)
+    assert rate_after(200, 429) < rate_after(200, 503)
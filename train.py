@@ -1,59 +1,120 @@
+import argparse
+import json
+import math
 import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
 
-from tensorflow.keras.layers import Flatten, Dense, Dropout
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+
+from tensorflow.keras.layers import Flatten, Dense, Dropout, Input
 from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from tensorflow.keras.applications import VGG16
 from tensorflow.keras.models import Model
 from tensorflow.keras.callbacks import ReduceLROnPlateau
+from tensorflow.keras.utils import Sequence
+
+from modules.tensor_flow.callbacks import InputStallMonitor, ThroughputMonitor
+from modules.tensor_flow.dataset import (
+    augment_batch,
+    build_dataset,
+    load_image,
+    split_category_files,
+)
+from modules.storage.image_store import ImageStore
+from modules.storage.label_journal import LABEL_JOURNAL, read_labels
+from modules.tensor_flow.feature_cache import FeatureCache, file_hash
+from modules.tensor_flow.image_evaluator import SHARED_OUTPUTS
 
 
 # Directories
 SOURCE_DIR = "images/classified"
+IMAGES_DIR = "images/downloaded"
 OUTPUT_DIR = "model"
 CATEGORIES = ["users", "faces"]
 
+SHARED_MODEL = "shared.keras"
+FEATURE_CACHE_DIR = os.path.join(OUTPUT_DIR, "feature_cache")
+
 IMAGE_SIZE = 224
+BATCH_SIZE = 32
+EPOCHS = 30
+VALIDATION_SPLIT = 0.2
+SHUFFLE_BUFFER = 1000
+
+AUGMENTATION = dict(
+    rotation_range=40,
+    width_shift_range=0.2,
+    height_shift_range=0.2,
+    shear_range=0.2,
+    zoom_range=0.2,
+    horizontal_flip=True,
+    fill_mode="nearest",
+)
+
+# How many augmented versions of each training image are cached by default
+DEFAULT_AUGMENTED_VARIANTS = 4
+# Bumped whenever augment_batch changes, so the cached augmented variants are computed again
+AUGMENTATION_VERSION = 2
+
+# Distribution strategies
+SINGLE = "single"
+MIRRORED = "mirrored"
+MULTI_WORKER = "multi_worker"
+STRATEGIES = [SINGLE, MIRRORED, MULTI_WORKER]
+
+# How many logical devices the CPU is split into for the mirrored strategy without GPUs
+DEFAULT_CPU_REPLICAS = 2
+
+PRECISIONS = ["float32", "mixed_float16", "mixed_bfloat16"]
 
 
 # Load data
-def load_data(parent_directory):
-    """Load images from parent directory, expecting 'positive' and 'negative' subfolders."""
-    datagen = ImageDataGenerator(
-        rescale=1.0 / 255,
-        validation_split=0.2,
-        rotation_range=40,
-        width_shift_range=0.2,
-        height_shift_range=0.2,
-        shear_range=0.2,
-        zoom_range=0.2,
-        horizontal_flip=True,
-        fill_mode="nearest",
-    )
+def labelled_files(category, args):
+    """
+    Lists the labelled images of a category, from the label journal and the images moved into
+    SOURCE_DIR by older versions of classify_photos.py, split into training and validation
+    """
+    labels = read_labels(args.labels)
 
-    train_generator = datagen.flow_from_directory(
-        directory=parent_directory,
-        target_size=(IMAGE_SIZE, IMAGE_SIZE),
-        color_mode="rgb",
-        batch_size=32,
-        class_mode="binary",
-        subset="training",
+    return split_category_files(
+        SOURCE_DIR, category, labels, ImageStore(args.images_dir), VALIDATION_SPLIT
     )
 
-    validation_generator = datagen.flow_from_directory(
-        directory=parent_directory,
-        target_size=(IMAGE_SIZE, IMAGE_SIZE),
-        color_mode="rgb",
-        batch_size=32,
-        class_mode="binary",
-        subset="validation",
+
+def load_data(training, validation, batch_size=BATCH_SIZE, cache_file=""):
+    """
+    Load the (path, label) pairs of the training and validation images.
+
+    Returns augmented, shuffled training batches and plain validation batches.
+    """
+    print(f"Found {len(training)} training and {len(validation)} validation images")
+
+    train_dataset = build_dataset(
+        training,
+        IMAGE_SIZE,
+        batch_size,
+        augmentation=AUGMENTATION,
+        shuffle_buffer=SHUFFLE_BUFFER,
+        cache_file=cache_file and f"{cache_file}_training",
+    )
+    validation_dataset = build_dataset(
+        validation,
+        IMAGE_SIZE,
+        batch_size,
+        cache_file=cache_file and f"{cache_file}_validation",
     )
 
-    return train_generator, validation_generator
+    return train_dataset, validation_dataset
 
 
 # Define the CNN model
-def create_model():
+def create_backbone():
     base_model = VGG16(
         weights="imagenet", include_top=False, input_shape=(IMAGE_SIZE, IMAGE_SIZE, 3)
     )
@@ -62,48 +123,466 @@ def create_model():
     for layer in base_model.layers:
         layer.trainable = False
 
-    # Adding custom layers on top of VGG16
-    x = Flatten()(base_model.output)
-    x = Dense(1024, activation="relu")(x)
+    return base_model
+
+
+def create_head(features, name=None):
+    """Adds the custom dense layers that classify the VGG16 features, prefixing their names with name if given"""
+    x = Flatten(name=name and f"{name}_flatten")(features)
+    x = Dense(1024, activation="relu", name=name and f"{name}_dense_1")(x)
     x = Dropout(0.5)(x)
-    x = Dense(1024, activation="relu")(x)
+    x = Dense(1024, activation="relu", name=name and f"{name}_dense_2")(x)
     x = Dropout(0.5)(x)
-    output = Dense(1, activation="sigmoid")(x)
+    # Keep the output in float32 with mixed precision, so the loss is computed accurately
+    return Dense(1, activation="sigmoid", dtype="float32", name=name)(x)
+
+
+def create_model():
+    base_model = create_backbone()
+
+    # Adding custom layers on top of VGG16
+    output = create_head(base_model.output)
 
     return Model(inputs=base_model.input, outputs=output)
 
 
-def main():
-    for category in CATEGORIES:
-        source_dir = os.path.join(SOURCE_DIR, category)
+def training_label(args):
+    """Describes the strategy and precision options used, for the throughput report"""
+    label = f"{args.strategy}, {args.precision}"
+    return f"{label}, XLA" if args.jit_compile else label
+
+
+def compile_and_fit(
+    model, train_data, validation_data, args, images_per_epoch, callbacks=()
+):
+    """Compiles and trains a model, reporting its throughput"""
+    model.compile(
+        optimizer=Adam(learning_rate=0.0001),
+        loss="binary_crossentropy",
+        metrics=["accuracy"],
+        jit_compile=args.jit_compile,
+    )
 
-        train_generator, validation_generator = load_data(source_dir)
-        model = create_model()
+    throughput = ThroughputMonitor(images_per_epoch, training_label(args))
 
-        model.compile(
-            optimizer=Adam(learning_rate=0.0001),
-            loss="binary_crossentropy",
-            metrics=["accuracy"],
+    reduce_lr = ReduceLROnPlateau(
+        monitor="val_loss", factor=0.2, patience=5, min_lr=0.00001
+    )
+
+    # Train the model
+    return model.fit(
+        train_data,
+        validation_data=validation_data,
+        epochs=EPOCHS,
+        callbacks=[reduce_lr, throughput, *callbacks],
+    )
+
+
+def train_model(model, training, validation, args, cache_file=""):
+    """Trains a model on the (path, label) pairs of the training and validation images"""
+    train_dataset, validation_dataset = load_data(
+        training, validation, args.batch_size, cache_file
+    )
+
+    return compile_and_fit(
+        model,
+        train_dataset,
+        validation_dataset,
+        args,
+        images_per_epoch=len(training),
+        callbacks=[InputStallMonitor(train_dataset)],
+    )
+
+
+class CachedFeatureSequence(Sequence):
+    """
+    Batches of cached backbone features and their labels
+
+    Every time an image is drawn, one of its cached variants is picked at random, so the head
+    still sees augmented images without running the backbone again.
+
+    :param FeatureCache cache: the cache holding the features
+    :param list entries: (file hash, label) of every image
+    :param int variants: how many augmented variants are cached per image, besides the original
+    :param bool shuffle: whether to shuffle the images and pick random variants every epoch
+    """
+
+    def __init__(self, cache, entries, variants, shuffle, batch_size=BATCH_SIZE):
+        super().__init__()
+        self.cache = cache
+        self.entries = entries
+        self.variants = variants
+        self.shuffle = shuffle
+        self.batch_size = batch_size
+        self._rng = np.random.default_rng(0)
+        self._order = np.arange(len(entries))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return math.ceil(len(self.entries) / self.batch_size)
+
+    def __getitem__(self, index):
+        batch = self._order[index * self.batch_size : (index + 1) * self.batch_size]
+
+        if self.shuffle:
+            variants = self._rng.integers(0, self.variants + 1, len(batch))
+        else:
+            variants = np.zeros(len(batch), dtype=int)
+
+        keys = [
+            (self.entries[i][0], int(variant)) for i, variant in zip(batch, variants)
+        ]
+        features = self.cache.features[self.cache.rows(keys)].astype(np.float32)
+        labels = np.array([self.entries[i][1] for i in batch], dtype=np.float32)
+
+        return features, labels
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self._rng.shuffle(self._order)
+
+
+def update_feature_cache(base_model, cache, files, variants):
+    """
+    Runs the backbone over the (path, file hash) pairs and their augmented variants that are
+    not cached yet
+    """
+    pending = [
+        (path, content_hash, variant)
+        for path, content_hash in files
+        for variant in range(variants + 1)
+        if (content_hash, variant) not in cache
+    ]
+
+    for start in tqdm(
+        range(0, len(pending), BATCH_SIZE), desc="Caching backbone features"
+    ):
+        batch = pending[start : start + BATCH_SIZE]
+
+        images = []
+        for path, content_hash, variant in batch:
+            image = tf.cast(load_image(path, IMAGE_SIZE), tf.float32)
+
+            # Each variant always gets the same augmentation, so cached rows are reproducible
+            if variant:
+                seed = tf.constant([int(content_hash[:8], 16), variant], tf.int64)
+                image = augment_batch(image[None], **AUGMENTATION, seed=seed)[0]
+
+            images.append(image / 255.0)
+
+        features = base_model.predict_on_batch(tf.stack(images))
+        cache.add(
+            [(content_hash, variant) for _, content_hash, variant in batch], features
         )
 
-        reduce_lr = ReduceLROnPlateau(
-            monitor="val_loss", factor=0.2, patience=5, min_lr=0.00001
+
+def train_cached_head(base_model, training, validation, cache, args, name=None):
+    """
+    Trains a head on cached backbone features of the training and validation images,
+    computing the features of new images first
+
+    Returns the trained head as a model that takes backbone features
+    """
+    hashes = {path: file_hash(path) for path, _ in training + validation}
+
+    update_feature_cache(
+        base_model,
+        cache,
+        [(path, hashes[path]) for path, _ in training],
+        args.augmented_variants,
+    )
+    update_feature_cache(
+        base_model, cache, [(path, hashes[path]) for path, _ in validation], 0
+    )
+
+    features = Input(shape=base_model.output.shape[1:])
+    head = Model(
+        inputs=features,
+        outputs=create_head(features, name=name and f"{name}_head"),
+        name=name,
+    )
+
+    compile_and_fit(
+        head,
+        CachedFeatureSequence(
+            cache,
+            [(hashes[path], label) for path, label in training],
+            args.augmented_variants,
+            shuffle=True,
+            batch_size=args.batch_size,
+        ),
+        CachedFeatureSequence(
+            cache,
+            [(hashes[path], label) for path, label in validation],
+            0,
+            shuffle=False,
+            batch_size=args.batch_size,
+        ),
+        args,
+        images_per_epoch=len(training),
+    )
+    return head
+
+
+def train_category(base_model, category, args, name=None):
+    """
+    Trains a head for category on top of the backbone, either end to end or from the feature
+    cache, and returns its output tensor
+    """
+    training, validation = labelled_files(category, args)
+
+    if args.cache_features:
+        cache = FeatureCache(
+            args.feature_cache_dir,
+            base_model.output.shape[1:],
+            augmentation=f"{AUGMENTATION_VERSION}:{json.dumps(AUGMENTATION, sort_keys=True)}",
         )
+        head = train_cached_head(base_model, training, validation, cache, args, name)
+        return head(base_model.output)
+
+    output = create_head(base_model.output, name=name)
+    train_model(
+        Model(inputs=base_model.input, outputs=output),
+        training,
+        validation,
+        args,
+        args.dataset_cache and f"{args.dataset_cache}_{category}",
+    )
+    return output
 
-        # Train the model
-        history = model.fit(
-            train_generator,
-            steps_per_epoch=train_generator.samples // train_generator.batch_size,
-            validation_data=validation_generator,
-            validation_steps=validation_generator.samples
-            // validation_generator.batch_size,
-            epochs=30,
-            callbacks=[reduce_lr],
+
+def create_strategy(name, cpu_replicas=DEFAULT_CPU_REPLICAS):
+    """
+    Creates the distribution strategy to train with
+
+    Without GPUs, the mirrored strategy splits the CPU into cpu_replicas logical devices. The
+    multi-worker strategy reads the cluster from the TF_CONFIG environment variable.
+    """
+    if name == MIRRORED:
+        if tf.config.list_physical_devices("GPU"):
+            return tf.distribute.MirroredStrategy()
+
+        cpu = tf.config.list_physical_devices("CPU")[0]
+        tf.config.set_logical_device_configuration(
+            cpu, [tf.config.LogicalDeviceConfiguration()] * cpu_replicas
+        )
+        return tf.distribute.MirroredStrategy(
+            devices=[device.name for device in tf.config.list_logical_devices("CPU")],
+            cross_device_ops=tf.distribute.ReductionToOneDevice(),
         )
 
-        # Save the trained model
+    if name == MULTI_WORKER:
+        return tf.distribute.MultiWorkerMirroredStrategy()
+
+    return tf.distribute.get_strategy()
+
+
+def is_chief():
+    """Whether this process writes the models to OUTPUT_DIR, ie. it isn't a secondary multi-worker process"""
+    task = json.loads(os.environ.get("TF_CONFIG", "{}")).get("task", {})
+    return task.get("type", "worker") == "chief" or (
+        task.get("type", "worker") == "worker" and task.get("index", 0) == 0
+    )
+
+
+def save_model(model, name):
+    """
+    Saves a model in OUTPUT_DIR
+
+    Saving runs collective ops under the multi-worker strategy, so every worker has to save or
+    the chief hangs. The other workers save to a temporary directory that is then removed.
+    """
+    if is_chief():
         os.makedirs(OUTPUT_DIR, exist_ok=True)
-        model.save(os.path.join(OUTPUT_DIR, f"{category}.keras"))
+        model.save(os.path.join(OUTPUT_DIR, name))
+        return
+
+    directory = tempfile.mkdtemp()
+    try:
+        model.save(os.path.join(directory, name))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def reserve_ports(count):
+    """
+    Binds count distinct free ports and returns the bound sockets
+
+    Where SO_REUSEPORT is available (gRPC sets it too), the sockets are kept bound while the
+    workers run, so no other process can take a port between picking it and the worker binding
+    it. They never listen, so connections still go to the workers.
+    """
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket()
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(("localhost", 0))
+        sockets.append(sock)
+    return sockets
+
+
+def launch_local_workers(count):
+    """
+    Runs this script in count local processes that train together as a multi-worker cluster,
+    and returns the worst exit code
+    """
+    reserved = reserve_ports(count)
+    cluster = {
+        "worker": [f"localhost:{sock.getsockname()[1]}" for sock in reserved]
+    }
+
+    # Without SO_REUSEPORT the workers can't bind ports that are still held
+    if not hasattr(socket, "SO_REUSEPORT"):
+        for sock in reserved:
+            sock.close()
+
+    try:
+        processes = []
+        for index in range(count):
+            tf_config = {"cluster": cluster, "task": {"type": "worker", "index": index}}
+            processes.append(
+                subprocess.Popen(
+                    [sys.executable, *sys.argv],
+                    env={**os.environ, "TF_CONFIG": json.dumps(tf_config)},
+                )
+            )
+
+        return max(process.wait() for process in processes)
+    finally:
+        for sock in reserved:
+            sock.close()
+
+
+def train_separate_models(args):
+    """Trains one independent model per category"""
+    for category in CATEGORIES:
+        base_model = create_backbone()
+        output = train_category(base_model, category, args)
+        model = Model(inputs=base_model.input, outputs=output)
+
+        # Save the trained model
+        save_model(model, f"{category}.keras")
+
+
+def train_shared_model(args):
+    """
+    Trains one head per category on top of a single frozen VGG16 backbone, and exports them
+    as one model with an output per category (in SHARED_OUTPUTS order)
+    """
+    base_model = create_backbone()
+
+    # The backbone is frozen, so training one head leaves the other untouched
+    outputs = [
+        train_category(base_model, category, args, name=category)
+        for category in SHARED_OUTPUTS
+    ]
+
+    shared_model = Model(inputs=base_model.input, outputs=outputs)
+
+    save_model(shared_model, SHARED_MODEL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trains the face and user models")
+    parser.add_argument(
+        "--labels",
+        default=os.path.join(SOURCE_DIR, LABEL_JOURNAL),
+        help="Label journal written by classify_photos.py",
+        dest="labels",
+    )
+    parser.add_argument(
+        "--images_dir",
+        default=IMAGES_DIR,
+        help="Directory with the farmed images the label journal refers to",
+        dest="images_dir",
+    )
+    parser.add_argument(
+        "--shared",
+        action="store_true",
+        help=f"Train a single model with a shared backbone and a head per category, saved as {SHARED_MODEL}",
+        dest="shared",
+    )
+    parser.add_argument(
+        "--cache_features",
+        action="store_true",
+        help="Run the frozen backbone once per image and train the heads from cached features",
+        dest="cache_features",
+    )
+    parser.add_argument(
+        "--feature_cache_dir",
+        default=FEATURE_CACHE_DIR,
+        help="Where to keep the cached backbone features",
+        dest="feature_cache_dir",
+    )
+    parser.add_argument(
+        "--augmented_variants",
+        type=int,
+        default=DEFAULT_AUGMENTED_VARIANTS,
+        help="How many augmented versions of each training image to cache",
+        dest="augmented_variants",
+    )
+    parser.add_argument(
+        "--dataset_cache",
+        default="",
+        help="File prefix to cache the decoded images in, instead of keeping them in memory",
+        dest="dataset_cache",
+    )
+    parser.add_argument(
+        "--strategy",
+        choices=STRATEGIES,
+        default=SINGLE,
+        help="Train on one device, mirrored over the GPUs or logical CPUs, or over several workers set up with TF_CONFIG",
+        dest="strategy",
+    )
+    parser.add_argument(
+        "--cpu_replicas",
+        type=int,
+        default=DEFAULT_CPU_REPLICAS,
+        help="How many logical devices to split the CPU into for the mirrored strategy, if there are no GPUs",
+        dest="cpu_replicas",
+    )
+    parser.add_argument(
+        "--local_workers",
+        type=int,
+        default=0,
+        help="Run the multi-worker strategy in this many local processes, without setting up TF_CONFIG",
+        dest="local_workers",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=PRECISIONS,
+        default=PRECISIONS[0],
+        help="Train in float32 or with float16/bfloat16 mixed precision",
+        dest="precision",
+    )
+    parser.add_argument(
+        "--jit_compile",
+        action="store_true",
+        help="Compile the training step with XLA",
+        dest="jit_compile",
+    )
+    args = parser.parse_args()
+
+    if args.local_workers and args.strategy != MULTI_WORKER:
+        parser.error("--local_workers needs --strategy multi_worker")
+    if args.cache_features and args.strategy == MULTI_WORKER:
+        parser.error("--cache_features can't be used with several workers")
+
+    if args.local_workers and "TF_CONFIG" not in os.environ:
+        sys.exit(launch_local_workers(args.local_workers))
+
+    tf.keras.mixed_precision.set_global_policy(args.precision)
+    strategy = create_strategy(args.strategy, args.cpu_replicas)
+
+    # Each replica gets a batch of BATCH_SIZE
+    args.batch_size = BATCH_SIZE * strategy.num_replicas_in_sync
+
+    with strategy.scope():
+        if args.shared:
+            train_shared_model(args)
+        else:
+            train_separate_models(args)
 
     print("Models trained and saved successfully.")
 